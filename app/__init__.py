@@ -6,13 +6,14 @@ from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
 from flask_login import LoginManager
 from flask_babel import Babel, lazy_gettext as _l
-from redis import Redis
-import rq
 import logging
 # why is SMTPHandler under logging?
 from logging.handlers import SMTPHandler
 from logging.handlers import RotatingFileHandler
 from elasticsearch import Elasticsearch
+from app.last_seen import LastSeenTracker
+from app import cache, fragments, health, queues
+from app.cache import create_cache
 import os
 
 
@@ -40,10 +41,26 @@ def create_app(config_class=Config):
     mail.init_app(app)
     moment.init_app(app)
     babel.init_app(app)
-    app.elasticsearch = Elasticsearch([app.config['ELASTICSEARCH_URL']]) \
+    app.elasticsearch = Elasticsearch([app.config['ELASTICSEARCH_URL']],
+                                      request_timeout=app.config['ELASTICSEARCH_TIMEOUT']) \
         if app.config['ELASTICSEARCH_URL'] else None
-    app.redis = Redis.from_url(app.config['REDIS_URL'])
-    app.task_queue = rq.Queue('microblog-tasks', connection=app.redis)
+    from app.search import create_search_backend
+    app.search_backend = create_search_backend(app)
+    health.init_app(app)
+    # timeouts, so a redis that has hung makes commands fail instead of making them wait forever
+    app.redis = health.GuardedRedis.from_url(app.config['REDIS_URL'], socket_timeout=app.config['REDIS_TIMEOUT'],
+                                             socket_connect_timeout=app.config['REDIS_TIMEOUT'])
+    app.redis.breaker = app.health.breakers['redis']
+    queues.init_app(app)
+    app.last_seen = LastSeenTracker(app)
+    app.user_cache = create_cache(app, 'user', app.config['USER_CACHE_SIZE'], app.config['USER_CACHE_TTL'])
+    app.token_cache = create_cache(app, 'token', app.config['TOKEN_CACHE_SIZE'], app.config['TOKEN_CACHE_TTL'])
+    app.translation_cache = create_cache(app, 'translation', app.config['TRANSLATION_CACHE_SIZE'],
+                                         app.config['TRANSLATION_CACHE_TTL'])
+    app.post_html_cache = create_cache(app, 'post_html', app.config['POST_HTML_CACHE_SIZE'],
+                                       app.config['POST_HTML_CACHE_TTL'])
+    cache.init_app(app)
+    fragments.init_app(app)
 
     from app.errors import bp as errors_bp
     app.register_blueprint(errors_bp)
@@ -2,4 +2,4 @@ from flask import Blueprint
 
 bp = Blueprint('api', __name__)
 
-from app.api import users, errors, tokens
\ No newline at end of file
+from app.api import users, errors, tokens, stats, search
\ No newline at end of file
@@ -0,0 +1,36 @@
+from flask import request, url_for
+from app.api import bp
+from app.api.auth import token_auth
+from app.api.errors import bad_request, error_response
+from app.models import Post
+from app.pagination import InvalidCursor
+from app.search import SearchUnavailable
+
+
+@bp.route('/search', methods=['GET'])
+@token_auth.login_required
+def search():
+    # ?q= is the query, and the _links.next/prev cursors walk through the results
+    q = request.args.get('q', '').strip()
+    if not q:
+        return bad_request('must include a q query')
+    per_page = min(request.args.get('per_page', 10, type=int), 100)
+    cursor = request.args.get('cursor')
+    try:
+        posts = Post.search_page(q, cursor, per_page)
+    except InvalidCursor:
+        return bad_request('invalid or expired cursor')
+    except SearchUnavailable:
+        return error_response(503, 'search is not available right now')
+    return {
+        'items': [post.to_dict() for post in posts.items],
+        '_meta': {
+            'per_page': per_page,
+            'total_items': posts.total
+        },
+        '_links': {
+            'self': url_for('api.search', q=q, cursor=cursor, per_page=per_page),
+            'next': url_for('api.search', q=q, cursor=posts.next_cursor, per_page=per_page) if posts.has_next else None,
+            'prev': url_for('api.search', q=q, cursor=posts.prev_cursor, per_page=per_page) if posts.has_prev else None
+        }
+    }
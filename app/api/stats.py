@@ -0,0 +1,23 @@
+import redis
+from app.api import bp
+from app.api.auth import token_auth
+from app.api.errors import error_response
+from app.cache import cache_stats
+from app import queues
+
+
+@bp.route('/stats/caches', methods=['GET'])
+@token_auth.login_required
+def get_cache_stats():
+    # hit/miss counters of the in-memory caches of the process that serves this request
+    return cache_stats()
+
+
+@bp.route('/stats/queues', methods=['GET'])
+@token_auth.login_required
+def get_queue_stats():
+    # queue depth and the wait of the oldest job in each queue, what an autoscaler would go by
+    try:
+        return queues.stats()
+    except redis.exceptions.RedisError:
+        return error_response(503, 'the task queues are not available right now')
@@ -7,6 +7,11 @@ from app.api.errors import bad_request
 from app.api.auth import token_auth
 
 
+def collection_args():
+    # ?cursor= switches a collection to keyset pagination, ?total=1 adds the item count to it
+    return {'cursor': request.args.get('cursor'), 'with_total': request.args.get('total', 0, type=int) == 1}
+
+
 @bp.route('/users/<int:id>', methods=['GET'])
 @token_auth.login_required
 def get_user(id):
@@ -18,7 +23,8 @@ def get_user(id):
 def get_users():
     page = request.args.get('page', 1, type=int)
     per_page = min(request.args.get('per_page', 10, type=int), 100)
-    return User.to_collection_dict(sa.select(User), page, per_page, 'api.get_users')
+    return User.to_collection_dict(sa.select(User), page, per_page, 'api.get_users',
+                                   **collection_args())
 
 
 @bp.route('/users/<int:id>/followers', methods=['GET'])
@@ -27,7 +33,8 @@ def get_followers(id):
     user = db.get_or_404(User, id)
     page = request.args.get('page', 1, type=int)
     per_page = min(request.args.get('per_page', 10, type=int), 100)
-    return User.to_collection_dict(user.followers.select(), page, per_page, 'api.get_followers', id=id)
+    return User.to_collection_dict(user.followers.select(), page, per_page, 'api.get_followers',
+                                   id=id, **collection_args())
 
 
 @bp.route('/users/<int:id>/following', methods=['GET'])
@@ -36,7 +43,8 @@ def get_following(id):
     user = db.get_or_404(User, id)
     page = request.args.get('page', 1, type=int)
     per_page = min(request.args.get('per_page', 10, type=int), 100)
-    return User.to_collection_dict(user.following.select(), page, per_page, 'api.get_following', id=id)
+    return User.to_collection_dict(user.following.select(), page, per_page, 'api.get_following',
+                                   id=id, **collection_args())
 
 
 @bp.route('/users', methods=['POST'])
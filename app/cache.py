@@ -0,0 +1,121 @@
+from collections import OrderedDict
+from threading import Lock, Thread
+from flask import current_app
+import json
+import os
+import time
+import redis
+
+# Every process keeps its own small caches in memory. When something changes, the process that made
+# the change publishes the key on this redis channel and every process (itself included) drops it.
+CHANNEL = 'cache-invalidate'
+
+# seconds the listener waits for a message at a time, it has to be under REDIS_TIMEOUT
+LISTEN_TIMEOUT = 1
+
+
+class TTLCache:
+    """A thread safe LRU cache whose entries also expire ttl seconds after they were stored."""
+
+    def __init__(self, maxsize=1024, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.data.get(key)
+            if entry is None or entry[1] < time.monotonic():
+                if entry is not None:
+                    del self.data[key]
+                self.misses += 1
+                return default
+            self.data.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, ttl=None):
+        with self.lock:
+            self.data[key] = (value, time.monotonic() + (ttl or self.ttl))
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def stats(self):
+        return {'size': len(self.data), 'maxsize': self.maxsize, 'ttl': self.ttl,
+                'hits': self.hits, 'misses': self.misses}
+
+
+def create_cache(app, name, maxsize, ttl):
+    """Make a TTLCache that is listed in the cache stats and can be invalidated across processes by name."""
+    cache = TTLCache(maxsize, ttl)
+    app.extensions.setdefault('caches', {})[name] = cache
+    return cache
+
+
+def cache_stats():
+    return {name: cache.stats() for name, cache in current_app.extensions.get('caches', {}).items()}
+
+
+def invalidate(name, *keys):
+    """Drop keys from the named cache here, and ask every other process to do the same."""
+    cache = current_app.extensions['caches'][name]
+    for key in keys:
+        cache.delete(key)
+    try:
+        current_app.redis.publish(CHANNEL, json.dumps({'cache': name, 'keys': list(keys)}))
+    except redis.exceptions.RedisError:
+        # the other processes will catch up when their entries expire
+        current_app.logger.warning('Could not publish invalidation for cache %s', name)
+
+
+def init_app(app):
+    # the listener is started from the first request, so that it runs in the worker process and not in
+    # a parent that is about to fork
+    app.before_request(lambda: start_listener(app))
+
+
+def start_listener(app):
+    """Start this process's invalidation listener, if it isn't running yet. RQ workers call it after forking."""
+    if app.testing or app.extensions.get('cache_listener') == os.getpid():
+        return
+    app.extensions['cache_listener'] = os.getpid()
+    Thread(target=_listen, args=(app,), daemon=True).start()
+
+
+def _listen(app):
+    caches = app.extensions['caches']
+    disconnected = False
+    while True:
+        try:
+            pubsub = app.redis.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(CHANNEL)
+            if disconnected:
+                # anything published while we were away was missed, so start over
+                for cache in caches.values():
+                    cache.clear()
+                disconnected = False
+            while True:
+                # not listen(), which would take the socket timeout of an idle channel for redis being gone
+                message = pubsub.get_message(timeout=LISTEN_TIMEOUT)
+                if message is None:
+                    continue
+                data = json.loads(message['data'])
+                cache = caches.get(data['cache'])
+                if cache is not None:
+                    for key in data['keys']:
+                        cache.delete(key)
+        except redis.exceptions.RedisError:
+            disconnected = True
+            time.sleep(5)
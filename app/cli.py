@@ -37,4 +37,183 @@ def init(lang):
         raise RuntimeError('extract command failed')
     if os.system('pybabel init -i messages.pot -d app/translations -l ' + lang):
         raise RuntimeError('init command failed.')
-    os.remove('messages.pot')
\ No newline at end of file
+    os.remove('messages.pot')
+
+@bp.cli.group()
+def counters():
+    """Denormalized counter maintenance commands."""
+    pass
+
+@counters.command()
+@click.option('--batch-size', default=1000, help='Number of users to recount per transaction.')
+def reconcile(batch_size):
+    """Recount posts and followers and fix drifted User counters."""
+    from app.models import User
+    total = 0
+    for last_id, fixed in User.reconcile_counters(batch_size):
+        total += fixed
+        click.echo(f'up to user {last_id}: fixed {fixed}')
+    click.echo(f'{total} users fixed')
+
+@bp.cli.group()
+def search():
+    """Search index commands."""
+    pass
+
+@search.command()
+@click.option('--workers', default=4, help='Number of worker processes streaming rows into the index.')
+@click.option('--chunk-size', default=1000, help='Rows per database fetch and per bulk request.')
+def reindex(workers, chunk_size):
+    """Rebuild the search indexes and switch to them with no downtime."""
+    from flask import current_app
+    from app.models import SearchableMixin
+    import time
+    if not current_app.search_backend:
+        raise click.ClickException('Search is turned off (SEARCH_BACKEND)')
+    for model in SearchableMixin.__subclasses__():
+        start = time.time()
+
+        def progress(done, total):
+            click.echo(f'{model.__tablename__}: {done}/{total} rows, '
+                       f'{done / max(time.time() - start, 1e-6):.0f} rows/s')
+
+        target = model.reindex(workers, chunk_size, progress)
+        click.echo(f'{model.__tablename__} now points at {target} ({time.time() - start:.1f}s)')
+
+@bp.cli.group()
+def language():
+    """Post language detection commands."""
+    pass
+
+@language.command()
+@click.option('--workers', default=4, help='Number of worker processes running the detector.')
+@click.option('--chunk-size', default=1000, help='Post ids per chunk of work.')
+def backfill(workers, chunk_size):
+    """Detect the language of every post that doesn't have one yet."""
+    from app import language as detection
+    import time
+    start = time.time()
+
+    def progress(done, total):
+        click.echo(f'{done}/{total} posts, {done / max(time.time() - start, 1e-6):.0f} posts/s')
+
+    done = detection.backfill(workers, chunk_size, progress)
+    click.echo(f'{done} posts done in {time.time() - start:.1f}s')
+
+@bp.cli.group('import')
+def import_():
+    """Bulk import commands, for moving users over from another platform."""
+    pass
+
+def _import_progress(what):
+    import time
+    start = time.time()
+
+    def progress(done):
+        click.echo(f'{done} {what}, {done / max(time.time() - start, 1e-6):.0f} {what}/s')
+    return progress
+
+def _catch_up(after_post_id=None):
+    # the rows went in without the per-object session events, so do their work in bulk now
+    from flask import current_app
+    from app import importer, timeline
+    from app.models import User
+    import redis
+    fixed = sum(fixed for _, fixed in User.reconcile_counters())
+    click.echo(f'counters fixed for {fixed} users')
+    try:
+        click.echo(f'{timeline.clear()} cached timelines dropped')
+    except redis.exceptions.RedisError:
+        click.echo('redis is not available, cached timelines will be stale until they expire')
+    if after_post_id is not None and current_app.search_backend:
+        done = importer.index_posts(after_post_id, progress=_import_progress('posts indexed'))
+        click.echo(f'{done} posts indexed')
+
+@import_.command('users')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--batch-size', default=5000, help='Rows per INSERT.')
+def import_users(path, batch_size):
+    """Create users from a CSV file with username, email and about_me columns."""
+    from app import importer
+    created, skipped = importer.import_users(path, batch_size, _import_progress('rows'))
+    click.echo(f'{created} users created, {skipped} skipped')
+
+@import_.command('posts')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--user', help='Author of the lines without a username, as in a file from the export.')
+@click.option('--batch-size', default=5000, help='Rows per INSERT.')
+def import_posts(path, user, batch_size):
+    """Load posts from an NDJSON file, gzipped or not, in the format of the post export."""
+    from app import db, importer
+    from app.models import Post, SearchableMixin
+    import sqlalchemy as sa
+    after_post_id = db.session.scalar(sa.select(sa.func.max(Post.id))) or 0
+    with SearchableMixin.indexing_suspended():
+        created, skipped = importer.import_posts(path, user, batch_size, _import_progress('lines'))
+    click.echo(f'{created} posts created, {skipped} skipped because their author does not exist')
+    _catch_up(after_post_id)
+    click.echo('run flask language backfill to detect the language of the new posts')
+
+@import_.command('follows')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--batch-size', default=5000, help='Rows per INSERT.')
+def import_follows(path, batch_size):
+    """Load follow edges from a CSV file with follower and followed usernames."""
+    from app import importer
+    created, skipped = importer.import_follows(path, batch_size, _import_progress('rows'))
+    click.echo(f'{created} follows created, {skipped} skipped')
+    _catch_up()
+
+@bp.cli.group()
+def queues():
+    """Task queue commands."""
+    pass
+
+@queues.command()
+def stats():
+    """Show how deep each task queue is and how long its oldest job has waited."""
+    from app import queues as task_queues
+    for name, numbers in task_queues.stats().items():
+        click.echo(f'{name}: ' + ', '.join(f'{key} {value}' for key, value in numbers.items()))
+
+@queues.command()
+@click.option('--fork/--no-fork', default=False, help='Run every job in a fresh fork of its worker.')
+@click.option('--scheduler/--no-scheduler', default=True,
+              help='Let the workers run retries and jobs that were scheduled for later.')
+def pool(fork, scheduler):
+    """Run the workers for every task queue, as many for each as TASK_QUEUES says.
+
+    Each queue gets workers of its own, so a long export never holds up an email. Workers that exit are
+    started again, and stopping the pool stops them all.
+    """
+    from flask import current_app
+    from app import queues as task_queues, worker as task_worker
+    workers = [(f'{name}-{i}-{os.getpid()}', [name])
+               for name, count in task_queues.parse_queues(current_app.config['TASK_QUEUES']).items()
+               for i in range(count)]
+    click.echo(f'starting {len(workers)} workers')
+    task_worker.run(current_app._get_current_object(), workers, fork=fork, with_scheduler=scheduler)
+
+@bp.cli.command()
+@click.argument('queue_names', nargs=-1)
+@click.option('--processes', type=int, help='Number of worker processes, WORKER_PROCESSES by default.')
+@click.option('--fork/--no-fork', default=False, help='Run every job in a fresh fork of its worker.')
+@click.option('--burst', is_flag=True, help='Stop once the queues are empty.')
+@click.option('--scheduler/--no-scheduler', default=True,
+              help='Let the workers run retries and jobs that were scheduled for later.')
+def worker(queue_names, processes, fork, burst, scheduler):
+    """Run task workers on the named queues, or all of them, most urgent first.
+
+    The app is built and warmed up once, and the workers are forked from it and run job after job. See
+    app/worker.py.
+    """
+    from flask import current_app
+    from app import worker as task_worker
+    unknown = set(queue_names) - current_app.task_queues.keys()
+    if unknown:
+        raise click.BadParameter(f'no queue called {", ".join(sorted(unknown))}', param_hint='QUEUE_NAMES')
+    queue_names = list(queue_names or current_app.task_queues)
+    processes = processes or current_app.config['WORKER_PROCESSES']
+    workers = [(f'worker-{i}-{os.getpid()}', queue_names) for i in range(processes)]
+    click.echo(f'starting {processes} workers on {", ".join(queue_names)}')
+    task_worker.run(current_app._get_current_object(), workers, fork=fork, burst=burst, with_scheduler=scheduler)
@@ -1,7 +1,35 @@
-from flask_mail import Message
-from app import mail
+from flask_mail import Connection, Message
+from app import queues
+from app.health import CircuitOpen
 from flask import current_app
 from threading import Thread
+from rq import Retry, get_current_job
+import base64
+import json
+import smtplib
+import time
+import uuid
+import redis
+
+# outgoing mail waits in a redis list, RQ jobs send it in batches, at most MAIL_CONCURRENCY of them at once
+OUTBOX = 'mail-outbox'
+
+# Each sending job holds a lease in this sorted set, scored by when the lease runs out. A job that died
+# without giving its lease back stops counting once it has expired.
+SENDERS = 'mail-senders'
+
+# how long a lease lasts, it is renewed after every batch
+LEASE = 300
+
+CLAIM_LEASE = """
+redis.call('zremrangebyscore', KEYS[1], '-inf', ARGV[1])
+if redis.call('zcard', KEYS[1]) < tonumber(ARGV[2]) then
+    redis.call('zadd', KEYS[1], ARGV[3], ARGV[4])
+    return 1
+end
+return 0
+"""
+
 
 # make an sync wrapper function to send the mail asynchronously
 # which avoids waiting on the single process before continuing with the program
@@ -12,7 +40,7 @@ def send_async_email(app, msg):
     # This is also the case with file like objects, since they have these __enter__ and __exit__ things setup
     with app.app_context():
         # The context is basically like a temporary global variable. It is made possible by thread-local storage
-        mail.send(msg)
+        send_now(msg)
 
 def send_email(subject, sender, recipients, text_body, html_body, attachments=None, sync=False):
     msg = Message(subject, sender=sender, recipients=recipients)
@@ -23,8 +51,9 @@ def send_email(subject, sender, recipients, text_body, html_body, attachments=No
         for attachment in attachments:
             msg.attach(*attachment)
     if sync:
-        mail.send(msg)
-    else:
+        send_now(msg)
+    elif not queue_email(msg):
+        # redis is down, so fall back to sending it from here.
         # create a new thread and use it call the function with the specified args
         # this basically "primes" the function and says "go do your work, and tell me if you have downtime so I
         # can continue exception elsewhere". You can also set daemon=True to say that this thread should just be killed
@@ -32,6 +61,133 @@ def send_email(subject, sender, recipients, text_body, html_body, attachments=No
         Thread(target=send_async_email, args=(current_app._get_current_object(), msg)).start()
 
 
+def send_now(msg):
+    # mail.send(msg), with a timeout
+    with TimeoutConnection(current_app.extensions['mail']) as conn:
+        conn.send(msg)
+
+
+def queue_email(msg):
+    """Put a message in the outbox and make sure a job is coming to send it. Returns False if redis is down."""
+    try:
+        current_app.redis.rpush(OUTBOX, json.dumps(_to_dict(msg)))
+        _schedule()
+        return True
+    except redis.exceptions.RedisError:
+        current_app.logger.warning('Could not queue an email, sending it directly')
+        return False
+
+
+def _schedule():
+    # if the mail server is down, try again in a little while, and then a while longer
+    queues.schedule_once(f'{OUTBOX}:scheduled', LEASE, 'app.tasks.send_queued_email',
+                         retry=Retry(max=3, interval=[10, 60, 300]))
+
+
+def drain_outbox():
+    """Send everything in the outbox, a batch per SMTP connection. Runs inside an RQ job.
+
+    Returns how many were sent. If the mail server can't be reached, the messages go back in the outbox
+    and the job fails, so that RQ tries it again later.
+    """
+    r = current_app.redis
+    queues.clear_scheduled(f'{OUTBOX}:scheduled')
+    job = get_current_job()
+    lease = job.get_id() if job else uuid.uuid4().hex
+    claim = r.register_script(CLAIM_LEASE)
+    if not claim(keys=[SENDERS], args=[time.time(), current_app.config['MAIL_CONCURRENCY'],
+                                       time.time() + LEASE, lease]):
+        # enough jobs are sending already, and they keep going until the outbox is empty
+        return 0
+    sent = 0
+    try:
+        while True:
+            batch = r.lpop(OUTBOX, current_app.config['MAIL_BATCH_SIZE'])
+            if not batch:
+                break
+            messages = [json.loads(message) for message in batch]
+            unsent = deliver(messages)
+            sent += len(messages) - len(unsent)
+            if unsent:
+                retry = [m for m in unsent if m.get('attempts', 0) < current_app.config['MAIL_MAX_ATTEMPTS']]
+                if len(retry) < len(unsent):
+                    current_app.logger.error('Gave up on %d emails', len(unsent) - len(retry))
+                if retry:
+                    # back at the front, they have waited longest
+                    r.lpush(OUTBOX, *[json.dumps(dict(m, attempts=m.get('attempts', 0) + 1))
+                                      for m in reversed(retry)])
+                raise RuntimeError(f'Could not send {len(unsent)} emails, the mail server is not answering')
+            r.zadd(SENDERS, {lease: time.time() + LEASE}, xx=True)
+    finally:
+        r.zrem(SENDERS, lease)
+    # anything queued while we were on the last batch may have found the flag set and not scheduled a job
+    if r.llen(OUTBOX):
+        _schedule()
+    return sent
+
+
+def deliver(messages):
+    """Send a batch of outbox messages over one SMTP connection. Returns the ones that were not sent.
+
+    A message the server refuses is dropped and logged, trying it again would get the same answer. If the
+    connection fails, whatever hadn't gone yet is returned, all of them if it never opened.
+    """
+    unsent = list(messages)
+    try:
+        # the breaker skips the connection attempt while the mail server is known to be down
+        with current_app.health.breakers['smtp'], TimeoutConnection(current_app.extensions['mail']) as conn:
+            while unsent:
+                try:
+                    conn.send(_from_dict(unsent[0]))
+                except (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused, smtplib.SMTPDataError) as e:
+                    current_app.logger.error('Email to %s was refused: %s', unsent[0]['recipients'], e)
+                unsent.pop(0)
+    except CircuitOpen:
+        current_app.logger.warning('Not sending emails, the mail server is down')
+    except (smtplib.SMTPException, OSError):
+        current_app.logger.warning('Could not send emails', exc_info=True)
+    return unsent
+
+
+class TimeoutConnection(Connection):
+    """A Flask-Mail connection that gives up on a mail server that doesn't answer in MAIL_TIMEOUT seconds.
+
+    Flask-Mail opens its SMTP connections without a timeout.
+    """
+
+    def configure_host(self):
+        timeout = current_app.config['MAIL_TIMEOUT']
+        if self.mail.use_ssl:
+            host = smtplib.SMTP_SSL(self.mail.server, self.mail.port, timeout=timeout)
+        else:
+            host = smtplib.SMTP(self.mail.server, self.mail.port, timeout=timeout)
+        host.set_debuglevel(int(self.mail.debug))
+        if self.mail.use_tls:
+            host.starttls()
+        if self.mail.username and self.mail.password:
+            host.login(self.mail.username, self.mail.password)
+        return host
+
 
+def _to_dict(msg):
+    return {
+        'subject': msg.subject,
+        'sender': msg.sender,
+        'recipients': msg.recipients,
+        'body': msg.body,
+        'html': msg.html,
+        'attachments': [[a.filename, a.content_type, base64.b64encode(
+            a.data if isinstance(a.data, bytes) else a.data.encode('utf-8')).decode('ascii')]
+            for a in msg.attachments]
+    }
 
 
+def _from_dict(data):
+    # a (name, address) sender comes back from JSON as a list
+    sender = tuple(data['sender']) if isinstance(data['sender'], list) else data['sender']
+    msg = Message(data['subject'], sender=sender, recipients=data['recipients'])
+    msg.body = data['body']
+    msg.html = data['html']
+    for filename, content_type, content in data['attachments']:
+        msg.attach(filename, content_type, base64.b64decode(content))
+    return msg
@@ -0,0 +1,31 @@
+from app import db
+from app.models import Post
+import gzip
+import json
+import sqlalchemy as sa
+
+# A user's posts are exported as NDJSON, one JSON object per line, compressed with gzip. The posts are read
+# and written a chunk at a time, so an export takes the same memory whether the user has ten posts or a
+# million, and only the compressed file is ever whole.
+
+
+def write_posts(user_id, fileobj, chunk_size=1000, progress=None):
+    """Write a user's posts, oldest first, to fileobj as gzipped NDJSON. Returns how many were written.
+
+    progress, if given, is called with the number of posts in each chunk as it is written.
+    """
+    # plain rows instead of Post objects, nothing needs to be tracked by the session
+    query = (sa.select(Post.body, Post.timestamp).where(Post.user_id == user_id)
+             .order_by(Post.timestamp.asc(), Post.id.asc()).execution_options(yield_per=chunk_size))
+    count = 0
+    # closing the gzip file writes its trailer, and leaves fileobj open for the caller
+    with gzip.GzipFile(fileobj=fileobj, mode='wb', compresslevel=6) as gz:
+        for chunk in db.session.execute(query).partitions():
+            gz.write(''.join(
+                json.dumps({'body': body, 'timestamp': timestamp.isoformat() + 'Z'}) + '\n'
+                for body, timestamp in chunk
+            ).encode('utf-8'))
+            count += len(chunk)
+            if progress:
+                progress(len(chunk))
+    return count
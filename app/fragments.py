@@ -0,0 +1,78 @@
+from hashlib import sha1
+from flask import current_app, g, render_template
+from markupsafe import Markup
+import redis
+
+# The HTML of each post, as _post.html renders it, is cached in two places like translations are: a small
+# LRU cache in each process (see app/cache.py) and redis, which all the processes share. A page of posts
+# is one redis MGET for what the process doesn't have, and only posts neither has are rendered.
+#
+# A post's body never changes once it is written, so everything else the HTML depends on is in the key:
+# the post id, the locale it was rendered for, the language detected for the post (that is filled in
+# after the post is written), the author's avatar (a hash of their email) and username, and a hash of
+# the template. Changing any of them means a different key, so a user who changes their username or email
+# gets fresh HTML on every post straight away, in every process, and the old entries just expire. _post.html must not depend on who is looking.
+
+TEMPLATE = '_post.html'
+
+
+def template_version():
+    """A hash of _post.html, so that HTML from an older version of the template is never used."""
+    version = current_app.extensions.get('post_html_version')
+    # templates are reloaded when they change in debug mode, so it has to be worked out every time there
+    if version is None or current_app.debug:
+        source = current_app.jinja_env.loader.get_source(current_app.jinja_env, TEMPLATE)[0]
+        version = sha1(source.encode('utf-8')).hexdigest()[:12]
+        current_app.extensions['post_html_version'] = version
+    return version
+
+
+def _cache_key(version, post, locale):
+    # the language goes in as it is, the template renders None and '' differently. The username goes
+    # last, so whatever characters it has can't be mistaken for another part
+    return (f'post-html:{version}:{post.id}:{locale}:{post.language}:{post.author.avatar_digest()}:'
+            f'{post.author.username}')
+
+
+def render_posts(posts):
+    """The HTML of each of the posts, in the same order. Posts can be Post or PostHit objects."""
+    posts = list(posts)
+    if not current_app.config['POST_HTML_CACHE_TTL']:
+        return [Markup(render_template(TEMPLATE, post=post)) for post in posts]
+    version = template_version()
+    keys = [_cache_key(version, post, g.locale) for post in posts]
+    html = {}
+    for key in keys:
+        cached = current_app.post_html_cache.get(key)
+        if cached is not None:
+            html[key] = cached
+    missing = [key for key in dict.fromkeys(keys) if key not in html]
+    if missing:
+        try:
+            for key, cached in zip(missing, current_app.redis.mget(missing)):
+                if cached is not None:
+                    html[key] = cached.decode('utf-8')
+                    current_app.post_html_cache.set(key, html[key])
+        except redis.exceptions.RedisError:
+            pass
+
+    rendered = {}
+    for key, post in zip(keys, posts):
+        if key not in html:
+            html[key] = rendered[key] = render_template(TEMPLATE, post=post)
+            current_app.post_html_cache.set(key, html[key])
+    if rendered:
+        try:
+            # nothing here has to be atomic, so no MULTI/EXEC around it
+            pipe = current_app.redis.pipeline(transaction=False)
+            for key, value in rendered.items():
+                pipe.set(key, value, ex=current_app.config['POST_HTML_TTL'])
+            pipe.execute()
+        except redis.exceptions.RedisError:
+            pass
+    return [Markup(html[key]) for key in keys]
+
+
+def init_app(app):
+    # the templates loop over render_posts(posts) instead of including _post.html for each post
+    app.jinja_env.globals['render_posts'] = render_posts
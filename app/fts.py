@@ -0,0 +1,153 @@
+from threading import Lock
+from app import db
+from app.search import SearchBackend, make_document, searchable_model
+import sqlalchemy as sa
+import re
+import sqlite3
+
+
+class FTSBackend(SearchBackend):
+    """Full text search in a local SQLite file, for deployments (and tests) without elasticsearch.
+
+    Every index is an FTS5 virtual table with a column per document field and the id of the row as its
+    rowid. The __searchable__ fields are full text indexed, the stored ones are UNINDEXED. Any of the words
+    in a query can match in any searchable column, like the multi_match query we send to elasticsearch,
+    and the results are ranked with bm25.
+    """
+
+    # writing a few rows into a local table is quicker than queueing them for a job
+    queued = False
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = Lock()
+        self.conn = None
+
+    def _connect(self):
+        # opened on first use, so commands that never search don't create the file
+        if self.conn is None:
+            self.conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False, timeout=10)
+            if self.path != ':memory:':
+                # the web processes and the rq worker all use the same file, WAL lets them read while one writes
+                self.conn.execute('PRAGMA journal_mode=WAL')
+        return self.conn
+
+    def _has_table(self, index):
+        return self._connect().execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (index,)).fetchone() is not None
+
+    def _fields(self, index):
+        model = searchable_model(index)
+        return model.__searchable__ + model.__stored__
+
+    def _create_table(self, index):
+        searchable = searchable_model(index).__searchable__
+        columns = ', '.join(f'"{field}"' if field in searchable else f'"{field}" UNINDEXED'
+                            for field in self._fields(index))
+        self._connect().execute(f'CREATE VIRTUAL TABLE IF NOT EXISTS "{index}" USING fts5({columns}, '
+                                f"tokenize = 'unicode61 remove_diacritics 2')")
+
+    def _insert(self, index, documents):
+        self._create_table(index)
+        fields = self._fields(index)
+        columns = ', '.join(f'"{field}"' for field in fields)
+        self._connect().executemany(
+            f'INSERT INTO "{index}" (rowid, {columns}) VALUES (?{", ?" * len(fields)})',
+            [(id, *[doc.get(field) for field in fields]) for id, doc in documents.items()]
+        )
+
+    def add(self, index, id, document):
+        self.bulk(index, {id: document}, [])
+
+    def remove(self, index, id):
+        self.bulk(index, {}, [id])
+
+    def query(self, index, query, page, per_page):
+        expression = _match_expression(query)
+        with self.lock:
+            if not expression or not self._has_table(index):
+                return [], 0
+            conn = self._connect()
+            total = conn.execute(f'SELECT count(*) FROM "{index}" WHERE "{index}" MATCH ?',
+                                 (expression,)).fetchone()[0]
+            # rank is the bm25 score of the row, lower is better
+            rows = conn.execute(f'SELECT rowid FROM "{index}" WHERE "{index}" MATCH ? '
+                                f'ORDER BY rank, rowid DESC LIMIT ? OFFSET ?',
+                                (expression, per_page, (page - 1) * per_page)).fetchall()
+        return [row[0] for row in rows], total
+
+    def search_after(self, index, query, context, after, reverse, size, offset=0):
+        expression = _match_expression(query)
+        params = [expression]
+        # bm25 scores are lower for better matches, and newer posts win ties
+        if reverse:
+            seek = '(score < ? OR (score = ? AND rowid > ?))'
+            order = 'score DESC, rowid ASC'
+        else:
+            seek = '(score > ? OR (score = ? AND rowid < ?))'
+            order = 'score ASC, rowid DESC'
+        where = f'"{index}" MATCH ?'
+        if after:
+            score, rowid = after
+            where += f' AND {seek}'
+            params += [score, score, rowid]
+        with self.lock:
+            if not expression or not self._has_table(index):
+                return [], 0, None
+            conn = self._connect()
+            total = conn.execute(f'SELECT count(*) FROM "{index}" WHERE "{index}" MATCH ?',
+                                 (expression,)).fetchone()[0]
+            result = conn.execute(f'SELECT rowid, bm25("{index}") AS score, * FROM "{index}" WHERE {where} '
+                                  f'ORDER BY {order} LIMIT ? OFFSET ?', params + [size, 0 if after else offset])
+            fields = [column[0] for column in result.description[2:]]
+            hits = [(row[0], dict(zip(fields, row[2:])), [row[1], row[0]]) for row in result.fetchall()]
+        return hits, total, None
+
+    def bulk(self, index, documents, remove_ids, retries=None):
+        ids = [(id,) for id in list(documents) + list(remove_ids)]
+        with self.lock:
+            conn = self._connect()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                if self._has_table(index):
+                    conn.executemany(f'DELETE FROM "{index}" WHERE rowid = ?', ids)
+                if documents:
+                    self._insert(index, documents)
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+        # it all went in or it all raised, nothing is left to retry
+        return [], []
+
+    def rebuild(self, index, workers, chunk_size, progress):
+        """Recreate the table and load every row into it in one transaction.
+
+        SQLite only has one writer at a time, so there are no worker processes here. Searches from other
+        connections keep seeing the old table until the transaction commits.
+        """
+        model = searchable_model(index)
+        total = db.session.scalar(sa.select(sa.func.count(model.id)))
+        query = model.search_query().order_by(model.id).execution_options(yield_per=chunk_size)
+        with self.lock:
+            conn = self._connect()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                conn.execute(f'DROP TABLE IF EXISTS "{index}"')
+                self._create_table(index)
+                done = 0
+                for chunk in db.session.scalars(query).partitions():
+                    self._insert(index, {obj.id: make_document(obj) for obj in chunk})
+                    done += len(chunk)
+                    if progress:
+                        progress(done, total)
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+        return index
+
+
+def _match_expression(query):
+    # each word is quoted so that nothing typed in the search box is taken as FTS5 query syntax
+    return ' OR '.join(f'"{word}"' for word in re.findall(r'\w+', query))
@@ -0,0 +1,288 @@
+from datetime import datetime, timezone
+from threading import Lock, Thread
+import json
+import os
+import smtplib
+import time
+import redis
+import requests
+from elasticsearch import TransportError
+
+# backends are checked in the background and their calls go through circuit breakers, results at /health
+
+
+class CircuitOpen(Exception):
+    """Raised instead of calling a backend whose circuit breaker is open."""
+    pass
+
+
+class RedisCircuitOpen(CircuitOpen, redis.exceptions.ConnectionError):
+    # a RedisError, so everything that already copes with redis being down copes with this too
+    pass
+
+
+class CircuitBreaker:
+    """Counts the failures of calls to a backend, and stops the calls once there are too many.
+
+    After threshold failures in a row the breaker opens, and using it raises error at once. reset_timeout
+    seconds later it lets a single call through to try the backend again, and closes if that one works.
+    Only exceptions in failures count against the backend, anything else means it answered.
+    """
+
+    def __init__(self, name, failures, threshold=3, reset_timeout=30, error=CircuitOpen):
+        self.name = name
+        self.failures = failures
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.error = error
+        self.lock = Lock()
+        self.failure_count = 0
+        self.opened_at = None
+        self.trying = False
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at < self.reset_timeout:
+            return 'open'
+        return 'half-open'
+
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if self.trying or time.monotonic() - self.opened_at < self.reset_timeout:
+                return False
+            # half open, this call finds out whether the backend is back
+            self.trying = True
+            return True
+
+    def succeeded(self):
+        with self.lock:
+            self.failure_count = 0
+            self.opened_at = None
+            self.trying = False
+
+    def failed(self):
+        with self.lock:
+            self.failure_count += 1
+            self.trying = False
+            if self.opened_at is not None or self.failure_count >= self.threshold:
+                self.opened_at = time.monotonic()
+
+    def trip(self):
+        """Open the breaker now, a health check found the backend down."""
+        with self.lock:
+            self.failure_count = max(self.failure_count, self.threshold)
+            self.opened_at = time.monotonic()
+            self.trying = False
+
+    def __enter__(self):
+        if not self.allow():
+            raise self.error(f'{self.name} is unavailable')
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is not None and issubclass(exc_type, self.failures):
+            self.failed()
+        else:
+            self.succeeded()
+
+
+class GuardedRedis(redis.Redis):
+    """A redis client whose commands and pipelines go through a circuit breaker."""
+
+    breaker = None
+
+    def execute_command(self, *args, **options):
+        if self.breaker is None:
+            return super().execute_command(*args, **options)
+        with self.breaker:
+            return super().execute_command(*args, **options)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        pipe = GuardedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+        pipe.breaker = self.breaker
+        return pipe
+
+
+class GuardedPipeline(redis.client.Pipeline):
+    breaker = None
+
+    def execute(self, raise_on_error=True):
+        if self.breaker is None:
+            return super().execute(raise_on_error)
+        with self.breaker:
+            return super().execute(raise_on_error)
+
+
+def check_redis(app):
+    # straight to the connection pool, the breaker is what this check decides about
+    redis.Redis(connection_pool=app.redis.connection_pool).ping()
+
+
+def check_elasticsearch(app):
+    app.elasticsearch.options(request_timeout=app.config['HEALTH_CHECK_TIMEOUT']).info()
+
+
+def check_smtp(app):
+    with smtplib.SMTP(app.config['MAIL_SERVER'], app.config['MAIL_PORT'],
+                      timeout=app.config['HEALTH_CHECK_TIMEOUT']) as smtp:
+        smtp.noop()
+
+
+def check_translator(app):
+    # the list of languages needs no key, so this costs nothing
+    response = requests.get(app.config['MS_TRANSLATOR_URL'] + '/languages', params={'api-version': '3.0'},
+                            timeout=app.config['HEALTH_CHECK_TIMEOUT'])
+    if response.status_code >= 500:
+        raise requests.HTTPError(f'the translator answered {response.status_code}', response=response)
+
+
+# name -> (check, the exceptions that count as the backend failing, what the breaker raises when open)
+CHECKS = {
+    'redis': (check_redis, (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError), RedisCircuitOpen),
+    'elasticsearch': (check_elasticsearch, (TransportError,), CircuitOpen),
+    'smtp': (check_smtp, (smtplib.SMTPException, OSError), CircuitOpen),
+    'translator': (check_translator, (requests.RequestException,), CircuitOpen),
+}
+
+# the services outside that one process checks for all of them, see HealthMonitor.run_checks
+SHARED = ('elasticsearch', 'smtp', 'translator')
+
+
+class HealthMonitor:
+    """Runs the checks in CHECKS and keeps the circuit breakers, one of each per backend."""
+
+    def __init__(self, app):
+        self.app = app
+        self.interval = app.config['HEALTH_CHECK_INTERVAL']
+        self.breakers = {name: CircuitBreaker(name, failures, app.config['CIRCUIT_BREAKER_THRESHOLD'],
+                                              app.config['CIRCUIT_BREAKER_RESET'], error)
+                         for name, (_check, failures, error) in CHECKS.items()}
+        self.results = {}
+        self.pid = None
+
+    def configured(self, name):
+        config = self.app.config
+        if name == 'elasticsearch':
+            return self.app.elasticsearch is not None and config['SEARCH_BACKEND'] == 'elasticsearch'
+        if name == 'smtp':
+            return bool(config['MAIL_SERVER']) and config['HEALTH_CHECK_SMTP']
+        if name == 'translator':
+            return bool(config.get('MS_TRANSLATOR_KEY'))
+        return True
+
+    def is_up(self, name):
+        """Whether the backend looked usable last time anyone tried it. Never waits on the backend."""
+        if not self.configured(name):
+            return False
+        result = self.results.get(name)
+        if result is not None and not result['up']:
+            return False
+        return self.breakers[name].state != 'open'
+
+    def check(self, name):
+        start = time.monotonic()
+        try:
+            CHECKS[name][0](self.app)
+            error = None
+        except Exception as e:
+            error = f'{type(e).__name__}: {e}'
+        latency_ms = round((time.monotonic() - start) * 1000, 1)
+        return self._record(name, error, latency_ms, datetime.now(timezone.utc))
+
+    def _record(self, name, error, latency_ms, checked_at):
+        was_up = self.results.get(name, {}).get('up', True)
+        self.results[name] = {'up': error is None, 'error': error, 'latency_ms': latency_ms,
+                              'checked_at': checked_at}
+        if error is None:
+            self.breakers[name].succeeded()
+            if not was_up:
+                self.app.logger.info('%s is back', name)
+        else:
+            self.breakers[name].trip()
+            if was_up:
+                self.app.logger.warning('%s is down: %s', name, error)
+        return error is None
+
+    def check_all(self):
+        return {name: self.check(name) for name in CHECKS if self.configured(name)}
+
+    def run_checks(self):
+        """One round of the background checks."""
+        for name in CHECKS:
+            if not self.configured(name):
+                continue
+            if name in SHARED:
+                self._shared_check(name)
+            else:
+                # every process has connections of its own to redis, so each one finds out for itself
+                self.check(name)
+
+    def _shared_check(self, name):
+        r = self.app.redis
+        key = f'health:{name}'
+        try:
+            # whoever sets the lock does this round's check, and it expires in time for the next round
+            claimed = r.set(f'{key}:lock', os.getpid(), nx=True, ex=max(self.interval - 1, 1))
+            shared = None if claimed else r.get(key)
+        except redis.exceptions.RedisError:
+            # nothing to share through, so each process checks for itself until redis is back
+            claimed, shared = True, None
+        if claimed:
+            self.check(name)
+            result = self.results[name]
+            try:
+                r.set(key, json.dumps(dict(result, checked_at=result['checked_at'].isoformat())),
+                      ex=self.interval * 3)
+            except redis.exceptions.RedisError:
+                pass
+        elif shared is not None:
+            result = json.loads(shared)
+            checked_at = datetime.fromisoformat(result['checked_at'])
+            if name not in self.results or self.results[name]['checked_at'] < checked_at:
+                self._record(name, result['error'], result['latency_ms'], checked_at)
+
+    def report(self):
+        # anyone can read this, so the errors, which name hosts and ports, only go to the log
+        checks = {}
+        for name in CHECKS:
+            if not self.configured(name):
+                checks[name] = {'status': 'disabled'}
+                continue
+            result = self.results.get(name)
+            if result is None:
+                # not checked yet, the breaker alone can't say it is up
+                status = 'unknown' if self.breakers[name].state == 'closed' else 'down'
+            else:
+                status = 'up' if self.is_up(name) else 'down'
+            checks[name] = {
+                'status': status,
+                'breaker': self.breakers[name].state,
+                'latency_ms': result and result['latency_ms'],
+                'checked_at': result and result['checked_at'].isoformat(),
+            }
+        down = [name for name, check in checks.items() if check['status'] == 'down']
+        return {'status': 'degraded' if down else 'ok', 'checks': checks}
+
+    def start(self):
+        # started from the first request like the cache listener, so it runs in the process that serves
+        if self.app.testing or self.pid == os.getpid():
+            return
+        self.pid = os.getpid()
+        Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        while True:
+            try:
+                self.run_checks()
+            except Exception:
+                self.app.logger.exception('Health checks failed')
+            time.sleep(self.interval)
+
+
+def init_app(app):
+    app.health = HealthMonitor(app)
+    app.before_request(app.health.start)
@@ -0,0 +1,152 @@
+from datetime import datetime, timezone
+from app import db
+from app.models import User, Post, followers
+import sqlalchemy as sa
+import csv
+import gzip
+import json
+
+# Bulk loading for users moving over from another platform. Rows are read from the file a batch at a time
+# and written with one executemany INSERT per batch. Nothing goes through the ORM, so none of the per-object
+# work in the session events (counters, timelines, search) happens here, and the `flask import` commands
+# catch all of that up in bulk once the rows are in. See app/cli.py.
+
+
+def open_text(path):
+    # the files from export_posts are gzipped, but a plain one works too
+    with open(path, 'rb') as f:
+        gzipped = f.read(2) == b'\x1f\x8b'
+    if gzipped:
+        return gzip.open(path, 'rt', encoding='utf-8', newline='')
+    return open(path, encoding='utf-8', newline='')
+
+
+def batches(rows, size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class UserIds:
+    """Looks up user ids by username, a batch at a time, and remembers them."""
+
+    def __init__(self):
+        self.ids = {}
+
+    def lookup(self, usernames):
+        missing = set(usernames) - self.ids.keys()
+        if missing:
+            self.ids.update(db.session.execute(
+                sa.select(User.username, User.id).where(User.username.in_(missing))).all())
+        return self.ids
+
+
+def import_users(path, batch_size=5000, progress=None):
+    """Create the users in a CSV file with username and email columns, and optionally about_me.
+
+    Usernames that already exist are left alone. Returns (users created, rows skipped).
+    """
+    user_ids = UserIds()
+    created = skipped = 0
+    with open_text(path) as f:
+        for batch in batches(csv.DictReader(f), batch_size):
+            existing = user_ids.lookup(row['username'] for row in batch)
+            rows = {row['username']: {'username': row['username'], 'email': row['email'],
+                                      'about_me': row.get('about_me') or None}
+                    for row in batch if row['username'] not in existing}
+            if rows:
+                db.session.execute(sa.insert(User), list(rows.values()))
+                db.session.commit()
+            created += len(rows)
+            skipped += len(batch) - len(rows)
+            if progress:
+                progress(created + skipped)
+    return created, skipped
+
+
+def import_posts(path, username=None, batch_size=5000, progress=None):
+    """Load posts from NDJSON, one {"body", "timestamp", "username"} object per line.
+
+    This is the format export_posts writes, which has no username, so username is the author of the lines
+    without one. Lines whose author doesn't exist are skipped. Returns (posts created, lines skipped).
+    """
+    user_ids = UserIds()
+    created = skipped = 0
+    with open_text(path) as f:
+        for batch in batches(filter(None, map(_parse_line, f)), batch_size):
+            authors = user_ids.lookup(post.get('username', username) for post in batch)
+            rows = []
+            for post in batch:
+                user_id = authors.get(post.get('username', username))
+                if user_id is None:
+                    skipped += 1
+                    continue
+                rows.append({'body': post['body'], 'timestamp': _parse_timestamp(post['timestamp']),
+                             'user_id': user_id})
+            if rows:
+                db.session.execute(sa.insert(Post), rows)
+                db.session.commit()
+            created += len(rows)
+            if progress:
+                progress(created + skipped)
+    return created, skipped
+
+
+def import_follows(path, batch_size=5000, progress=None):
+    """Load follow edges from a CSV file with follower and followed columns, both usernames.
+
+    Edges that already exist, or whose users don't, are skipped. Returns (edges created, rows skipped).
+    """
+    user_ids = UserIds()
+    created = skipped = 0
+    with open_text(path) as f:
+        for batch in batches(csv.DictReader(f), batch_size):
+            ids = user_ids.lookup([row['follower'] for row in batch] + [row['followed'] for row in batch])
+            edges = {(ids[row['follower']], ids[row['followed']]) for row in batch
+                     if row['follower'] in ids and row['followed'] in ids and row['follower'] != row['followed']}
+            if edges:
+                edges -= set(db.session.execute(sa.select(followers.c.follower_id, followers.c.followed_id).where(
+                    followers.c.follower_id.in_({follower for follower, _ in edges}),
+                    followers.c.followed_id.in_({followed for _, followed in edges}))).all())
+            if edges:
+                db.session.execute(sa.insert(followers), [{'follower_id': follower, 'followed_id': followed}
+                                                          for follower, followed in edges])
+                db.session.commit()
+            created += len(edges)
+            skipped += len(batch) - len(edges)
+            if progress:
+                progress(created + skipped)
+    return created, skipped
+
+
+def index_posts(after_id, chunk_size=1000, progress=None):
+    """Add the posts with ids above after_id to the search index. Returns how many."""
+    done = 0
+    while True:
+        ids = db.session.scalars(sa.select(Post.id).where(Post.id > after_id).order_by(Post.id)
+                                 .limit(chunk_size)).all()
+        if not ids:
+            return done
+        Post.index_ids(ids, [])
+        after_id = ids[-1]
+        done += len(ids)
+        if progress:
+            progress(done)
+
+
+def _parse_line(line):
+    line = line.strip()
+    return json.loads(line) if line else None
+
+
+def _parse_timestamp(value):
+    # export_posts writes naive UTC times with a Z on the end, and the database keeps them naive
+    timestamp = datetime.fromisoformat(value.removesuffix('Z'))
+    if timestamp.tzinfo:
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    return timestamp
@@ -0,0 +1,123 @@
+from flask import current_app
+from multiprocessing import get_context
+from langdetect import DetectorFactory, LangDetectException, detect
+from langdetect.detector_factory import init_factory
+from app import db, queues
+from app.models import Post
+import sqlalchemy as sa
+import redis
+
+# Working out the language of a post is slow, and the first detection in a process is slower still because
+# that is when langdetect loads all of its language profiles. So new posts are saved with a NULL language
+# and their ids go into a redis set, which an RQ job drains in batches. Posts that could not be queued, and
+# the ones from before this existed, are picked up by `flask language backfill`.
+# A NULL language means not detected yet, '' means detection was tried and failed.
+
+QUEUE_KEY = 'language-queue'
+
+# how long the scheduled flag lives, in case the job that was meant to clear it never ran
+QUEUE_TIMEOUT = 300
+
+# the same text always gets the same answer
+DetectorFactory.seed = 0
+
+
+def load_profiles():
+    """Load the langdetect profiles now instead of on the first detection."""
+    init_factory()
+
+
+def detect_language(text):
+    try:
+        return detect(text)
+    except LangDetectException:
+        return ''
+
+
+def queue_detection(post_ids):
+    try:
+        current_app.redis.sadd(QUEUE_KEY, *post_ids)
+        queues.schedule_once(f'{QUEUE_KEY}:scheduled', QUEUE_TIMEOUT, 'app.tasks.detect_queued_languages')
+    except redis.exceptions.RedisError:
+        current_app.logger.warning('Could not queue language detection, flask language backfill will do it')
+
+
+def process_queue(batch_size=500):
+    """Detect the language of every queued post. Runs inside an RQ job."""
+    queues.clear_scheduled(f'{QUEUE_KEY}:scheduled')
+    done = 0
+    while True:
+        # if we die after the pop, these posts are left with a NULL language for the backfill to find
+        post_ids = [int(id) for id in current_app.redis.spop(QUEUE_KEY, batch_size)]
+        if not post_ids:
+            return done
+        done += detect_languages(post_ids)
+
+
+def detect_languages(post_ids):
+    """Detect and save the language of the posts in post_ids that don't have one. Returns how many."""
+    return _detect(Post.id.in_(post_ids))
+
+
+def detect_id_range(first_id, last_id):
+    return _detect(Post.id.between(first_id, last_id))
+
+
+def _detect(where):
+    rows = db.session.execute(sa.select(Post.id, Post.body).where(where, Post.language.is_(None))).all()
+    if not rows:
+        return 0
+    table = Post.__table__
+    db.session.execute(
+        table.update().where(table.c.id == sa.bindparam('post_id')).values(language=sa.bindparam('detected')),
+        [{'post_id': id, 'detected': detect_language(body)} for id, body in rows]
+    )
+    db.session.commit()
+    # the language is in the search documents, and this UPDATE doesn't go through the session events
+    if current_app.search_backend:
+        Post.index_ids([id for id, _ in rows], [])
+    return len(rows)
+
+
+_worker_app = None
+
+
+def _init_backfill_worker():
+    # each worker process gets its own app and database connection, and loads the profiles once
+    global _worker_app
+    from app import create_app
+    _worker_app = create_app()
+    _worker_app.app_context().push()
+    load_profiles()
+
+
+def _detect_id_range(args):
+    return detect_id_range(*args)
+
+
+def backfill(workers=4, chunk_size=1000, progress=None):
+    """Detect the language of every post that doesn't have one, in id ranges spread over worker processes.
+
+    progress, if given, is called with (posts done, posts total). Returns the number of posts done.
+    """
+    first_id, last_id, total = db.session.execute(
+        sa.select(sa.func.min(Post.id), sa.func.max(Post.id), sa.func.count(Post.id))
+        .where(Post.language.is_(None))).one()
+    db.session.commit()
+    if not total:
+        return 0
+    ranges = [(lo, min(lo + chunk_size - 1, last_id)) for lo in range(first_id, last_id + 1, chunk_size)]
+    done = 0
+    if workers > 1:
+        with get_context('spawn').Pool(workers, initializer=_init_backfill_worker) as pool:
+            for count in pool.imap_unordered(_detect_id_range, ranges):
+                done += count
+                if progress:
+                    progress(done, total)
+    else:
+        load_profiles()
+        for first, last in ranges:
+            done += detect_id_range(first, last)
+            if progress:
+                progress(done, total)
+    return done
@@ -0,0 +1,80 @@
+from datetime import datetime, timezone
+from threading import Lock, Thread
+import atexit
+import time
+import sqlalchemy as sa
+
+
+class LastSeenTracker:
+    """Buffers User.last_seen updates in memory and writes them out in bulk.
+
+    Every authenticated request used to commit its own UPDATE for last_seen. Now a request only records
+    the time in a dict, and a background thread writes everything that piled up with a single
+    executemany UPDATE once every LAST_SEEN_INTERVAL seconds, so each user costs at most one write per
+    interval no matter how many pages they load.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.interval = app.config['LAST_SEEN_INTERVAL']
+        self.lock = Lock()
+        self.pending = {}
+        self.thread = None
+
+    def touch(self, user):
+        now = datetime.now(timezone.utc)
+        with self.lock:
+            self.pending[user.id] = now
+        if self.thread is None and not self.app.testing:
+            self._start()
+
+    def get(self, user):
+        # the buffered value is newer than anything in the database
+        return self.pending.get(user.id, user.last_seen)
+
+    def flush(self):
+        """Write all buffered timestamps to the database. Needs an app context."""
+        from app import db
+        from app.models import User, stale_keys
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        if not pending:
+            return 0
+        table = User.__table__
+        try:
+            db.session.execute(
+                table.update().where(table.c.id == sa.bindparam('user_id'))
+                .values(last_seen=sa.bindparam('seen')),
+                [{'user_id': id, 'seen': seen} for id, seen in pending.items()]
+            )
+            # a Core update doesn't go through the ORM events, so the cached users are marked by hand
+            stale_keys(db.session, 'user').update(pending)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            # put them back so the next flush tries again, unless a newer time came in meanwhile
+            with self.lock:
+                for id, seen in pending.items():
+                    self.pending.setdefault(id, seen)
+            raise
+        return len(pending)
+
+    def _start(self):
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.thread = Thread(target=self._run, daemon=True)
+            self.thread.start()
+        atexit.register(self._flush_in_context)
+
+    def _flush_in_context(self):
+        with self.app.app_context():
+            try:
+                self.flush()
+            except Exception:
+                self.app.logger.exception('Could not write last_seen updates')
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self._flush_in_context()
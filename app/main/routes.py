@@ -1,22 +1,25 @@
 from redis import Redis
-from flask import render_template, flash, redirect, url_for, request, g, current_app
-from app import db
+from flask import render_template, flash, redirect, url_for, request, g, current_app, Response, \
+	session, stream_with_context
+from app import db, language, timeline
+from app.pagination import InvalidCursor, KeysetPage, cursor_mode, paginate, page_urls
+from app.search import SearchUnavailable, close_cursor
 from app.main import bp
 from app.main.forms import MessageForm
-from app.translate import translate
-from app.models import User, Post, Message, Notification
+from app.notifications import subscribe as subscribe_notifications, stream as stream_notifications
+from app.translate import translate, translate_many
+from app.models import User, Post, Message, preload_authors
 from app.main.forms import EditProfileForm, EmptyForm, PostForm, SearchForm
 import sqlalchemy as sa
 from flask_login import current_user, login_required
 from datetime import datetime, timezone
 from flask_babel import _, get_locale
-from langdetect import detect, LangDetectException
 
 @bp.before_request
 def before_request():
 	if current_user.is_authenticated:
-		current_user.last_seen = datetime.now(timezone.utc)
-		db.session.commit()
+		# buffered and written in bulk every LAST_SEEN_INTERVAL seconds, see app/last_seen.py
+		current_app.last_seen.touch(current_user)
 		g.search_form = SearchForm()
 	g.locale = str(get_locale())
 
@@ -33,13 +36,12 @@ def before_request():
 def bobsanchez():
 	form = PostForm()
 	if form.validate_on_submit():
-		try:
-			language = detect(form.post.data)
-		except LangDetectException:
-			language = ''
-		post = Post(body=form.post.data, author=current_user, language=language)
+		# the language is detected later by an RQ job, see app/language.py
+		post = Post(body=form.post.data, author=current_user)
 		db.session.add(post)
 		db.session.commit()
+		timeline.push_post(post)
+		language.queue_detection([post.id])
 		flash(_('Your post is now live!')) # the _() function is used to mark something for translation
 		# when submitting data, it is good practice to redirect to the same location
 		# after a post request. This removes strange reloading behavior, since it performs a GET
@@ -47,10 +49,16 @@ def bobsanchez():
 		# and helps prevent duplicated data
 		return redirect(url_for('main.bobsanchez'))
 
-	page = request.args.get('page', 1, type=int)
-	posts = db.paginate(current_user.following_posts(), page=page, per_page=current_app.config['POSTS_PER_PAGE'], error_out=False)
-	next_url = url_for('main.bobsanchez', page=posts.next_num) if posts.has_next else None
-	prev_url = url_for('main.bobsanchez', page=posts.prev_num) if posts.has_prev else None
+	if cursor_mode():
+		# the same timeline cache, paged by (timestamp, id) cursors into the sorted set
+		posts = timeline.home_cursor_page(current_user, request.args.get('cursor') or None,
+										  current_app.config['POSTS_PER_PAGE'])
+	else:
+		page = request.args.get('page', 1, type=int)
+		# the timeline cache falls back to the following_posts() query on its own if redis can't help
+		posts = timeline.home_page(current_user, page, current_app.config['POSTS_PER_PAGE'])
+	preload_authors(posts.items)
+	next_url, prev_url = page_urls(posts, 'main.bobsanchez')
 	# templates are the actual html documents, and they must be rendered
 	# to be visible tok the user. When we direct user to a function view
 	# the view can try and load a template to provide to the user through
@@ -61,22 +69,14 @@ def bobsanchez():
 @login_required
 def user(username):
 	user = db.first_or_404(sa.select(User).where(User.username == username))
-	page = request.args.get('page', 1, type=int)
 	query = user.posts.select().order_by(Post.timestamp.desc())
-	posts = db.paginate(query, page=page, per_page=current_app.config['POSTS_PER_PAGE'], error_out=False)
-	next_url = url_for('main.user', username=user.username, page=posts.next_num) if posts.has_next else None
-	prev_url = url_for('main.user', username=user.username, page=posts.prev_num) if posts.has_prev else None
+	posts = paginate(query, (Post.timestamp, Post.id), current_app.config['POSTS_PER_PAGE'])
+	next_url, prev_url = page_urls(posts, 'main.user', username=user.username)
 	form = EmptyForm()
 
 	# Check if redis is working before providing a way for user to export posts. Then if its not, display something
-	# else to prevent a crash.
-	is_redis_active = False
-	try:
-		r = getattr(current_app, 'redis')
-		r.ping()
-		is_redis_active = True
-	except Exception:
-		is_redis_active = False
+	# else to prevent a crash. The background health checks know, so nothing is pinged here, see app/health.py
+	is_redis_active = current_app.health.is_up('redis')
 
 	return render_template('user.html', user=user, posts=posts.items, form=form,
 						   next_url=next_url, prev_url=prev_url, is_redis_active=is_redis_active)
@@ -119,6 +119,7 @@ def follow(username):
 			return redirect(url_for('main.user', username=username))
 		current_user.follow(user)
 		db.session.commit()
+		timeline.backfill(current_user, user)
 		flash(f'You are now following {username}!')
 		return redirect(url_for('main.user', username=username))
 	else:
@@ -140,6 +141,7 @@ def unfollow(username):
 			return redirect(url_for('main.user', username=username))
 		current_user.unfollow(user)
 		db.session.commit()
+		timeline.prune(current_user, user)
 		flash(f'You are not following {username}.')
 		return redirect(url_for('main.user', username=username))
 	else:
@@ -148,11 +150,12 @@ def unfollow(username):
 @bp.route('/explore')
 @login_required
 def explore():
-	page = request.args.get('page', 1, type=int)
 	query = sa.select(Post).order_by(Post.timestamp.desc())
-	posts = db.paginate(query, page=page, per_page=current_app.config['POSTS_PER_PAGE'], error_out=False)
-
-	return render_template('index.html', title='Explore', posts=posts.items)
+	posts = paginate(query, (Post.timestamp, Post.id), current_app.config['POSTS_PER_PAGE'])
+	preload_authors(posts.items)
+	next_url, prev_url = page_urls(posts, 'main.explore')
+	return render_template('index.html', title='Explore', posts=posts.items,
+						   next_url=next_url, prev_url=prev_url)
 
 @bp.route('/translate', methods=['POST'])
 @login_required
@@ -161,19 +164,48 @@ def translate_text():
 	return {'text': translate(data['text'], data['source_language'], data['dest_language'])}
 
 
+@bp.route('/translate_batch', methods=['POST'])
+@login_required
+def translate_batch():
+	# all the posts of a page at once: {'dest_language': ..., 'items': [{'text': ..., 'source_language': ...}]}
+	# gives back {'texts': [...]} in the same order, with one request to the translator per source language
+	data = request.get_json()
+	# more than any page shows, the rest is ignored
+	items = data['items'][:100]
+	by_language = {}
+	for i, item in enumerate(items):
+		by_language.setdefault(item['source_language'], []).append(i)
+	texts = [None] * len(items)
+	for source_language, indexes in by_language.items():
+		translations = translate_many([items[i]['text'] for i in indexes], source_language, data['dest_language'])
+		for i, translation in zip(indexes, translations):
+			texts[i] = translation
+	return {'texts': texts}
+
+
 @bp.route('/search')
 @login_required
 def search():
 	if not g.search_form.validate():
 		return redirect(url_for('main.explore'))
-	page = request.args.get('page', 1, type=int)
-	posts, total = Post.search(g.search_form.q.data, page,
-							   current_app.config['POSTS_PER_PAGE'])
-	next_url = url_for('main.search', q=g.search_form.q.data, page=page + 1) \
-		if total > page * current_app.config['POSTS_PER_PAGE'] else None
-	prev_url = url_for('main.search', q=g.search_form.q.data, page=page - 1) \
-		if page > 1 else None
-	return render_template('search.html', title=_('Search'), posts=posts,
+	# always cursors here, page numbers get slower the deeper they go and elasticsearch stops at 10,000
+	# results. The posts come straight from the search index, see PostHit
+	cursor = request.args.get('cursor')
+	try:
+		if not cursor:
+			# a new search, the point in time of the one before it isn't needed any more
+			close_cursor(session.pop('search_cursor', None))
+		try:
+			posts = Post.search_page(g.search_form.q.data, cursor, current_app.config['POSTS_PER_PAGE'])
+		except InvalidCursor:
+			# a cursor that was tampered with, start over
+			posts = Post.search_page(g.search_form.q.data, None, current_app.config['POSTS_PER_PAGE'])
+	except SearchUnavailable:
+		flash(_('Search is not available right now, please try again later.'))
+		posts = KeysetPage([], None, None, 0)
+	session['search_cursor'] = posts.next_cursor or posts.prev_cursor
+	next_url, prev_url = page_urls(posts, 'main.search', q=g.search_form.q.data)
+	return render_template('search.html', title=_('Search'), posts=posts.items,
 						   next_url=next_url, prev_url=prev_url)
 
 
@@ -192,8 +224,9 @@ def send_message(recipient):
 	if form.validate_on_submit():
 		msg = Message(author=current_user, recipient=user, body=form.message.data)
 		db.session.add(msg)
-		user.add_notification('unread_message_count', user.unread_message_count())
 		db.session.commit()
+		# a counter in redis goes up by one, nothing here counts the recipient's inbox
+		user.message_received()
 		flash(_('Your message has been sent.'))
 		return redirect(url_for('main.user', username=recipient))
 	return render_template('send_message.html', title=_('Send Message'),
@@ -203,41 +236,56 @@ def send_message(recipient):
 @login_required
 def messages():
 	current_user.last_message_read_time = datetime.now(timezone.utc)
-	current_user.add_notification('unread_message_count', 0)
 	db.session.commit()
-	page = request.args.get('page', 1, type=int)
+	current_user.messages_read()
 	query = current_user.messages_received.select().order_by(
 		Message.timestamp.desc()
 	)
-	messages = db.paginate(query, page=page, per_page=current_app.config['POSTS_PER_PAGE'],
-						   error_out=False)
-	next_url = url_for('main.messages', page=messages.next_num) if messages.has_next else None
-	prev_url = url_for('main.messages', page=messages.prev_num) if messages.has_prev else None
+	messages = paginate(query, (Message.timestamp, Message.id), current_app.config['POSTS_PER_PAGE'])
+	preload_authors(messages.items)
+	next_url, prev_url = page_urls(messages, 'main.messages')
 	return render_template('messages.html', messages=messages.items, next_url=next_url, prev_url=prev_url)
 
 @bp.route('/notifications')
 @login_required
 def notifications():
 	since = request.args.get('since', 0.0, type=float)
-	query = current_user.notifications.select().where(
-		Notification.timestamp > since
-	).order_by(Notification.timestamp.asc())
-	notifications = db.session.scalars(query)
-	return [
-		{
-			'name': n.name,
-			'data': n.get_data(),
-			'timestamp': n.timestamp
-		}
-		for n in notifications
-	]
+	return current_user.notifications_since(since)
+
+
+@bp.route('/notifications/stream')
+@login_required
+def notification_stream():
+	# the push version of /notifications, as Server-Sent Events. See app/notifications.py
+	if not current_app.config['NOTIFICATION_STREAM']:
+		# 204 tells EventSource to stop reconnecting, and the page polls instead
+		return '', 204
+	since = request.headers.get('Last-Event-ID', type=float) or request.args.get('since', 0.0, type=float)
+	# subscribe before reading the backlog, so nothing can slip in between the two
+	pubsub = subscribe_notifications(current_user.id)
+	if pubsub is None:
+		# 204 tells EventSource to stop reconnecting, and the page falls back to polling
+		return '', 204
+	backlog = current_user.notifications_since(since)
+	# the stream may stay open for minutes, it shouldn't hold on to a database connection all that time
+	db.session.close()
+	return Response(stream_with_context(stream_notifications(pubsub, backlog)), mimetype='text/event-stream',
+					headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 @bp.route('/export_posts')
 @login_required
 def export_posts():
-	if current_user.get_task_in_progress('export_posts'):
+	# launch_task says no if another request got there first, a double click say
+	if current_user.get_task_in_progress('export_posts') or \
+			not current_user.launch_task('export_posts', _('Exporting posts...')):
 		flash(_('An export task is currently in progress.'))
 	else:
-		current_user.launch_task('export_posts', _('Exporting posts...'))
 		db.session.commit()
-	return redirect(url_for('main.user', username=current_user.username))
\ No newline at end of file
+	return redirect(url_for('main.user', username=current_user.username))
+
+
+@bp.route('/health')
+def health():
+	# what the background checks found last, nothing is asked from here, see app/health.py. Pages still work
+	# with a backend down, so this is a 200 either way, and the status says 'degraded'
+	return current_app.health.report()
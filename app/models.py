@@ -1,12 +1,16 @@
+from contextlib import contextmanager
 from datetime import datetime, timezone, timedelta
 
-from celery.worker.consumer import Tasks
 from werkzeug.security import generate_password_hash, check_password_hash
 from typing import Optional
 from flask_login import UserMixin
 from flask import current_app, url_for
 from app import db, login
-from app.search import add_to_index, remove_from_index, query_index
+from app.search import make_document, query_index, queue_index_changes, take_index_changes, \
+    requeue_index_changes, bulk_index, rebuild_index, search_page
+from app.pagination import keyset_paginate, InvalidCursor
+from app.cache import invalidate
+from app import notifications, queues
 import sqlalchemy as sa
 import sqlalchemy.orm as so
 from hashlib import md5
@@ -14,15 +18,25 @@ from time import time
 import json
 import jwt
 import secrets
+import uuid
 import redis
 import rq
 
 # comes from the LoginManager object
 # this function is called everytime a request is made that requires
 # current_user. It then populates this information into current_user
+# The user row is cached in memory for USER_CACHE_TTL seconds, so most requests don't need the
+# database for this. Any change to a user drops it from the cache again, see invalidate_users below.
 @login.user_loader
 def load_user(id):
-    return db.session.get(User, int(id))
+    id = int(id)
+    row = current_app.user_cache.get(id)
+    if row is not None:
+        return User.from_cached_row(row)
+    user = db.session.get(User, id)
+    if user is not None:
+        current_app.user_cache.set(id, {key: getattr(user, key) for key in sa.inspect(User).column_attrs.keys()})
+    return user
 
 
 followers = sa.Table(
@@ -33,10 +47,19 @@ followers = sa.Table(
 )
 
 
+def gravatar(digest, size):
+    return f'https://www.gravatar.com/avatar/{digest}?d=identicon&s={size}'
+
+
 class PaginatedAPIMixin(object):
-    @staticmethod
-    def to_collection_dict(query, page, per_page, endpoint, **kwargs):
+    @classmethod
+    def to_collection_dict(cls, query, page, per_page, endpoint, cursor=None, with_total=False, **kwargs):
+        if cursor is None and current_app.config['CURSOR_PAGINATION']:
+            cursor = ''
+        if cursor is not None:
+            return cls.to_cursor_collection_dict(query, cursor, per_page, endpoint, with_total, **kwargs)
         resources = db.paginate(query, page=page, per_page=per_page, error_out=False)
+        cls.preload_collection(resources.items)
 
         data = {
             'items': [item.to_dict() for item in resources.items],
@@ -49,13 +72,46 @@ class PaginatedAPIMixin(object):
             '_links': {
                 'self': url_for(endpoint, page=page, per_page=per_page, **kwargs),
                 'next': url_for(endpoint, page=page + 1, per_page=per_page, **kwargs) if resources.has_next else None,
-                'next': url_for(endpoint, page=page - 1, per_page=per_page, **kwargs) if resources.has_prev else None,
+                'prev': url_for(endpoint, page=page - 1, per_page=per_page, **kwargs) if resources.has_prev else None,
+            }
+        }
+        return data
+
+    @classmethod
+    def preload_collection(cls, items):
+        # hook for models to batch load whatever their to_dict() needs for a whole page at once,
+        # instead of one query per item
+        pass
+
+    @classmethod
+    def to_cursor_collection_dict(cls, query, cursor, per_page, endpoint, with_total=False, **kwargs):
+        # same as above, but the links carry opaque cursors and counting the total is optional
+        try:
+            resources = keyset_paginate(query, (cls.id,), cursor or None, per_page,
+                                        descending=False, count=with_total)
+        except InvalidCursor:
+            resources = keyset_paginate(query, (cls.id,), None, per_page, descending=False, count=with_total)
+            cursor = ''
+        cls.preload_collection(resources.items)
+        data = {
+            'items': [item.to_dict() for item in resources.items],
+            '_meta': {
+                'per_page': per_page,
+                'total_items': resources.total
+            },
+            '_links': {
+                'self': url_for(endpoint, cursor=cursor, per_page=per_page, **kwargs),
+                'next': url_for(endpoint, cursor=resources.next_cursor, per_page=per_page, **kwargs) if resources.has_next else None,
+                'prev': url_for(endpoint, cursor=resources.prev_cursor, per_page=per_page, **kwargs) if resources.has_prev else None,
             }
         }
         return data
 
 
 class SearchableMixin(object):
+    # fields that go into the search documents without being searched, see stored_fields()
+    __stored__ = []
+
     @classmethod
     def search(cls, expression, page, per_page):
 
@@ -68,7 +124,34 @@ class SearchableMixin(object):
         query = sa.select(cls).where(cls.id.in_(ids)).order_by(
             db.case(*when, value=cls.id)
         )
-        return db.session.scalars(query), total
+        return db.session.scalars(query).all(), total
+
+    @classmethod
+    def search_page(cls, expression, cursor=None, per_page=10):
+        """Like search(), but paged with cursors, and with results made by from_document() from what the
+        search index stored instead of rows loaded from the database."""
+        page = search_page(cls.__tablename__, expression, cursor, per_page)
+        hits = {id: cls.from_document(id, document) for id, document in page.items}
+        # documents indexed before they had every stored field are made again from the database
+        missing = [id for id, hit in hits.items() if hit is None]
+        if missing:
+            for obj in db.session.scalars(cls.search_query().where(cls.id.in_(missing))):
+                hits[obj.id] = cls.from_document(obj.id, make_document(obj))
+        page.items = [hits[id] for id, _ in page.items if hits[id] is not None]
+        return page
+
+    @classmethod
+    def search_query(cls):
+        # the select that loads rows for indexing, models add loader options for what their documents need
+        return sa.select(cls)
+
+    def stored_fields(self):
+        return {field: getattr(self, field) for field in self.__stored__}
+
+    @classmethod
+    def from_document(cls, id, document):
+        """Make a search result from a stored document, or None if the document doesn't have enough for it."""
+        return None
 
     @classmethod
     def before_commit(cls, session):
@@ -80,21 +163,71 @@ class SearchableMixin(object):
 
     @classmethod
     def after_commit(cls, session):
-        for obj in session._changes['add']:
-            if isinstance(obj, SearchableMixin):
-                add_to_index(obj.__tablename__, obj)
-        for obj in session._changes['update']:
-            if isinstance(obj, SearchableMixin):
-                add_to_index(obj.__tablename__, obj)
-        for obj in session._changes['delete']:
-            if isinstance(obj, SearchableMixin):
-                remove_from_index(obj.__tablename__, obj)
-        session._changes = None
+        changes, session._changes = session._changes, None
+        if not changes or not current_app.search_backend or session.info.get('indexing_suspended'):
+            return
+        # only the ids are needed here, and the identity key has them without reloading the
+        # objects that the commit just expired
+        queued = {}
+        for op, objs in (('add', changes['add'] + changes['update']), ('delete', changes['delete'])):
+            for obj in objs:
+                if isinstance(obj, SearchableMixin):
+                    adds, deletes = queued.setdefault(type(obj), (set(), set()))
+                    (adds if op == 'add' else deletes).add(sa.inspect(obj).identity[0])
+        for model, (adds, deletes) in queued.items():
+            if not current_app.search_backend.queued or \
+                    not queue_index_changes(model.__tablename__, adds - deletes, deletes):
+                # either the backend is quick enough to do it right here, or redis is down and we have to.
+                # Search being behind is better than a failed request, or a slow one, so no retries here
+                try:
+                    # the committed session can't run queries until this hook is over, so use another one
+                    with so.Session(db.engine) as index_session:
+                        model.index_ids(adds - deletes, deletes, index_session, retries=0)
+                except Exception:
+                    current_app.logger.exception('Could not index %s changes', model.__tablename__)
+
+    @staticmethod
+    @contextmanager
+    def indexing_suspended():
+        """Don't index anything that is committed inside the with block, for bulk loads that index
+        everything they wrote in one go afterwards."""
+        db.session.info['indexing_suspended'] = True
+        try:
+            yield
+        finally:
+            db.session.info.pop('indexing_suspended', None)
+
+    @classmethod
+    def index_ids(cls, add_ids, remove_ids, session=None, retries=None):
+        """Bulk index the rows with add_ids and drop remove_ids. Returns what still failed after retries,
+        SEARCH_BULK_RETRIES of them unless retries says otherwise."""
+        add_ids = set(add_ids)
+        documents = {}
+        for obj in (session or db.session).scalars(cls.search_query().where(cls.id.in_(add_ids))) if add_ids else []:
+            documents[obj.id] = make_document(obj)
+        # rows that are gone by now were deleted after they were queued
+        remove_ids = set(remove_ids) | (add_ids - documents.keys())
+        return bulk_index(cls.__tablename__, documents, remove_ids, retries)
+
+    @classmethod
+    def process_index_queue(cls, batch_size=500):
+        """Drain the queued changes for this model into the search index. Runs inside an RQ job."""
+        add_ids, remove_ids = take_index_changes(cls.__tablename__)
+        failed_adds, failed_removes = [], []
+        for i in range(0, max(len(add_ids), len(remove_ids)), batch_size):
+            adds, removes = cls.index_ids(add_ids[i:i + batch_size], remove_ids[i:i + batch_size])
+            failed_adds += adds
+            failed_removes += removes
+        if failed_adds or failed_removes:
+            requeue_index_changes(cls.__tablename__, failed_adds, failed_removes)
+            raise RuntimeError(f'{len(failed_adds) + len(failed_removes)} {cls.__tablename__} '
+                               f'changes could not be indexed and were queued again')
 
     @classmethod
-    def reindex(cls):
-        for obj in db.session.scalars(sa.select(cls)):
-            add_to_index(cls.__tablename__, obj)
+    def reindex(cls, workers=1, chunk_size=1000, progress=None):
+        if not current_app.search_backend:
+            return
+        return rebuild_index(cls.__tablename__, workers, chunk_size, progress)
 
 
 
@@ -142,13 +275,20 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
     )
     tasks: so.WriteOnlyMapped['Task'] = so.relationship(back_populates='user')
 
+    # denormalized copies of the COUNT(*) queries below. follow/unfollow and post inserts/deletes keep
+    # them up to date in the same transaction, and `flask counters reconcile` repairs any drift.
+    post_counter: so.Mapped[int] = so.mapped_column(default=0, server_default='0')
+    follower_counter: so.Mapped[int] = so.mapped_column(default=0, server_default='0')
+    following_counter: so.Mapped[int] = so.mapped_column(default=0, server_default='0')
 
     def add_notification(self, name, data):
         db.session.execute(self.notifications.delete().where(
             Notification.name == name
         ))
-        n = Notification(name=name, payload_json=json.dumps(data), user=self)
+        n = Notification(name=name, payload_json=json.dumps(data), user=self, timestamp=time())
         db.session.add(n)
+        # published to the pages this user has open once the transaction commits
+        notifications.pending(db.session).append((self, n.to_dict()))
         return n
 
     def get_reset_password_token(self, expires_in=600):
@@ -167,6 +307,17 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
         return db.session.get(User, id)
 
 
+    @staticmethod
+    def from_cached_row(row):
+        user = User()
+        for key, value in row.items():
+            # set_committed_value makes these look like they were loaded from the database,
+            # so the session doesn't think the user has unsaved changes
+            so.attributes.set_committed_value(user, key, value)
+        so.make_transient_to_detached(user)
+        # load=False attaches the user to the session without a SELECT
+        return db.session.merge(user, load=False)
+
     def set_password(self, password):
         self.password_hash = generate_password_hash(password)
 
@@ -177,16 +328,29 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
         return '<User {}'.format(self.username)
 
     def avatar(self, size):
-        digest = md5(self.email.lower().encode('utf-8')).hexdigest()
-        return f'https://www.gravatar.com/avatar/{digest}?d=identicon&s={size}'
+        return gravatar(self.avatar_digest(), size)
+
+    def avatar_digest(self):
+        return md5(self.email.lower().encode('utf-8')).hexdigest()
 
     def follow(self, user):
         if not self.is_following(user):
             self.following.add(user)
+            self._update_follow_counters(user, 1)
 
     def unfollow(self, user):
         if self.is_following(user):
             self.following.remove(user)
+            self._update_follow_counters(user, -1)
+
+    def _update_follow_counters(self, user, delta):
+        # UPDATE ... SET x = x + 1 instead of read-modify-write, so two people following the same
+        # user at the same time can't overwrite each other's increment
+        db.session.execute(sa.update(User).where(User.id == self.id).values(
+            following_counter=User.following_counter + delta))
+        db.session.execute(sa.update(User).where(User.id == user.id).values(
+            follower_counter=User.follower_counter + delta))
+        stale_keys(db.session, 'user').update([self.id, user.id])
 
     def is_following(self, user):
         # User.id == user.id is kind of like saying where the "user" column = some specific ID
@@ -194,6 +358,10 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
         return db.session.scalar(query) is not None
 
     def followers_count(self):
+        if current_app.config['USER_COUNTERS']:
+            return self.follower_counter
+        if hasattr(self, '_preloaded_counts'):
+            return self._preloaded_counts['followers']
         # this like SELECT COUNT(*) FROM (SUBQUERY)
         query = sa.select(sa.func.count()).select_from(
             self.followers.select().subquery()
@@ -201,6 +369,10 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
         return db.session.scalar(query)
 
     def following_count(self):
+        if current_app.config['USER_COUNTERS']:
+            return self.following_counter
+        if hasattr(self, '_preloaded_counts'):
+            return self._preloaded_counts['following']
         query = sa.select(sa.func.count()).select_from(
             self.following.select().subquery()
         )
@@ -228,6 +400,34 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
         )
 
     def unread_message_count(self):
+        # a redis counter, see app/notifications.py
+        return notifications.unread_count(self.id, self.count_unread_messages)
+
+    def message_received(self):
+        """Count a new message for this user and let their pages know. Call it after the commit."""
+        self.notify('unread_message_count', notifications.add_unread(self.id, self.count_unread_messages))
+
+    def messages_read(self):
+        """Reset the unread count. Call it after last_message_read_time has been committed."""
+        notifications.clear_unread(self.id)
+        self.notify('unread_message_count', 0)
+
+    def notify(self, name, data):
+        # kept in redis and written to the database later, or straight to the database if redis is down
+        if not notifications.notify(self.id, name, data):
+            self.add_notification(name, data)
+            db.session.commit()
+
+    def notifications_since(self, since):
+        # the ones still only in redis win over older copies of the same name in the database
+        found = {}
+        query = self.notifications.select().where(Notification.timestamp > since)
+        for n in [n.to_dict() for n in db.session.scalars(query)] + notifications.recent(self.id, since):
+            if n['name'] not in found or n['timestamp'] > found[n['name']]['timestamp']:
+                found[n['name']] = n
+        return sorted(found.values(), key=lambda n: n['timestamp'])
+
+    def count_unread_messages(self):
         last_read_time = self.last_message_read_time or datetime(1900,1,1)
         query = sa.select(Message).where(Message.recipient == self, Message.timestamp > last_read_time)
         return db.session.scalar(sa.select(sa.func.count()).select_from(
@@ -235,16 +435,53 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
         ))
 
     def posts_count(self):
+        if current_app.config['USER_COUNTERS']:
+            return self.post_counter
+        if hasattr(self, '_preloaded_counts'):
+            return self._preloaded_counts['posts']
         query = sa.select(sa.func.count()).select_from(
             self.posts.select().subquery()
         )
         return db.session.scalar(query)
 
+    @staticmethod
+    def preload_counts(users):
+        """Count posts, followers and following for a list of users with a single query.
+
+        The results are kept on each user, so posts_count() and friends don't have to run their own
+        COUNT(*). There is nothing to do when the counter columns are in use.
+        """
+        if current_app.config['USER_COUNTERS'] or not users:
+            return
+        ids = [user.id for user in users]
+        query = sa.union_all(
+            sa.select(sa.literal('posts'), Post.user_id, sa.func.count())
+            .where(Post.user_id.in_(ids)).group_by(Post.user_id),
+            sa.select(sa.literal('followers'), followers.c.followed_id, sa.func.count())
+            .where(followers.c.followed_id.in_(ids)).group_by(followers.c.followed_id),
+            sa.select(sa.literal('following'), followers.c.follower_id, sa.func.count())
+            .where(followers.c.follower_id.in_(ids)).group_by(followers.c.follower_id)
+        )
+        counts = {id: {'posts': 0, 'followers': 0, 'following': 0} for id in ids}
+        for kind, id, count in db.session.execute(query):
+            counts[id][kind] = count
+        for user in users:
+            user._preloaded_counts = counts[user.id]
+
+    @classmethod
+    def preload_collection(cls, items):
+        cls.preload_counts(items)
+
+    def get_last_seen(self):
+        # last_seen updates sit in memory for a while before they reach the database
+        return current_app.last_seen.get(self)
+
     def to_dict(self, include_email=False):
+        last_seen = self.get_last_seen()
         data = {
             'id': self.id,
             'username': self.username,
-            'last_seen': self.last_seen.replace(tzinfo=timezone.utc).isoformat() if self.last_seen else None,
+            'last_seen': last_seen.replace(tzinfo=timezone.utc).isoformat() if last_seen else None,
             'about_me': self.about_me,
             'post_count': self.posts_count(),
             'follower_count': self.followers_count(),
@@ -282,21 +519,76 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
 
     @staticmethod
     def check_token(token):
+        # tokens are cached as token -> (user id, expiration). Rotating or revoking a token evicts it
+        # from every process once the change is committed, see find_stale_users below.
+        cached = current_app.token_cache.get(token)
+        if cached is not None:
+            user_id, expiration = cached
+            if expiration < datetime.now(timezone.utc):
+                return None
+            return load_user(user_id)
         user = db.session.scalar(sa.select(User).where(User.token == token))
         if user is None or user.token_expiration.replace(tzinfo=timezone.utc) < datetime.now(timezone.utc):
             return None
+        expiration = user.token_expiration.replace(tzinfo=timezone.utc)
+        current_app.token_cache.set(token, (user.id, expiration))
         return user
 
-    def launch_task(self, name, description, *args, **kwargs):
+    @classmethod
+    def reconcile_counters(cls, batch_size=1000):
+        """Recount posts, followers and following for every user, fixing the counter columns that drifted.
+
+        Works through the user table batch_size ids at a time and yields (last id, users fixed) after
+        each batch is committed.
+        """
+        last_id = 0
+        while True:
+            ids = db.session.scalars(sa.select(User.id).where(User.id > last_id).order_by(User.id)
+                                     .limit(batch_size)).all()
+            if not ids:
+                return
+            last_id = ids[-1]
+            posts = dict(db.session.execute(sa.select(Post.user_id, sa.func.count()).where(
+                Post.user_id.in_(ids)).group_by(Post.user_id)).all())
+            followers_ = dict(db.session.execute(sa.select(followers.c.followed_id, sa.func.count()).where(
+                followers.c.followed_id.in_(ids)).group_by(followers.c.followed_id)).all())
+            following = dict(db.session.execute(sa.select(followers.c.follower_id, sa.func.count()).where(
+                followers.c.follower_id.in_(ids)).group_by(followers.c.follower_id)).all())
+            fixes = []
+            for id, post_counter, follower_counter, following_counter in db.session.execute(
+                    sa.select(User.id, User.post_counter, User.follower_counter, User.following_counter)
+                    .where(User.id.in_(ids))):
+                actual = (posts.get(id, 0), followers_.get(id, 0), following.get(id, 0))
+                if actual != (post_counter, follower_counter, following_counter):
+                    fixes.append({'id': id, 'post_counter': actual[0], 'follower_counter': actual[1],
+                                  'following_counter': actual[2]})
+            if fixes:
+                db.session.execute(sa.update(User), fixes)
+                stale_keys(db.session, 'user').update(fix['id'] for fix in fixes)
+            db.session.commit()
+            yield last_id, len(fixes)
 
-        rq_job = current_app.task_queue.enqueue(f'app.tasks.{name}', self.id, *args, **kwargs)
+    def launch_task(self, name, description, *args, **kwargs):
+        """Start a background task for this user. Returns the Task, or None if one with this name is
+        already running."""
+        job_id = str(uuid.uuid4())
+        # the lock is taken before anything is enqueued, so two clicks at once can't both start one
+        if not queues.lock_task(self.id, name, job_id, current_app.config['TASK_LOCK_TIMEOUT']):
+            return None
+        try:
+            rq_job = queues.enqueue(f'app.tasks.{name}', self.id, *args, job_id=job_id, **kwargs)
+        except Exception:
+            # nothing will ever run to release it, and the user couldn't start this task for an hour
+            queues.unlock_task(self.id, name, job_id)
+            raise
         task = Task(id=rq_job.id, name=name, description=description, user=self)
         db.session.add(task)
         return task
 
     def get_tasks_in_progress(self):
+        # every page shows these, so their progress is loaded in one go, see Task.load_progress
         query = self.tasks.select().where(Task.complete == False)
-        return db.session.scalars(query)
+        return Task.load_progress(db.session.scalars(query).all())
 
     def get_task_in_progress(self, name):
         query = self.tasks.select().where(Task.name == name, Task.complete == False)
@@ -315,10 +607,76 @@ class Post(SearchableMixin, db.Model):
     last_seen: so.Mapped[Optional[datetime]] = so.mapped_column(default=lambda: datetime.now(timezone.utc))
     language: so.Mapped[Optional[str]] = so.mapped_column(sa.String(5))
     __searchable__ = ['body']
+    __stored__ = ['timestamp', 'language', 'user_id', 'username', 'avatar']
 
     def __repr__(self):
         return '<Post {}>'.format(self.body)
 
+    @classmethod
+    def search_query(cls):
+        # every document has the name and avatar of the author in it
+        return sa.select(cls).options(so.joinedload(cls.author))
+
+    def stored_fields(self):
+        return {
+            'timestamp': self.timestamp.isoformat(),
+            'language': self.language,
+            'user_id': self.user_id,
+            'username': self.author.username,
+            'avatar': self.author.avatar_digest()
+        }
+
+    @classmethod
+    def from_document(cls, id, document):
+        if any(field not in document for field in cls.__stored__):
+            return None
+        return PostHit(id, document)
+
+
+class IndexedAuthor:
+    """The author of a PostHit, with the parts of User the post templates use."""
+
+    def __init__(self, id, username, avatar_digest):
+        self.id = id
+        self.username = username
+        self.digest = avatar_digest
+
+    def avatar(self, size):
+        return gravatar(self.digest, size)
+
+    def avatar_digest(self):
+        return self.digest
+
+
+class PostHit:
+    """A post from the search results, made from its search document instead of a database row.
+
+    It has the attributes of Post that the templates use, so it renders like one.
+    """
+
+    def __init__(self, id, document):
+        self.id = id
+        self.body = document['body']
+        self.timestamp = datetime.fromisoformat(document['timestamp'])
+        self.language = document['language']
+        self.author = IndexedAuthor(document['user_id'], document['username'], document['avatar'])
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'body': self.body,
+            'timestamp': self.timestamp.replace(tzinfo=timezone.utc).isoformat(),
+            'language': self.language,
+            'author': {
+                'id': self.author.id,
+                'username': self.author.username,
+                '_links': {
+                    'self': url_for('api.get_user', id=self.author.id),
+                    'avatar': self.author.avatar(128)
+                }
+            }
+        }
+
 
 class Message(db.Model):
     id: so.Mapped[int] = so.mapped_column(primary_key=True)
@@ -351,6 +709,13 @@ class Notification(db.Model):
     def get_data(self):
         return json.loads(str(self.payload_json))
 
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'data': self.get_data(),
+            'timestamp': self.timestamp
+        }
+
 
 class Task(db.Model):
     id: so.Mapped[int] = so.mapped_column(sa.String(36), primary_key=True)
@@ -368,11 +733,112 @@ class Task(db.Model):
         return rq_job
 
     def get_progress(self):
+        if hasattr(self, '_progress'):
+            return self._progress
         job = self.get_rq_job()
         return job.meta.get('progress', 0) if job is not None else 100
 
-
-
-
+    @staticmethod
+    def load_progress(tasks):
+        """Fetch the jobs of all the tasks with one pipelined redis call, and set their progress.
+
+        A task whose job is gone, or failed or was stopped, is never going to finish, so it is marked
+        complete and left out. Returns the tasks that are still in progress. If redis is down, that is all
+        of them, with a progress of None as it is not known.
+        """
+        if not tasks:
+            return tasks
+        try:
+            jobs = rq.job.Job.fetch_many([task.id for task in tasks], connection=current_app.redis)
+        except redis.exceptions.RedisError:
+            for task in tasks:
+                task._progress = None
+            return tasks
+        in_progress, stale = [], []
+        for task, job in zip(tasks, jobs):
+            if job is None or job.get_status(refresh=False) in (
+                    rq.job.JobStatus.FAILED, rq.job.JobStatus.STOPPED, rq.job.JobStatus.CANCELED):
+                stale.append(task.id)
+                queues.unlock_task(task.user_id, task.name, task.id)
+                continue
+            task._progress = job.meta.get('progress', 0)
+            in_progress.append(task)
+        if stale:
+            # this runs while a page renders, so the update gets a connection of its own instead of
+            # committing the session in the middle of it
+            with db.engine.begin() as connection:
+                connection.execute(sa.update(Task.__table__).where(Task.id.in_(stale)).values(complete=True))
+        return in_progress
+
+
+
+
+def update_post_counters(session, flush_context):
+    # keep User.post_counter in step with the posts that were just inserted or deleted, inside the
+    # same transaction as the flush
+    deltas = {}
+    for obj in session.new:
+        if isinstance(obj, Post):
+            deltas[obj.user_id] = deltas.get(obj.user_id, 0) + 1
+    for obj in session.deleted:
+        if isinstance(obj, Post):
+            deltas[obj.user_id] = deltas.get(obj.user_id, 0) - 1
+    for user_id, delta in deltas.items():
+        if delta:
+            session.connection().execute(sa.update(User.__table__).where(User.id == user_id).values(
+                post_counter=User.__table__.c.post_counter + delta))
+            stale_keys(session, 'user').add(user_id)
+            user = session.identity_map.get(sa.inspect(User).identity_key_from_primary_key((user_id,)))
+            if user is not None:
+                session.expire(user, ['post_counter'])
+
+
+def preload_authors(items):
+    """Load the authors of a page of posts or messages with one IN query instead of one SELECT per item."""
+    items = [item for item in items if 'author' not in sa.inspect(item).dict]
+    if not items:
+        return
+    # Post.author goes through user_id, Message.author through sender_id
+    key = list(sa.inspect(type(items[0])).relationships['author'].local_columns)[0].key
+    authors = {user.id: user for user in db.session.scalars(
+        sa.select(User).where(User.id.in_({getattr(item, key) for item in items})))}
+    for item in items:
+        # set_committed_value marks the relationship as loaded, so item.author won't hit the database
+        so.attributes.set_committed_value(item, 'author', authors.get(getattr(item, key)))
+
+
+def stale_keys(session, cache):
+    # keys of the named cache (see app/cache.py) that have to go once the current transaction commits
+    return session.info.setdefault('stale_keys', {}).setdefault(cache, set())
+
+
+def find_stale_users(session, flush_context):
+    for obj in list(session.dirty) + list(session.deleted):
+        if isinstance(obj, User) and session.is_modified(obj):
+            stale_keys(session, 'user').add(obj.id)
+            # a rotated token is in the deleted history, a revoked one only has a new expiration
+            state = sa.inspect(obj)
+            tokens = set(state.attrs.token.history.deleted)
+            if state.attrs.token_expiration.history.has_changes() or obj in session.deleted:
+                tokens.add(obj.token)
+            stale_keys(session, 'token').update(token for token in tokens if token)
+
+
+def invalidate_stale_keys(session):
+    for cache, keys in session.info.pop('stale_keys', {}).items():
+        if keys:
+            invalidate(cache, *keys)
+
+
+def forget_stale_keys(session):
+    session.info.pop('stale_keys', None)
+
+
+db.event.listen(db.session, 'after_flush', update_post_counters)
+db.event.listen(db.session, 'after_flush', find_stale_users)
+db.event.listen(db.session, 'after_commit', invalidate_stale_keys)
+db.event.listen(db.session, 'after_rollback', forget_stale_keys)
+db.event.listen(db.session, 'after_commit', notifications.publish_pending)
+db.event.listen(db.session, 'after_rollback', notifications.forget_pending)
 db.event.listen(db.session, 'before_commit', SearchableMixin.before_commit)
 db.event.listen(db.session, 'after_commit', SearchableMixin.after_commit)
\ No newline at end of file
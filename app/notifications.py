@@ -0,0 +1,212 @@
+from flask import current_app
+from app import db, queues
+import json
+import time
+import redis
+import sqlalchemy as sa
+
+# notifications are also published on a redis channel per user, /notifications/stream relays it as SSE
+# frequent ones live in a redis hash per user that an RQ job copies to the database, see notify()
+
+# seconds between keep-alive comments on an idle stream
+HEARTBEAT = 15
+
+# how long the browser waits before reconnecting, in milliseconds
+RETRY = 3000
+
+
+# users whose notification hash has changes the notification table doesn't have yet
+FLUSH_KEY = 'notification-flush'
+
+# how long the scheduled flag lives, in case the job that was meant to clear it never ran
+FLUSH_TIMEOUT = 300
+
+# how long a notification hash outlives its last change, it is in the database by then
+HASH_TTL = 24 * 3600
+
+# Only count on top of a counter that exists. A missing one has to be counted from SQL first, and
+# incrementing it would start it at 1 instead.
+INCR_IF_EXISTS = """
+if redis.call('exists', KEYS[1]) == 1 then
+    return redis.call('incr', KEYS[1])
+end
+return false
+"""
+
+
+def channel(user_id):
+    return f'notifications:{user_id}'
+
+
+def _hash_key(user_id):
+    return f'notification-hash:{user_id}'
+
+
+def _unread_key(user_id):
+    return f'unread-messages:{user_id}'
+
+
+def pending(session):
+    # (user, notification) pairs to publish once the current transaction commits
+    return session.info.setdefault('notifications', [])
+
+
+def publish_pending(session):
+    notifications = session.info.pop('notifications', [])
+    if not notifications:
+        return
+    try:
+        pipe = current_app.redis.pipeline(transaction=False)
+        for user, notification in notifications:
+            # the user may be new in this transaction, the identity has its id without a refresh
+            pipe.publish(channel(sa.inspect(user).identity[0]), json.dumps(notification))
+        pipe.execute()
+    except redis.exceptions.RedisError:
+        # open pages will find them when they reconnect or poll
+        current_app.logger.warning('Could not publish %d notifications', len(notifications))
+
+
+def forget_pending(session):
+    session.info.pop('notifications', None)
+
+
+def notify(user_id, name, data):
+    """Keep a notification in redis and publish it. Returns False if redis is down, so the caller can
+    store it in the database instead."""
+    notification = json.dumps({'name': name, 'data': data, 'timestamp': time.time()})
+    try:
+        pipe = current_app.redis.pipeline()
+        pipe.hset(_hash_key(user_id), name, notification)
+        pipe.expire(_hash_key(user_id), HASH_TTL)
+        pipe.sadd(FLUSH_KEY, user_id)
+        pipe.publish(channel(user_id), notification)
+        pipe.execute()
+        queues.schedule_once(f'{FLUSH_KEY}:scheduled', FLUSH_TIMEOUT, 'app.tasks.flush_notifications')
+        return True
+    except redis.exceptions.RedisError:
+        return False
+
+
+def recent(user_id, since):
+    """The notifications in a user's hash newer than since. Empty if redis is down."""
+    try:
+        values = current_app.redis.hvals(_hash_key(user_id))
+    except redis.exceptions.RedisError:
+        return []
+    notifications = [json.loads(value) for value in values]
+    return [n for n in notifications if n['timestamp'] > since]
+
+
+def flush_pending(batch_size=500):
+    """Copy the changed notification hashes to the notification table. Runs inside an RQ job."""
+    from app.models import Notification
+    queues.clear_scheduled(f'{FLUSH_KEY}:scheduled')
+    done = 0
+    while True:
+        # if we die after the pop these only live in redis until they change again, which is where
+        # the pages read them from first anyway
+        user_ids = [int(id) for id in current_app.redis.spop(FLUSH_KEY, batch_size)]
+        if not user_ids:
+            return done
+        pipe = current_app.redis.pipeline(transaction=False)
+        for user_id in user_ids:
+            pipe.hvals(_hash_key(user_id))
+        rows = [dict(json.loads(value), user_id=user_id)
+                for user_id, values in zip(user_ids, pipe.execute()) for value in values]
+        if not rows:
+            continue
+        table = Notification.__table__
+        db.session.execute(
+            table.delete().where(table.c.user_id == sa.bindparam('notified_user'),
+                                 table.c.name == sa.bindparam('notification')),
+            [{'notified_user': row['user_id'], 'notification': row['name']} for row in rows]
+        )
+        db.session.execute(table.insert(), [
+            {'user_id': row['user_id'], 'name': row['name'], 'timestamp': row['timestamp'],
+             'payload_json': json.dumps(row['data'])} for row in rows
+        ])
+        db.session.commit()
+        done += len(rows)
+
+
+def unread_count(user_id, count):
+    """A user's unread message count. count is called to work it out from SQL when redis doesn't have it."""
+    try:
+        cached = current_app.redis.get(_unread_key(user_id))
+    except redis.exceptions.RedisError:
+        return count()
+    if cached is not None:
+        return int(cached)
+    return _set_unread(user_id, count())
+
+
+def add_unread(user_id, count):
+    """One more unread message for a user, after it has been committed. Returns the new count."""
+    try:
+        unread = current_app.redis.register_script(INCR_IF_EXISTS)(keys=[_unread_key(user_id)])
+    except redis.exceptions.RedisError:
+        return count()
+    if unread is not None:
+        return unread
+    # counted from SQL, so the new message is in there already
+    return _set_unread(user_id, count())
+
+
+def clear_unread(user_id):
+    _set_unread(user_id, 0, replace=True)
+
+
+def _set_unread(user_id, unread, replace=False):
+    try:
+        current_app.redis.set(_unread_key(user_id), unread, nx=not replace,
+                              ex=current_app.config['UNREAD_COUNT_TTL'])
+    except redis.exceptions.RedisError:
+        pass
+    return unread
+
+
+def subscribe(user_id):
+    """Start listening to a user's channel. Returns None if redis is unavailable."""
+    # pub/sub connections don't go through the circuit breaker, so ask it first
+    if not current_app.health.is_up('redis'):
+        return None
+    try:
+        pubsub = current_app.redis.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(channel(user_id))
+        return pubsub
+    except redis.exceptions.RedisError:
+        return None
+
+
+def _event(notification):
+    # the timestamp doubles as the event id, which the browser sends back as Last-Event-ID when it reconnects
+    return f"id: {notification['timestamp']}\ndata: {json.dumps(notification)}\n\n"
+
+
+def stream(pubsub, backlog):
+    """Generate the event stream: the backlog from the database first, then whatever gets published.
+
+    The stream ends after NOTIFICATION_STREAM_TIMEOUT seconds and the browser opens a new one, so a
+    connection is never held forever.
+    """
+    sent = {(n['name'], n['timestamp']) for n in backlog}
+    try:
+        yield f'retry: {RETRY}\n\n'
+        for notification in backlog:
+            yield _event(notification)
+        deadline = time.monotonic() + current_app.config['NOTIFICATION_STREAM_TIMEOUT']
+        while time.monotonic() < deadline:
+            message = pubsub.get_message(timeout=HEARTBEAT)
+            if message is None:
+                # a comment line, so proxies don't close the connection, and we notice when the page is gone
+                yield ': keep-alive\n\n'
+                continue
+            notification = json.loads(message['data'])
+            # it may have come in between subscribing and reading the backlog
+            if (notification['name'], notification['timestamp']) not in sent:
+                yield _event(notification)
+    except redis.exceptions.RedisError:
+        # the browser reconnects, and gets anything it missed from the backlog
+        pass
+    finally:
+        pubsub.close()
@@ -0,0 +1,123 @@
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from datetime import datetime
+from flask import current_app, request, url_for
+from app import db
+import sqlalchemy as sa
+import binascii
+import json
+
+# Keyset (a.k.a. cursor) pagination. Instead of OFFSET, each page remembers the sort key of its first and
+# last rows and the next query starts right after them with a WHERE clause, so the database can seek
+# straight to the page through an index no matter how deep it is. Cursors are opaque to clients, they
+# are just the key values and a direction, json encoded and base64'd.
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def _encode_value(value):
+    if isinstance(value, datetime):
+        return {'dt': value.isoformat()}
+    return value
+
+
+def _decode_value(value):
+    if isinstance(value, dict):
+        return datetime.fromisoformat(value['dt'])
+    return value
+
+
+def encode_cursor(values, direction):
+    data = json.dumps({'k': [_encode_value(v) for v in values], 'd': direction}, separators=(',', ':'))
+    return urlsafe_b64encode(data.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        data = json.loads(urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        return [_decode_value(v) for v in data['k']], data['d']
+    except (binascii.Error, ValueError, KeyError, TypeError):
+        raise InvalidCursor(cursor)
+
+
+class KeysetPage:
+    def __init__(self, items, next_cursor, prev_cursor, total=None):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+        self.has_next = next_cursor is not None
+        self.has_prev = prev_cursor is not None
+        self.total = total
+
+    def __iter__(self):
+        return iter(self.items)
+
+
+def keyset_paginate(query, keys, cursor=None, per_page=20, descending=True, count=False):
+    """Return one page of query ordered by the keys columns, starting after cursor.
+
+    The keys must be unique when taken together, which is why they always end with a primary key.
+    The order_by of the query is replaced.
+    """
+    values, direction = decode_cursor(cursor) if cursor else (None, 'next')
+    if len(keys) == 1:
+        row_key = keys[0]
+        bound = values[0] if values else None
+    else:
+        row_key = sa.tuple_(*keys)
+        bound = sa.tuple_(*values) if values else None
+    # walking backwards is the same query with the comparison and the order flipped
+    forward = (direction == 'next') == descending
+    page_query = query.order_by(None)
+    if bound is not None:
+        page_query = page_query.where(row_key < bound if forward else row_key > bound)
+    page_query = page_query.order_by(*[k.desc() if forward else k.asc() for k in keys])
+    items = db.session.scalars(page_query.limit(per_page + 1)).all()
+    more = len(items) > per_page
+    items = items[:per_page]
+    if direction == 'prev':
+        items.reverse()
+        has_next, has_prev = cursor is not None, more
+    else:
+        has_next, has_prev = more, cursor is not None
+
+    def key_of(item):
+        return [getattr(item, k.key) for k in keys]
+
+    total = None
+    if count:
+        total = db.session.scalar(sa.select(sa.func.count()).select_from(query.order_by(None).subquery()))
+    return KeysetPage(
+        items,
+        encode_cursor(key_of(items[-1]), 'next') if has_next and items else None,
+        encode_cursor(key_of(items[0]), 'prev') if has_prev and items else None,
+        total
+    )
+
+
+def cursor_mode():
+    # cursors are opt-in, either for the whole site through the config or per request with ?cursor=
+    return 'cursor' in request.args or current_app.config['CURSOR_PAGINATION']
+
+
+def paginate(query, keys, per_page, descending=True):
+    """Paginate query for the current request, with page numbers or with cursors."""
+    if cursor_mode():
+        try:
+            return keyset_paginate(query, keys, request.args.get('cursor') or None, per_page, descending)
+        except InvalidCursor:
+            return keyset_paginate(query, keys, None, per_page, descending)
+    page = request.args.get('page', 1, type=int)
+    return db.paginate(query, page=page, per_page=per_page, error_out=False)
+
+
+def page_urls(pagination, endpoint, **kwargs):
+    """Build the (next_url, prev_url) pair for a page returned by paginate()."""
+    if isinstance(pagination, KeysetPage):
+        next_url = url_for(endpoint, cursor=pagination.next_cursor, **kwargs) if pagination.has_next else None
+        prev_url = url_for(endpoint, cursor=pagination.prev_cursor, **kwargs) if pagination.has_prev else None
+    else:
+        next_url = url_for(endpoint, page=pagination.next_num, **kwargs) if pagination.has_next else None
+        prev_url = url_for(endpoint, page=pagination.prev_num, **kwargs) if pagination.has_prev else None
+    return next_url, prev_url
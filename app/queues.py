@@ -0,0 +1,110 @@
+from datetime import datetime, timezone
+from flask import current_app
+import rq
+import redis
+
+# Jobs go on one of a few named queues instead of all sharing one, so a long export can't hold up an email
+# or a search index update. TASK_QUEUES lists them from the most urgent down, with how many workers
+# `flask queues pool` runs for each one, and ROUTES says where each task goes.
+
+# anything not listed here goes on the default queue
+ROUTES = {
+    'app.tasks.send_queued_email': 'high',
+    'app.tasks.fan_out_post': 'high',
+    'app.tasks.index_search_queue': 'default',
+    'app.tasks.flush_notifications': 'default',
+    'app.tasks.detect_queued_languages': 'low',
+    'app.tasks.export_posts': 'low',
+    'app.tasks.example': 'low',
+}
+
+DEFAULT = 'default'
+
+# Release a user's task lock only if it still belongs to the job that finished. A lock that expired and
+# was taken by a newer job of the same name is left alone.
+RELEASE_LOCK = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+def parse_queues(value):
+    """'high:2,default:2,low:1' -> {'high': 2, 'default': 2, 'low': 1}, in the same order."""
+    queues = {}
+    for item in value.split(','):
+        name, _, workers = item.strip().partition(':')
+        queues[name] = int(workers or 1)
+    return queues
+
+
+def init_app(app):
+    app.task_queues = {name: rq.Queue(f'microblog-{name}', connection=app.redis)
+                       for name in parse_queues(app.config['TASK_QUEUES'])}
+
+
+def queue_for(func):
+    name = ROUTES.get(func, DEFAULT)
+    queues = current_app.task_queues
+    return queues.get(name) or queues.get(DEFAULT) or next(iter(queues.values()))
+
+
+def enqueue(func, *args, **kwargs):
+    return queue_for(func).enqueue(func, *args, **kwargs)
+
+
+def schedule_once(flag_key, ttl, task, *args, **kwargs):
+    """Enqueue a job that drains some queued work, unless one is already waiting for it.
+
+    flag_key is set while a job is waiting, and the job clears it with clear_scheduled when it starts, so
+    work queued after that gets a job of its own. The flag expires after ttl seconds in case the job never
+    runs. Returns the job, or None if one was waiting already. Redis errors are left to the caller.
+    """
+    if not current_app.redis.set(flag_key, 1, nx=True, ex=ttl):
+        return None
+    try:
+        return enqueue(task, *args, **kwargs)
+    except redis.exceptions.RedisError:
+        clear_scheduled(flag_key)
+        raise
+
+
+def clear_scheduled(flag_key):
+    current_app.redis.delete(flag_key)
+
+
+def _lock_key(user_id, name):
+    return f'task-lock:{user_id}:{name}'
+
+
+def lock_task(user_id, name, job_id, timeout):
+    """Claim the one running task called name for a user. False if it is taken, by a double click say."""
+    return bool(current_app.redis.set(_lock_key(user_id, name), job_id, nx=True, ex=timeout))
+
+
+def unlock_task(user_id, name, job_id):
+    try:
+        current_app.redis.register_script(RELEASE_LOCK)(keys=[_lock_key(user_id, name)], args=[job_id])
+    except redis.exceptions.RedisError:
+        # it expires on its own
+        pass
+
+
+def stats():
+    """How deep each queue is and how long its oldest job has waited, for scaling the workers."""
+    now = datetime.now(timezone.utc)
+    result = {}
+    for name, queue in current_app.task_queues.items():
+        oldest = queue.get_job_ids(0, 1)
+        job = rq.job.Job.fetch_many(oldest, connection=queue.connection)[0] if oldest else None
+        waited = (now - job.enqueued_at.replace(tzinfo=timezone.utc)).total_seconds() \
+            if job is not None and job.enqueued_at else 0
+        result[name] = {
+            'queued': queue.count,
+            'oldest_wait': round(waited, 3),
+            'started': queue.started_job_registry.count,
+            'failed': queue.failed_job_registry.count,
+            'workers': rq.Worker.count(queue=queue),
+        }
+    return result
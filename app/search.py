@@ -1,29 +1,626 @@
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
 from flask import current_app
+from elasticsearch import ApiError, NotFoundError, TransportError, helpers
+from multiprocessing import get_context
+from hashlib import sha1
+from uuid import uuid4
+from app import db, queues
+from app.health import CircuitOpen
+from app.pagination import InvalidCursor, KeysetPage, decode_cursor, encode_cursor
+import sqlalchemy as sa
+import json
+import time
+import redis
 
-def add_to_index(index, model):
-    if not current_app.elasticsearch:
-        return
+
+class SearchUnavailable(Exception):
+    """The search backend is down, or its circuit breaker is open."""
+    pass
+
+
+def make_document(model):
     payload = {}
     for field in model.__searchable__:
         payload[field] = getattr(model, field)
-    current_app.elasticsearch.index(index=index, id=model.id, document=payload)
+    # fields that are not searched, they are kept so results can be shown without going back to the database
+    payload.update(model.stored_fields())
+    return payload
+
+
+# the functions below hand the work to app.search_backend, picked by SEARCH_BACKEND (None when search is off)
+
+def create_search_backend(app):
+    backend = app.config['SEARCH_BACKEND']
+    if backend == 'elasticsearch' and app.elasticsearch:
+        return ElasticsearchBackend(app.elasticsearch)
+    if backend == 'sqlite':
+        from app.fts import FTSBackend
+        return FTSBackend(app.config['SEARCH_DATABASE'])
+    return None
+
+
+def add_to_index(index, model):
+    if not current_app.search_backend:
+        return
+    current_app.search_backend.add(index, model.id, make_document(model))
+    bump_generation(index)
 
 
 def remove_from_index(index, model):
-    if not current_app.elasticsearch:
+    if not current_app.search_backend:
         return
-    current_app.elasticsearch.delete(index=index, id=model.id)
+    current_app.search_backend.remove(index, model.id)
+    bump_generation(index)
+
+
+def _normalize(query):
+    return ' '.join(query.lower().split())
 
 
 def query_index(index, query, page, per_page):
-    if not current_app.elasticsearch:
+    if not current_app.search_backend:
         return [], 0
-    search = current_app.elasticsearch.search(
-        index=index,
-        query={'multi_match': {'query': query, 'fields': ['*']}},
-        from_=(page-1)*per_page,
-        size=per_page
-    )
-    print(search['hits']['hits'])
-    ids = [int(hit['_id']) for hit in search['hits']['hits']]
-    return ids, search['hits']['total']['value']
+    query = _normalize(query)
+    return tuple(cached(index, f'query\0{query}\0{page}\0{per_page}',
+                        lambda: list(current_app.search_backend.query(index, query, page, per_page))))
+
+
+def search_page(index, query, cursor=None, per_page=10):
+    """One page of (id, document) results as a KeysetPage, with cursors to the pages around it.
+
+    Instead of skipping (page - 1) * per_page results, each page continues right after the sort key of the
+    last result of the page before, so every page costs the same however deep it is. With elasticsearch
+    the cursors also carry a point in time, so results don't shift while someone is paging through them.
+    It is opened by the second page and closed by the last one. Cursors whose point in time has expired
+    carry on by position. Raises InvalidCursor for cursors that are malformed.
+    """
+    if not current_app.search_backend:
+        return KeysetPage([], None, None, 0)
+    query = _normalize(query)
+    if cursor:
+        page = _search_page(index, query, cursor, per_page)
+    else:
+        # first pages are the ones everyone asks for, so they are cached like query_index results
+        page = cached(index, f'page\0{query}\0{per_page}', lambda: _search_page(index, query, None, per_page))
+    return KeysetPage([tuple(item) for item in page['items']], page['next'], page['prev'], page['total'])
+
+
+def _search_page(index, query, cursor, per_page):
+    # a cursor is [context, position of the result it starts at, *sort key of that result]
+    context, offset, after, direction = None, 0, None, 'next'
+    if cursor:
+        values, direction = decode_cursor(cursor)
+        if len(values) < 2 or not isinstance(values[1], int) or values[1] < 0:
+            raise InvalidCursor(cursor)
+        context, offset, after = values[0], values[1], values[2:] or None
+    backend = current_app.search_backend
+    if after is not None:
+        try:
+            # walking backwards is the same search with the sort order reversed, like keyset_paginate does it
+            hits, total, context = backend.search_after(index, query, context, after, direction == 'prev',
+                                                        per_page + 1)
+        except InvalidCursor:
+            if context is None:
+                raise
+            # the point in time expired or was closed, so carry on from the same place in a new one
+            context, after = None, None
+        else:
+            more = len(hits) > per_page
+            hits = hits[:per_page]
+            if direction == 'prev':
+                hits.reverse()
+            start = offset if direction == 'next' else offset - len(hits)
+    if after is None:
+        # without a sort key to go on, the page is found by its position
+        start = offset if direction == 'next' else max(0, offset - per_page)
+        size = per_page + 1 if direction == 'next' else max(offset - start, 1)
+        hits, total, context = backend.search_after(index, query, context, None, False, size, start)
+        more = len(hits) > per_page
+        hits = hits[:per_page]
+    has_next = more if direction == 'next' else True
+    has_prev = start > 0
+    if context is not None and not has_next:
+        # the end of the results, so nothing will search this point in time again. Going back from here
+        # starts a new one
+        backend.close(context)
+        context = None
+    return {
+        'items': [[id, document] for id, document, _ in hits],
+        'next': encode_cursor([context, start + len(hits), *(hits[-1][2] or [])], 'next')
+        if has_next and hits else None,
+        'prev': encode_cursor([context, start, *(hits[0][2] or [])], 'prev') if has_prev and hits else None,
+        'total': total
+    }
+
+
+def close_cursor(cursor):
+    """Let go of whatever the backend keeps open for a walk through the results, a point in time say."""
+    if not cursor or not current_app.search_backend:
+        return
+    try:
+        values, _ = decode_cursor(cursor)
+    except InvalidCursor:
+        return
+    if values and values[0] is not None:
+        current_app.search_backend.close(values[0])
+
+
+def bulk_index(index, documents, remove_ids, retries=None):
+    """Index documents ({id: payload}) and drop remove_ids in one go.
+
+    Returns the (ids to index, ids to delete) that still failed.
+    """
+    failed = current_app.search_backend.bulk(index, documents, remove_ids, retries)
+    bump_generation(index)
+    return failed
+
+
+def rebuild_index(index, workers=4, chunk_size=1000, progress=None):
+    """Reindex every row from the database and only switch searches over once that is done.
+
+    progress, if given, is called with (rows done, rows total). Returns the name of the new index.
+    """
+    name = current_app.search_backend.rebuild(index, workers, chunk_size, progress)
+    bump_generation(index)
+    return name
+
+
+# results are cached per index generation, which every write bumps, and one request per miss asks the backend
+
+# the generation and the cached result in one round trip
+CACHED_RESULT = """
+local generation = redis.call('get', KEYS[1]) or '0'
+return {generation, redis.call('get', ARGV[1] .. generation .. ':' .. ARGV[2])}
+"""
+
+# how long a lock holder gets before the others stop waiting and ask the backend themselves
+LOCK_TIMEOUT = 5
+
+
+def _generation_key(index):
+    return f'search-generation:{index}'
+
+
+def bump_generation(index):
+    try:
+        current_app.redis.incr(_generation_key(index))
+    except redis.exceptions.RedisError:
+        current_app.logger.warning('Could not invalidate cached %s searches', index)
+
+
+def cached(index, key, compute):
+    """Return compute(), through the search cache of the index. The result has to be json serializable."""
+    ttl = current_app.config['SEARCH_CACHE_TTL']
+    if not ttl:
+        return compute()
+    prefix = f'search-cache:{index}:'
+    digest = sha1(key.encode('utf-8')).hexdigest()
+    try:
+        generation, result = current_app.redis.register_script(CACHED_RESULT)(
+            keys=[_generation_key(index)], args=[prefix, digest])
+        if result is not None:
+            return json.loads(result)
+        key = f'{prefix}{generation.decode()}:{digest}'
+        if not current_app.redis.set(f'{key}:lock', 1, nx=True, ex=LOCK_TIMEOUT):
+            # the same search is already running somewhere else
+            deadline = time.monotonic() + LOCK_TIMEOUT
+            while time.monotonic() < deadline:
+                time.sleep(0.02)
+                result = current_app.redis.get(key)
+                if result is not None:
+                    return json.loads(result)
+            return compute()
+    except redis.exceptions.RedisError:
+        return compute()
+    try:
+        result = compute()
+        pipe = current_app.redis.pipeline()
+        pipe.set(key, json.dumps(result), ex=ttl)
+        pipe.delete(f'{key}:lock')
+        pipe.execute()
+    except redis.exceptions.RedisError:
+        pass
+    except Exception:
+        # let the next request try again instead of waiting for the lock to expire
+        try:
+            current_app.redis.delete(f'{key}:lock')
+        except redis.exceptions.RedisError:
+            # it expires on its own, and the search's own error is the one to report
+            pass
+        raise
+    return result
+
+
+class SearchBackend(ABC):
+    """The methods a search backend has to provide."""
+
+    # whether changes go through the redis queue and an RQ job, instead of being written by the request
+    # that made them
+    queued = True
+
+    @abstractmethod
+    def add(self, index, id, document):
+        pass
+
+    @abstractmethod
+    def remove(self, index, id):
+        pass
+
+    @abstractmethod
+    def query(self, index, query, page, per_page):
+        """Returns the ids on the page, best match first, and the total number of matches."""
+        pass
+
+    @abstractmethod
+    def search_after(self, index, query, context, after, reverse, size, offset=0):
+        """Returns up to size (id, document, sort key) results that sort after the after key, the total
+        number of matches and the context to pass back for the next page. reverse flips the order. Without
+        an after key the results start at offset instead. The sort key may be None, when there is nothing
+        to go on but the offset."""
+        pass
+
+    def close(self, context):
+        """Called with the context of a walk through the results that is over."""
+        pass
+
+    @abstractmethod
+    def bulk(self, index, documents, remove_ids, retries=None):
+        """Returns the (ids to index, ids to delete) that still failed. retries defaults to SEARCH_BULK_RETRIES."""
+        pass
+
+    @abstractmethod
+    def rebuild(self, index, workers, chunk_size, progress):
+        pass
+
+
+def searchable_model(index):
+    from app.models import SearchableMixin
+    for model in SearchableMixin.__subclasses__():
+        if model.__tablename__ == index:
+            return model
+
+
+# changes go to a redis hash per index (id -> 'index' or 'delete') that an RQ job drains with the bulk API
+
+def _queue_key(index):
+    return f'search-queue:{index}'
+
+
+def queue_index_changes(index, add_ids, remove_ids):
+    """Record changed ids and make sure a job is on its way to index them. False if redis is unavailable."""
+    changes = {id: 'index' for id in add_ids}
+    changes.update({id: 'delete' for id in remove_ids})
+    if not changes:
+        return True
+    try:
+        current_app.redis.hset(_queue_key(index), mapping=changes)
+        queues.schedule_once(f'{_queue_key(index)}:scheduled', current_app.config['SEARCH_QUEUE_TIMEOUT'],
+                             'app.tasks.index_search_queue', index)
+    except redis.exceptions.RedisError:
+        return False
+    return True
+
+
+def take_index_changes(index):
+    """Atomically take everything queued for an index. Returns (ids to index, ids to delete)."""
+    queues.clear_scheduled(f'{_queue_key(index)}:scheduled')
+    batch_key = f'{_queue_key(index)}:{uuid4().hex}'
+    try:
+        current_app.redis.rename(_queue_key(index), batch_key)
+    except redis.exceptions.ResponseError:
+        # nothing was queued
+        return [], []
+    changes = current_app.redis.hgetall(batch_key)
+    current_app.redis.delete(batch_key)
+    add_ids = [int(id) for id, op in changes.items() if op == b'index']
+    remove_ids = [int(id) for id, op in changes.items() if op == b'delete']
+    return add_ids, remove_ids
+
+
+def requeue_index_changes(index, add_ids, remove_ids):
+    # hsetnx, so a newer change that came in while we were failing wins over the old one
+    pipe = current_app.redis.pipeline()
+    for id in add_ids:
+        pipe.hsetnx(_queue_key(index), id, 'index')
+    for id in remove_ids:
+        pipe.hsetnx(_queue_key(index), id, 'delete')
+    pipe.execute()
+
+
+# how long a point in time stays open after the last page that used it
+PIT_KEEP_ALIVE = '10m'
+
+
+class ElasticsearchBackend(SearchBackend):
+    def __init__(self, es):
+        self.es = es
+
+    @contextmanager
+    def _available(self):
+        # searches fail straight away while elasticsearch is known to be down, see app/health.py
+        try:
+            with current_app.health.breakers['elasticsearch']:
+                yield
+        except (CircuitOpen, TransportError) as e:
+            raise SearchUnavailable(str(e)) from e
+
+    def _query(self, index, query):
+        # only the searchable fields, the stored ones are there to be shown and not matched
+        return {'multi_match': {'query': query, 'fields': searchable_model(index).__searchable__}}
+
+    def add(self, index, id, document):
+        self.es.index(index=index, id=id, document=document)
+
+    def remove(self, index, id):
+        self.es.delete(index=index, id=id)
+
+    def query(self, index, query, page, per_page):
+        with self._available():
+            search = self.es.search(
+                index=index,
+                query=self._query(index, query),
+                from_=(page-1)*per_page,
+                size=per_page,
+                source=False
+            )
+        ids = [int(hit['_id']) for hit in search['hits']['hits']]
+        return ids, search['hits']['total']['value']
+
+    def search_after(self, index, query, context, after, reverse, size, offset=0):
+        with self._available():
+            if context is None and after is None and offset == 0:
+                # a first page, which is all most searches ever look at. It is cached and shared by everyone,
+                # so it gets no point in time, the next page opens one when someone asks for it
+                search = self.es.search(index=index, query=self._query(index, query), size=size)
+                hits = [(int(hit['_id']), hit['_source'], None) for hit in search['hits']['hits']]
+                return hits, search['hits']['total']['value'], None
+            pit = context or self.es.open_point_in_time(index=index, keep_alive=PIT_KEEP_ALIVE)['id']
+            # _shard_doc is the cheapest unique tie breaker there is, it only exists inside a point in time
+            sort = [{'_score': 'asc' if reverse else 'desc'}, {'_shard_doc': 'desc' if reverse else 'asc'}]
+            position = {'search_after': after} if after is not None else {'from_': offset}
+            try:
+                search = self.es.search(
+                    pit={'id': pit, 'keep_alive': PIT_KEEP_ALIVE},
+                    query=self._query(index, query),
+                    sort=sort,
+                    size=size,
+                    **position
+                )
+            except NotFoundError:
+                # the point in time has expired
+                raise InvalidCursor(pit)
+        hits = [(int(hit['_id']), hit['_source'], hit['sort']) for hit in search['hits']['hits']]
+        # elasticsearch may hand back a new id for the same point in time
+        return hits, search['hits']['total']['value'], search.get('pit_id', pit)
+
+    def close(self, context):
+        try:
+            self.es.close_point_in_time(id=context)
+        except (ApiError, TransportError):
+            # it expires on its own
+            pass
+
+    def bulk(self, index, documents, remove_ids, retries=None):
+        """Send documents and deletions to elasticsearch in one bulk request.
+
+        Failed items are retried with exponential backoff, up to SEARCH_BULK_RETRIES times, or retries.
+        Nothing is sent while the elasticsearch breaker is open, and everything is handed back as failed.
+        """
+        _record_rebuild_changes(index, list(documents) + list(remove_ids))
+        actions = [{'_op_type': 'index', '_index': index, '_id': id, '_source': doc} for id, doc in documents.items()]
+        actions += [{'_op_type': 'delete', '_index': index, '_id': id} for id in remove_ids]
+        delay = current_app.config['SEARCH_RETRY_DELAY']
+        if retries is None:
+            retries = current_app.config['SEARCH_BULK_RETRIES']
+        for attempt in range(retries + 1):
+            if attempt:
+                time.sleep(delay)
+                delay *= 2
+            try:
+                # wait_for, so the changes are searchable by the time the cached searches are invalidated
+                with current_app.health.breakers['elasticsearch']:
+                    _, errors = helpers.bulk(self.es.options(
+                        request_timeout=current_app.config['ELASTICSEARCH_BULK_TIMEOUT']),
+                        actions, raise_on_error=False, refresh='wait_for')
+            except (ApiError, TransportError, CircuitOpen):
+                current_app.logger.warning('Bulk indexing into %s failed', index, exc_info=True)
+                continue
+            failed = set()
+            for error in errors:
+                for op, result in error.items():
+                    # deleting something that was never indexed is fine
+                    if not (op == 'delete' and result.get('status') == 404):
+                        failed.add(str(result['_id']))
+            actions = [action for action in actions if str(action['_id']) in failed]
+            if not actions:
+                break
+        return ([action['_id'] for action in actions if action['_op_type'] == 'index'],
+                [action['_id'] for action in actions if action['_op_type'] == 'delete'])
+
+    def rebuild(self, index, workers, chunk_size, progress):
+        """Rebuild an index from scratch into a new versioned index and swap the alias over to it."""
+        # before anything is read, so every change from here on is replayed into the new index
+        _start_recording(index)
+        try:
+            return self._rebuild(index, workers, chunk_size, progress)
+        finally:
+            _stop_recording(index)
+
+    def _rebuild(self, index, workers, chunk_size, progress):
+        es = self.es.options(request_timeout=current_app.config['ELASTICSEARCH_BULK_TIMEOUT'])
+        model = searchable_model(index)
+        first_id, last_id, total = db.session.execute(
+            sa.select(sa.func.min(model.id), sa.func.max(model.id), sa.func.count(model.id))).one()
+        target = f'{index}-{int(time.time() * 1000)}'
+        # no refreshes and no replicas while loading, both are put back before the swap
+        es.indices.create(index=target, settings={'refresh_interval': '-1', 'number_of_replicas': 0})
+        try:
+            done = 0
+            if total:
+                # plenty of small ranges, so the work is balanced and progress can be reported as they finish
+                size = max(chunk_size, (last_id - first_id + 1) // (workers * 8) + 1)
+                jobs = [(index, target, lo, hi, chunk_size) for lo, hi in _id_ranges(first_id, last_id, size)]
+                if workers > 1:
+                    with get_context('spawn').Pool(workers, initializer=_init_reindex_worker) as pool:
+                        for count in pool.imap_unordered(_index_id_range, jobs):
+                            done += count
+                            if progress:
+                                progress(done, total)
+                else:
+                    for job in jobs:
+                        done += index_id_range(*job)
+                        if progress:
+                            progress(done, total)
+            # rows created while we were busy
+            new_last_id = db.session.scalar(sa.select(sa.func.max(model.id)))
+            if new_last_id and new_last_id > (last_id or 0):
+                done += index_id_range(index, target, (last_id or 0) + 1, new_last_id, chunk_size)
+            # rows changed since we started, which went to the old index. Most of them are caught up here, and
+            # anything that comes in before the swap is replayed once more after it
+            self._replay_changes(index, target, chunk_size)
+            es.indices.put_settings(index=target, settings={'refresh_interval': None, 'number_of_replicas': None})
+            es.indices.refresh(index=target)
+
+            actions = [{'add': {'index': target, 'alias': index}}]
+            old_indices = []
+            if es.indices.exists_alias(name=index):
+                old_indices = list(es.indices.get_alias(name=index).keys())
+                actions += [{'remove': {'index': old, 'alias': index}} for old in old_indices]
+            elif es.indices.exists(index=index):
+                # an index created before aliases were used has the name we want for the alias, it has to go
+                # in the same atomic call
+                actions.append({'remove_index': {'index': index}})
+            es.indices.update_aliases(actions=actions)
+        except Exception:
+            # a half built index is of no use to anyone, and a retry makes a new one
+            try:
+                es.indices.delete(index=target)
+            except (ApiError, TransportError):
+                current_app.logger.warning('Could not delete %s after a failed rebuild', target)
+            raise
+        # changes go to the new index through the alias from here on
+        _stop_recording(index)
+        self._replay_changes(index, index, chunk_size, after_swap=True)
+        for old in old_indices:
+            es.indices.delete(index=old)
+        return target
+
+    def _replay_changes(self, index, target, chunk_size, after_swap=False):
+        """Index the rows recorded by _record_rebuild_changes into target, as they are in the database now."""
+        ids = _take_rebuild_changes(index)
+        model = searchable_model(index)
+        for i in range(0, len(ids), chunk_size):
+            chunk = set(ids[i:i + chunk_size])
+            documents = {obj.id: make_document(obj)
+                         for obj in db.session.scalars(model.search_query().where(model.id.in_(chunk)))}
+            # rows that are gone were deleted
+            failed_adds, failed_removes = self.bulk(target, documents, chunk - documents.keys())
+            if after_swap:
+                # the alias is in place, so the incremental indexer can retry these like any others
+                queue_index_changes(index, failed_adds, failed_removes)
+            else:
+                _record_rebuild_changes(index, failed_adds + failed_removes)
+
+
+# Full elasticsearch rebuilds. Rows are streamed out of the database in id ranges by a pool of worker
+# processes and bulk loaded into a brand new index named <alias>-<timestamp>. Searches and the incremental
+# indexer keep using the alias, which still points at the old index, until the new one is complete and the
+# alias is moved over in a single atomic update_aliases call.
+#
+# A row can change after it was streamed, a post getting its language say. The incremental indexer writes
+# that to the old index, so while a rebuild runs every id it sends is also recorded in a redis set, and the
+# rebuild reindexes those rows from the database into the new index, before the swap and once more after.
+
+# how long the recording goes on if a rebuild dies without stopping it
+REBUILD_TIMEOUT = 24 * 3600
+
+RECORD_IF_REBUILDING = """
+if redis.call('exists', KEYS[1]) == 1 then
+    for i = 1, #ARGV do
+        redis.call('sadd', KEYS[2], ARGV[i])
+    end
+end
+"""
+
+
+def _rebuild_key(index):
+    return f'search-rebuild:{index}'
+
+
+def _start_recording(index):
+    try:
+        pipe = current_app.redis.pipeline()
+        pipe.delete(f'{_rebuild_key(index)}:changes')
+        pipe.set(_rebuild_key(index), 1, ex=REBUILD_TIMEOUT)
+        pipe.execute()
+    except redis.exceptions.RedisError:
+        current_app.logger.warning('Could not record the %s changes made during the rebuild, rows changed '
+                                   'while it runs may be out of date until they change again', index)
+
+
+def _stop_recording(index):
+    try:
+        current_app.redis.delete(_rebuild_key(index))
+    except redis.exceptions.RedisError:
+        pass
+
+
+def _record_rebuild_changes(index, ids):
+    if not ids:
+        return
+    try:
+        current_app.redis.register_script(RECORD_IF_REBUILDING)(
+            keys=[_rebuild_key(index), f'{_rebuild_key(index)}:changes'], args=ids)
+    except redis.exceptions.RedisError:
+        pass
+
+
+def _take_rebuild_changes(index):
+    try:
+        pipe = current_app.redis.pipeline()
+        pipe.smembers(f'{_rebuild_key(index)}:changes')
+        pipe.delete(f'{_rebuild_key(index)}:changes')
+        ids, _ = pipe.execute()
+    except redis.exceptions.RedisError:
+        return []
+    return sorted(int(id) for id in ids)
+
+_worker_app = None
+
+
+def _init_reindex_worker():
+    # each worker process gets its own app, and with it its own database and elasticsearch connections
+    global _worker_app
+    from app import create_app
+    _worker_app = create_app()
+    _worker_app.app_context().push()
+
+
+def index_id_range(index, target, first_id, last_id, chunk_size):
+    """Stream the rows with first_id <= id <= last_id into the target index. Returns how many were sent."""
+    model = searchable_model(index)
+    query = model.search_query().where(model.id >= first_id, model.id <= last_id).order_by(model.id)
+    count = 0
+
+    def actions():
+        nonlocal count
+        # yield_per fetches chunk_size rows at a time instead of loading the whole range
+        for obj in db.session.scalars(query.execution_options(yield_per=chunk_size)):
+            count += 1
+            yield {'_index': target, '_id': obj.id, '_source': make_document(obj)}
+
+    helpers.bulk(current_app.elasticsearch.options(request_timeout=current_app.config['ELASTICSEARCH_BULK_TIMEOUT']),
+                 actions(), chunk_size=chunk_size)
+    db.session.remove()
+    return count
+
+
+def _index_id_range(args):
+    return index_id_range(*args)
+
+
+def _id_ranges(first_id, last_id, size):
+    while first_id <= last_id:
+        yield first_id, min(first_id + size - 1, last_id)
+        first_id += size
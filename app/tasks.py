@@ -1,19 +1,17 @@
 import time
 import sys
-import json
-from flask import render_template
+import tempfile
+from flask import current_app, render_template
 from rq import get_current_job
-from app import create_app, db
+from app import db, export, language, notifications, queues, timeline
 from app.api.tokens import get_token
-from app.email import send_email
+from app.email import drain_outbox, send_email
 from app.models import Task, User, Post
+from app.search import searchable_model
 import sqlalchemy as sa
 
-# Another instance of this application is created here because RQ does not have access to microblog.py
-# microblog.py is what is run when flask run --debug is used.
-app = create_app()
-# This makes the "app" variable the "current_app" variable essentially.
-app.app_context().push()
+# These run in the workers started by `flask worker`, which build the app once and give every job an app
+# context of its own, see app/worker.py. Importing this module doesn't create an app.
 
 def example(seconds):
     job = get_current_job()
@@ -29,34 +27,100 @@ def example(seconds):
 
 
 def export_posts(user_id):
+    # 100% is reported when the with block ends, however it ends
+    with ProgressReporter() as progress:
+        try:
+            user = db.session.get(User, user_id)
+            progress.total = db.session.scalar(sa.select(sa.func.count()).select_from(
+                user.posts.select().subquery()))
+            # streamed to a file on disk, see app/export.py. Only the compressed file is read back
+            with tempfile.TemporaryFile() as f:
+                export.write_posts(user.id, f, progress=progress.advance)
+                f.seek(0)
+                archive = f.read()
+
+            send_email(
+                '[Microblog] Your blog posts',
+                sender=current_app.config['ADMINS'][0], recipients=[user.email],
+                text_body=render_template('email/export_posts.txt', user=user),
+                html_body=render_template('email/export_posts.html', user=user),
+                attachments=[('posts.ndjson.gz', 'application/gzip', archive)],
+                sync=True
+            )
+        except Exception:
+            current_app.logger.error('Unhandled exception', exc_info=sys.exc_info())
+
+
+def fan_out_post(post_id):
     try:
-        user = db.session.get(User, user_id)
-        _set_task_progress(0)
-        data = []
-        i = 0
-        total_posts = db.session.scalar(sa.select(sa.func.count()).select_from(
-            user.posts.select().subquery()))
-        for post in db.session.scalars(user.posts.select().order_by(
-            Post.timestamp.asc())):
-            data.append({'body': post.body,
-                         'timestamp': post.timestamp.isoformat() + 'Z'})
-            time.sleep(5)
-            i += 1
-            _set_task_progress(100 * i // total_posts)
-
-        send_email(
-            '[Microblog] Your blog posts',
-            sender=app.config['ADMINS'][0], recipients=[user.email],
-            text_body=render_template('email/export_posts.txt', user=user),
-            html_body=render_template('email/export_posts.html', user=user),
-            attachments=[('posts.json', 'application/json', json.dumps({'posts': data}, indent=4))],
-            sync=True
-        )
+        post = db.session.get(Post, post_id)
+        if post is not None:
+            timeline.fan_out(post)
     except Exception:
-        _set_task_progress(100)
-        app.logger.error('Unhandled exception', exc_info=sys.exc_info())
-    finally:
-        _set_task_progress(100)
+        current_app.logger.error('Unhandled exception', exc_info=sys.exc_info())
+
+
+def index_search_queue(index):
+    searchable_model(index).process_index_queue()
+
+
+def detect_queued_languages():
+    language.process_queue()
+
+
+def flush_notifications():
+    notifications.flush_pending()
+
+
+def send_queued_email():
+    drain_outbox()
+
+
+class ProgressReporter:
+    """Reports the progress of the current job as it works through total items.
+
+    Telling the user about every item is a job meta write and a notification each time, so progress is
+    only reported when it has moved at least step percent, or interval seconds have passed since the last
+    report. 0% is reported on the way into a with block, or else on the first advance(). Used as a context
+    manager it always reports 100% on the way out, otherwise call finish().
+    """
+
+    def __init__(self, total=0, step=5, interval=2.0, report=None):
+        self.total = total
+        self.step = step
+        self.interval = interval
+        self.report = report or _set_task_progress
+        self.done = 0
+        self.reported = None
+        self.reported_at = 0
+
+    def __enter__(self):
+        self._report(0)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.finish()
+
+    def advance(self, count=1):
+        if self.reported is None:
+            self._report(0)
+        self.done += count
+        progress = 100 * self.done // self.total if self.total else 100
+        if progress >= 100:
+            # 100% is left for finish(), after the rest of the task's work is done
+            progress = 99
+        if progress - self.reported >= self.step or \
+                (progress > self.reported and time.monotonic() - self.reported_at >= self.interval):
+            self._report(progress)
+
+    def finish(self):
+        if self.reported != 100:
+            self._report(100)
+
+    def _report(self, progress):
+        self.reported = progress
+        self.reported_at = time.monotonic()
+        self.report(progress)
 
 
 def _set_task_progress(progress):
@@ -65,8 +129,11 @@ def _set_task_progress(progress):
         job.meta['progress'] = progress
         job.save_meta()
         task = db.session.get(Task, job.get_id())
-        task.user.add_notification('task_progress', {'task_id': job.get_id(), 'progress': progress})
+        # kept in redis and written to the notification table in bulk, see app/notifications.py
+        task.user.notify('task_progress', {'task_id': job.get_id(), 'progress': progress})
 
         if progress >= 100:
             task.complete = True
-        db.session.commit()
\ No newline at end of file
+            db.session.commit()
+            # the user can start another one now
+            queues.unlock_task(task.user_id, task.name, task.id)
\ No newline at end of file
@@ -2,22 +2,47 @@ import os
 os.environ['DATABASE_URL'] = 'sqlite://'
 
 from datetime import datetime, timezone, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Event, Thread, Timer
+import base64
+import email
+import fakeredis
+import flask_mail
+import gzip
+import json
+import socket
+import tempfile
+import time
 import unittest
-from app import db, create_app
+from unittest import mock
+import redis
+import rq
+from aiosmtpd.controller import Controller
+from app import db, create_app, export, health, importer, language, queues, timeline, worker
+from app import email as outbox
 from flask import current_app
-from app.models import User, Post, followers
+from app.health import CircuitBreaker, CircuitOpen
+from app.models import SearchableMixin, User, Post, Message, Task, followers, load_user
+from app.pagination import KeysetPage, keyset_paginate
+from app.translate import translate, translate_many
+import sqlalchemy as sa
 from config import Config
 
 class TestConfig(Config):
     TESTING = True
     SQLALCHEMY_DATABASE_URI = 'sqlite://'
+    SEARCH_BACKEND = 'sqlite'
+    SEARCH_DATABASE = ':memory:'
+
+class AppCase(unittest.TestCase):
+    # the app every test case runs against, with its context pushed and an empty in-memory database
+    config = TestConfig
 
-class UserModelCase(unittest.TestCase):
     # These are always ran before each test.
     # Sets up a context/environment to run in
     # and then creates all?
     def setUp(self):
-        self.app = create_app(TestConfig)
+        self.app = create_app(self.config)
         self.app_context = self.app.app_context()
         self.app_context.push()
         db.create_all()
@@ -27,6 +52,8 @@ class UserModelCase(unittest.TestCase):
         db.drop_all()
         self.app_context.pop()
 
+
+class UserModelCase(AppCase):
     def test_password_hashing(self):
         u = User(username='susan', email='susan@example.com')
         u.set_password('cat')
@@ -103,6 +130,1059 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(f3, [p3, p4])
         self.assertEqual(f4, [p4])
 
+    def test_counters(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.add_all([Post(body='one', author=u1), Post(body='two', author=u1)])
+        u2.follow(u1)
+        db.session.commit()
+        self.assertEqual((u1.post_counter, u1.follower_counter, u1.following_counter), (2, 1, 0))
+        self.assertEqual((u2.post_counter, u2.follower_counter, u2.following_counter), (0, 0, 1))
+
+        # break the counters behind the ORM's back and let reconcile put them right
+        db.session.execute(sa.update(User).values(post_counter=7, follower_counter=0))
+        db.session.commit()
+        self.assertEqual(sum(fixed for _, fixed in User.reconcile_counters(batch_size=1)), 2)
+        self.assertEqual((u1.post_counter, u1.follower_counter), (2, 1))
+        self.assertEqual(u2.post_counter, 0)
+
+        db.session.delete(db.session.scalar(u1.posts.select().limit(1)))
+        u2.unfollow(u1)
+        db.session.commit()
+        self.assertEqual((u1.posts_count(), u1.followers_count(), u2.following_count()), (1, 0, 0))
+
+    def test_last_seen_tracker(self):
+        u = User(username='john', email='john@example.com',
+                 last_seen=datetime(2020, 1, 1, tzinfo=timezone.utc))
+        db.session.add(u)
+        db.session.commit()
+        current_app.last_seen.touch(u)
+        seen = u.get_last_seen()
+        self.assertGreater(seen.replace(tzinfo=None), datetime(2020, 1, 2))
+        self.assertEqual(u.last_seen, datetime(2020, 1, 1))
+        load_user(str(u.id))
+        self.assertEqual(current_app.last_seen.flush(), 1)
+        # the cached user has the old time, so it is dropped
+        self.assertIsNone(current_app.user_cache.get(u.id))
+        db.session.expire(u)
+        self.assertEqual(u.last_seen, seen.replace(tzinfo=None))
+        self.assertEqual(current_app.last_seen.flush(), 0)
+
+    def test_user_cache(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        cache = current_app.user_cache
+        self.assertEqual(load_user('1').username, 'john')
+        db.session.remove()
+        self.assertEqual(load_user('1').username, 'john')
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+        # a cached user is a normal persistent object, and changing it drops it from the cache
+        user = load_user('1')
+        user.username = 'susan'
+        db.session.commit()
+        self.assertIsNone(cache.get(1))
+        db.session.remove()
+        self.assertEqual(load_user('1').username, 'susan')
+
+    def test_token_cache(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        token = u.get_token()
+        db.session.commit()
+        self.assertEqual(User.check_token(token), u)
+        self.assertIsNotNone(current_app.token_cache.get(token))
+
+        u.revoke_token()
+        db.session.commit()
+        self.assertIsNone(current_app.token_cache.get(token))
+        self.assertIsNone(User.check_token(token))
+
+        # get_token() hands out a new token once the old one is revoked, and the old one stays dead
+        new_token = u.get_token()
+        db.session.commit()
+        self.assertNotEqual(new_token, token)
+        self.assertEqual(User.check_token(new_token), u)
+        self.assertIsNone(User.check_token(token))
+
+    def test_local_search(self):
+        u = User(username='john', email='john@example.com')
+        p1 = Post(body='my cat and my other cat', author=u)
+        p2 = Post(body='a cat, a dog and a parrot walk into a bar', author=u)
+        p3 = Post(body='nothing to see here', author=u)
+        db.session.add_all([u, p1, p2, p3])
+        db.session.commit()
+
+        # committed posts are indexed right away, and the better match comes first
+        self.assertEqual(Post.search('cat', 1, 10), ([p1, p2], 2))
+        self.assertEqual(Post.search('dog OR "nothing', 1, 10), ([p3, p2], 2))
+        self.assertEqual(Post.search('cat', 2, 1), ([p2], 2))
+
+        p1.body = 'no more pets'
+        db.session.delete(p2)
+        db.session.commit()
+        self.assertEqual(Post.search('cat', 1, 10), ([], 0))
+
+        Post.reindex()
+        self.assertEqual(Post.search('pets see', 1, 10), ([p1, p3], 2))
+
+    def test_elasticsearch_bulk_retries(self):
+        from elastic_transport import ConnectionError as TransportConnectionError
+        from app.search import ElasticsearchBackend
+        backend = ElasticsearchBackend(mock.Mock())
+        down = mock.patch('app.search.helpers.bulk', side_effect=TransportConnectionError('down'))
+        with down as bulk, mock.patch('app.search.time.sleep') as sleep:
+            # what a request does when it has to index by itself, it mustn't sit there backing off
+            self.assertEqual(backend.bulk('post', {1: {}}, [2], retries=0), ([1], [2]))
+            self.assertEqual((bulk.call_count, sleep.call_count), (1, 0))
+            # the RQ job does back off, until the breaker opens and nothing is sent any more
+            self.assertEqual(backend.bulk('post', {1: {}}, [2]), ([1], [2]))
+            self.assertEqual(self.app.health.breakers['elasticsearch'].state, 'open')
+            self.assertEqual((bulk.call_count, sleep.call_count), (3, 3))
+
+    def test_search_cursors(self):
+        u = User(username='john', email='john@example.com')
+        posts = [Post(body=f'cat number {i}', author=u) for i in range(5)]
+        db.session.add_all(posts)
+        db.session.commit()
+
+        # same score for all of them, so the newest comes first
+        page = Post.search_page('cat', per_page=2)
+        self.assertEqual([hit.id for hit in page.items], [5, 4])
+        self.assertEqual((page.total, page.has_prev), (5, False))
+        page = Post.search_page('cat', page.next_cursor, 2)
+        self.assertEqual([hit.id for hit in page.items], [3, 2])
+        last = Post.search_page('cat', page.next_cursor, 2)
+        self.assertEqual([hit.id for hit in last.items], [1])
+        self.assertFalse(last.has_next)
+        page = Post.search_page('cat', last.prev_cursor, 2)
+        self.assertEqual([hit.id for hit in page.items], [3, 2])
+
+        # results are made from the index, without loading the posts
+        hit = page.items[0]
+        self.assertEqual((hit.body, hit.author.username, hit.author.avatar(70)),
+                         ('cat number 2', 'john', u.avatar(70)))
+        self.assertEqual(hit.timestamp, posts[2].timestamp)
+
+    def test_language_backfill(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add_all([
+            Post(body='This is a post written in plain English about the weather today', author=u),
+            Post(body='Esta es una publicación escrita en español sobre el clima de hoy', author=u),
+            Post(body='1234 !!!', author=u),
+            Post(body='already done', author=u, language='fr'),
+        ])
+        db.session.commit()
+        self.assertEqual(language.backfill(workers=1, chunk_size=2), 3)
+        self.assertEqual(db.session.scalars(sa.select(Post.language).order_by(Post.id)).all(),
+                         ['en', 'es', '', 'fr'])
+        # the search documents were updated too
+        self.assertEqual(Post.search_page('clima').items[0].language, 'es')
+        self.assertEqual(language.backfill(workers=1), 0)
+
+    def test_notification_publish(self):
+        published = []
+
+        class RecordingRedis:
+            # just enough redis for publishing, everything else behaves as if it was down
+            def pipeline(self, transaction=True):
+                return self
+
+            def publish(self, channel, message):
+                # cache invalidations go through here too
+                if channel.startswith('notifications:'):
+                    published.append((channel, json.loads(message)))
+
+            def execute(self):
+                pass
+
+            def __getattr__(self, name):
+                raise redis.exceptions.ConnectionError()
+
+        self.app.redis = RecordingRedis()
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        u.add_notification('unread_message_count', 3)
+        self.assertEqual(published, [])
+        db.session.commit()
+        self.assertEqual(len(published), 1)
+        channel, notification = published[0]
+        self.assertEqual(channel, f'notifications:{u.id}')
+        self.assertEqual((notification['name'], notification['data']), ('unread_message_count', 3))
+
+        # nothing is published for a transaction that is rolled back
+        u.add_notification('unread_message_count', 4)
+        db.session.rollback()
+        db.session.commit()
+        self.assertEqual(len(published), 1)
+
+    def test_notification_stream_off(self):
+        u = User(username='john', email='john@example.com')
+        u.set_password('cat')
+        db.session.add(u)
+        db.session.commit()
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        client = self.app.test_client()
+        client.post('/auth/login', data={'username': 'john', 'password': 'cat'})
+        # off by default, so pages poll and no server thread is held per open page
+        self.assertIn('if (!false || !window.EventSource)', client.get('/index').get_data(as_text=True))
+        self.assertEqual(client.get('/notifications/stream').status_code, 204)
+
+    def test_unread_messages(self):
+        # without redis the counts come from SQL and the notifications go to the database
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        for i in range(3):
+            db.session.add(Message(author=u1, recipient=u2, body=f'hi {i}'))
+            db.session.commit()
+            u2.message_received()
+        self.assertEqual(u2.unread_message_count(), 3)
+        self.assertEqual([(n['name'], n['data']) for n in u2.notifications_since(0)],
+                         [('unread_message_count', 3)])
+
+        u2.last_message_read_time = datetime.now(timezone.utc) + timedelta(seconds=1)
+        db.session.commit()
+        u2.messages_read()
+        self.assertEqual(u2.unread_message_count(), 0)
+        self.assertEqual([n['data'] for n in u2.notifications_since(0)], [0])
+
+    def test_export_posts(self):
+        u = User(username='john', email='john@example.com')
+        now = datetime.now(timezone.utc)
+        db.session.add_all([Post(body=f'post {i}', author=u, timestamp=now + timedelta(seconds=i))
+                            for i in range(5)])
+        db.session.commit()
+        chunks = []
+        with tempfile.TemporaryFile() as f:
+            self.assertEqual(export.write_posts(u.id, f, chunk_size=2, progress=chunks.append), 5)
+            f.seek(0)
+            with gzip.open(f, 'rt', encoding='utf-8') as lines:
+                posts = [json.loads(line) for line in lines]
+        self.assertEqual(chunks, [2, 2, 1])
+        self.assertEqual([post['body'] for post in posts], [f'post {i}' for i in range(5)])
+        self.assertTrue(posts[0]['timestamp'].endswith('Z'))
+
+    def test_import(self):
+        u = User(username='john', email='john@example.com')
+        now = datetime.now(timezone.utc)
+        db.session.add_all([Post(body=f'exported dog {i}', author=u, timestamp=now + timedelta(seconds=i))
+                            for i in range(3)])
+        db.session.commit()
+        with tempfile.TemporaryDirectory() as tmp:
+            posts_path, users_path, follows_path = (os.path.join(tmp, name) for name in
+                                                    ('posts.ndjson.gz', 'users.csv', 'follows.csv'))
+            with open(posts_path, 'wb') as f:
+                export.write_posts(u.id, f)
+            with open(users_path, 'w') as f:
+                f.write('username,email\nsusan,susan@example.com\njohn,john@example.com\n')
+            with open(follows_path, 'w') as f:
+                f.write('follower,followed\nsusan,john\nsusan,john\nsusan,nobody\n')
+
+            self.assertEqual(importer.import_users(users_path, batch_size=1), (1, 1))
+            with SearchableMixin.indexing_suspended():
+                self.assertEqual(importer.import_posts(posts_path, 'susan', batch_size=2), (3, 0))
+            self.assertEqual(importer.import_follows(follows_path), (1, 2))
+
+        susan = db.session.scalar(sa.select(User).where(User.username == 'susan'))
+        self.assertEqual([p.body for p in db.session.scalars(susan.posts.select().order_by(Post.timestamp))],
+                         [f'exported dog {i}' for i in range(3)])
+        self.assertTrue(susan.is_following(u))
+        # nothing was indexed on the way in
+        self.assertEqual(Post.search_page('dog').total, 3)
+        self.assertEqual(importer.index_posts(3, chunk_size=2), 3)
+        self.assertEqual(Post.search_page('dog').total, 6)
+
+    def test_task_progress(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add_all([u, Task(id='running', name='export_posts', user=u),
+                            Task(id='gone', name='export_posts', user=u),
+                            Task(id='failed', name='export_posts', user=u)])
+        db.session.commit()
+
+        class FakeJob:
+            def __init__(self, status, progress):
+                self.status = status
+                self.meta = {'progress': progress}
+
+            def get_status(self, refresh=True):
+                return self.status
+
+        jobs = {'running': FakeJob(rq.job.JobStatus.STARTED, 40), 'failed': FakeJob(rq.job.JobStatus.FAILED, 10)}
+        with mock.patch('rq.job.Job.fetch_many', return_value=[jobs.get(id) for id in
+                                                               ('running', 'gone', 'failed')]) as fetch_many:
+            tasks = u.get_tasks_in_progress()
+        fetch_many.assert_called_once()
+        self.assertEqual([(task.id, task.get_progress()) for task in tasks], [('running', 40)])
+        # the ones that will never finish stop showing up
+        self.assertEqual(db.session.scalars(sa.select(Task.id).where(Task.complete == False)).all(),
+                         ['running'])
+
+        # without redis the progress is not known, but the task is still running
+        with mock.patch('rq.job.Job.fetch_many', side_effect=redis.exceptions.ConnectionError()):
+            tasks = u.get_tasks_in_progress()
+        self.assertEqual([(task.id, task.get_progress()) for task in tasks], [('running', None)])
+
+    def test_progress_reporter(self):
+        from app.tasks import ProgressReporter
+        reported = []
+        clock = [0.0]
+        with mock.patch('app.tasks.time.monotonic', lambda: clock[0]):
+            with ProgressReporter(total=200, step=10, interval=5, report=reported.append) as progress:
+                # every 10%, not every item
+                for _ in range(58):
+                    progress.advance()
+                self.assertEqual(reported, [0, 10, 20])
+                # or whatever it got to once the interval has passed
+                clock[0] = 6.0
+                progress.advance()
+                self.assertEqual(reported, [0, 10, 20, 29])
+                # the last item doesn't make it 100%, that is left for the end of the task
+                progress.advance(141)
+                self.assertEqual(reported[-1], 99)
+            self.assertEqual(reported[-1], 100)
+
+            # 100% is reported even when the task fails
+            reported.clear()
+            with self.assertRaises(ValueError):
+                with ProgressReporter(total=10, report=reported.append) as progress:
+                    progress.advance()
+                    raise ValueError()
+            self.assertEqual(reported, [0, 10, 100])
+
+            # without the with block
+            reported.clear()
+            progress = ProgressReporter(total=4, step=50, report=reported.append)
+            for _ in range(4):
+                progress.advance()
+            progress.finish()
+            self.assertEqual(reported, [0, 50, 100])
+
+    def test_worker_app_context(self):
+        class JobRunner:
+            def perform_job(self, job, queue):
+                return current_app._get_current_object(), db.session()
+
+        class Worker(worker.AppContextMixin, JobRunner):
+            pass
+
+        app, session = Worker(app=self.app).perform_job(None, None)
+        self.assertIs(app, self.app)
+        # every job gets a session of its own, and it is gone once the job ends
+        self.assertIsNot(session, db.session())
+
+    def test_circuit_breaker(self):
+        breaker = CircuitBreaker('backend', (OSError,), threshold=2, reset_timeout=0.05)
+
+        def call(error=None):
+            with breaker:
+                if error:
+                    raise error
+
+        self.assertRaises(OSError, call, OSError())
+        # the backend answered, even if it was with an error
+        self.assertRaises(ValueError, call, ValueError())
+        self.assertEqual(breaker.state, 'closed')
+        self.assertRaises(OSError, call, OSError())
+        self.assertRaises(OSError, call, OSError())
+        self.assertEqual(breaker.state, 'open')
+        self.assertRaises(CircuitOpen, call)
+
+        time.sleep(0.05)
+        self.assertEqual(breaker.state, 'half-open')
+        # one call gets through to try again, and it failing opens the breaker for another while
+        self.assertRaises(OSError, call, OSError())
+        self.assertRaises(CircuitOpen, call)
+        time.sleep(0.05)
+        call()
+        self.assertEqual(breaker.state, 'closed')
+
+    def test_health(self):
+        u = User(username='john', email='john@example.com')
+        u.set_password('cat')
+        db.session.add(u)
+        db.session.commit()
+        # nothing is listening here
+        self.app.redis.connection_pool.connection_kwargs['port'] = free_port()
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        client = self.app.test_client()
+        client.post('/auth/login', data={'username': 'john', 'password': 'cat'})
+
+        # nothing is known until the first check
+        self.assertEqual(client.get('/health').get_json()['checks']['redis']['status'], 'unknown')
+        self.assertEqual(self.app.health.check_all()['redis'], False)
+        with mock.patch.object(redis.Redis, 'ping') as ping:
+            page = client.get('/user/john').get_data(as_text=True)
+        # the page knew redis was down without asking it
+        ping.assert_not_called()
+        self.assertIn('Post exports are currently unavailable', page)
+
+        report = client.get('/health').get_json()
+        self.assertEqual(report['status'], 'degraded')
+        self.assertEqual(report['checks']['redis']['status'], 'down')
+        self.assertEqual(report['checks']['elasticsearch'], {'status': 'disabled'})
+        # MAIL_SERVER is only the localhost default here, so there is no mail server to check
+        self.assertEqual(report['checks']['smtp'], {'status': 'disabled'})
+        # the error says where redis is, and this needs no login
+        self.assertNotIn('error', report['checks']['redis'])
+        # redis commands fail straight away now, and everything that copes with redis being down still does
+        with mock.patch('redis.connection.Connection.connect') as connect:
+            self.assertEqual(u.unread_message_count(), 0)
+        connect.assert_not_called()
+
+    def test_post_html_cache(self):
+        u = User(username='john', email='john@example.com')
+        u.set_password('cat')
+        db.session.add_all([u, Post(body='first', author=u), Post(body='second', author=u)])
+        db.session.commit()
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        client = self.app.test_client()
+        client.post('/auth/login', data={'username': 'john', 'password': 'cat'})
+        cache = self.app.post_html_cache
+
+        page = client.get('/explore').get_data(as_text=True)
+        self.assertEqual((cache.stats()['hits'], cache.stats()['misses']), (0, 2))
+        # no language detected yet, which the translate all script has to see as no language at all
+        self.assertIn('data-language=""', page)
+        self.assertNotIn('data-language="None"', page)
+        self.assertEqual(client.get('/explore').get_data(as_text=True), page)
+        self.assertEqual(cache.stats()['hits'], 2)
+
+        # the username is in the key, so the new one shows up everywhere at once
+        client.post('/edit_profile', data={'username': 'johnny', 'about_me': ''})
+        page = client.get('/explore').get_data(as_text=True)
+        self.assertIn('>johnny</a>', page)
+        self.assertNotIn('>john</a>', page)
+        # and the avatar, which comes from the email
+        old_avatar = u.avatar_digest()
+        u.email = 'johnny@example.com'
+        db.session.commit()
+        page = client.get('/explore').get_data(as_text=True)
+        self.assertIn(u.avatar_digest(), page)
+        self.assertNotIn(old_avatar, page)
+        # and so is the language, which is only known once detection has run
+        db.session.execute(sa.update(Post).values(language='es'))
+        db.session.commit()
+        self.assertIn('data-language="es"', client.get('/explore').get_data(as_text=True))
+
+    def test_keyset_pagination(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        # a few posts share a timestamp, so the id has to break the tie
+        now = datetime.now(timezone.utc)
+        posts = [Post(body=f'post {i}', author=u, timestamp=now + timedelta(seconds=i // 2))
+                 for i in range(7)]
+        db.session.add_all(posts)
+        db.session.commit()
+        query = sa.select(Post).order_by(Post.timestamp.desc())
+        newest_first = db.session.scalars(query.order_by(Post.id.desc())).all()
+
+        # walk forward to the end, then back to the start
+        seen = []
+        page = keyset_paginate(query, (Post.timestamp, Post.id), per_page=3, count=True)
+        self.assertEqual(page.total, 7)
+        self.assertFalse(page.has_prev)
+        pages = [page]
+        while page.has_next:
+            page = keyset_paginate(query, (Post.timestamp, Post.id), page.next_cursor, per_page=3)
+            pages.append(page)
+        for p in pages:
+            seen.extend(p.items)
+        self.assertEqual(seen, newest_first)
+        self.assertEqual(len(pages), 3)
+
+        page = keyset_paginate(query, (Post.timestamp, Post.id), pages[-1].prev_cursor, per_page=3)
+        self.assertEqual(page.items, pages[1].items)
+        page = keyset_paginate(query, (Post.timestamp, Post.id), page.prev_cursor, per_page=3)
+        self.assertEqual(page.items, pages[0].items)
+        self.assertFalse(page.has_prev)
+        self.assertTrue(page.has_next)
+
+
+class QueryCountCase(AppCase):
+    # the number of SQL statements a page costs should not depend on how many items are on it
+    def setUp(self):
+        super().setUp()
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        users = [User(username=f'user{i}', email=f'user{i}@example.com') for i in range(60)]
+        users[0].set_password('cat')
+        db.session.add_all(users)
+        db.session.add_all([Post(body=f'post {i}', author=users[i]) for i in range(60)])
+        for user in users[1:]:
+            users[0].follow(user)
+        db.session.commit()
+        self.client = self.app.test_client()
+
+    def count_queries(self, *args, **kwargs):
+        statements = []
+
+        def count(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        sa.event.listen(db.engine, 'before_cursor_execute', count)
+        try:
+            response = self.client.get(*args, **kwargs)
+        finally:
+            sa.event.remove(db.engine, 'before_cursor_execute', count)
+        self.assertEqual(response.status_code, 200)
+        return len(statements)
+
+    def test_api_collection_queries(self):
+        token = self.client.post('/api/tokens', auth=('user0', 'cat')).get_json()['token']
+        headers = {'Authorization': f'Bearer {token}'}
+        # the first request puts the token in the token cache
+        self.assertEqual(self.count_queries('/api/users?per_page=5', headers=headers), 3)
+        for counters, expected in ((True, 2), (False, 3)):
+            self.app.config['USER_COUNTERS'] = counters
+            # page and total, plus one GROUP BY for the counts when the columns are off
+            self.assertEqual(self.count_queries('/api/users?per_page=5', headers=headers), expected)
+            self.assertEqual(self.count_queries('/api/users?per_page=50', headers=headers), expected)
+            # user 1 is already in the session from the token lookup, so get_or_404 costs nothing here
+            self.assertEqual(self.count_queries('/api/users/1/following?per_page=50', headers=headers),
+                             expected)
+
+    def test_post_list_queries(self):
+        self.client.post('/auth/login', data={'username': 'user0', 'password': 'cat'})
+        self.app.config['POSTS_PER_PAGE'] = 5
+        few = self.count_queries('/explore')
+        self.app.config['POSTS_PER_PAGE'] = 50
+        self.assertEqual(self.count_queries('/explore'), few)
+        # page, total, authors, unread messages and tasks. The logged in user is still in the session
+        # from the previous request, and last_seen no longer writes anything during the request.
+        self.assertEqual(few, 5)
+
+
+class RedisCase(AppCase):
+    # the parts that only do anything with redis up, against an in-memory fake of it
+    def setUp(self):
+        super().setUp()
+        self.app.redis = fakeredis.FakeRedis()
+        # the queues were made with the real client
+        queues.init_app(self.app)
+        now = datetime.now(timezone.utc)
+        self.users = [User(username=f'user{i}', email=f'user{i}@example.com') for i in range(4)]
+        db.session.add_all(self.users)
+        db.session.add_all([Post(body=f'post {i}', author=self.users[i % 3],
+                                 timestamp=now + timedelta(seconds=i)) for i in range(6)])
+        db.session.commit()
+
+    def home(self, user, page=1, per_page=10):
+        return [post.body for post in timeline.home_page(user, page, per_page)]
+
+    def test_timeline_fan_out(self):
+        u0, u1, u2, u3 = self.users
+        u0.follow(u1)
+        u3.follow(u1)
+        db.session.commit()
+        # the first read builds it from SQL
+        self.assertEqual(self.home(u0), ['post 4', 'post 3', 'post 1', 'post 0'])
+        self.assertEqual(self.app.redis.zcard('timeline:1'), 5)
+
+        post = Post(body='post 6', author=u1, timestamp=datetime.now(timezone.utc) + timedelta(seconds=10))
+        db.session.add(post)
+        db.session.commit()
+        timeline.push_post(post)
+        # the followers get it from a job
+        self.assertEqual([job.func_name for job in self.app.task_queues['high'].jobs], ['app.tasks.fan_out_post'])
+        timeline.fan_out(post)
+        self.assertEqual(self.home(u0)[0], 'post 6')
+        # u3 has never been home, so nothing half built is left for them
+        self.assertFalse(self.app.redis.exists('timeline:4'))
+        self.assertEqual(self.home(u3), ['post 6', 'post 4', 'post 1'])
+
+        # pushes and reads both keep a timeline from expiring
+        self.app.redis.expire('timeline:1', 10)
+        timeline.fan_out(post)
+        self.assertGreater(self.app.redis.ttl('timeline:1'), 10)
+        self.app.redis.expire('timeline:1', 10)
+        self.home(u0)
+        self.assertGreater(self.app.redis.ttl('timeline:1'), 10)
+
+    def test_timeline_follow(self):
+        u0, u1, u2, u3 = self.users
+        self.assertEqual(self.home(u0), ['post 3', 'post 0'])
+        u0.follow(u2)
+        db.session.commit()
+        timeline.backfill(u0, u2)
+        self.assertEqual(self.home(u0), ['post 5', 'post 3', 'post 2', 'post 0'])
+        u0.unfollow(u2)
+        db.session.commit()
+        timeline.prune(u0, u2)
+        self.assertEqual(self.home(u0), ['post 3', 'post 0'])
+
+        # a timeline with nothing in it but the sentinel
+        self.assertEqual(self.home(u3), [])
+        u3.follow(u3)
+        u3.unfollow(u3)
+        db.session.commit()
+        timeline.prune(u3, u3)
+        self.assertEqual(self.home(u3), [])
+
+        # a cold one is built again on the next read
+        self.app.redis.delete('timeline:1')
+        self.assertEqual(self.home(u0), ['post 3', 'post 0'])
+        self.assertTrue(self.app.redis.exists('timeline:1'))
+
+    def test_timeline_fallback(self):
+        u0, u1, u2, u3 = self.users
+        u0.follow(u1)
+        u0.follow(u2)
+        db.session.commit()
+        self.app.config['TIMELINE_LENGTH'] = 3
+        page = timeline.home_page(u0, 1, 2)
+        self.assertIsInstance(page, timeline.TimelinePage)
+        self.assertEqual([post.body for post in page], ['post 5', 'post 4'])
+        self.assertTrue(page.has_next)
+        # the second page needs more than the 3 ids that are cached, so it comes from SQL
+        page = timeline.home_page(u0, 2, 2)
+        self.assertNotIsInstance(page, timeline.TimelinePage)
+        self.assertEqual([post.body for post in page], ['post 3', 'post 2'])
+        self.assertEqual(self.home(u0, 3, 2), ['post 1', 'post 0'])
+
+    def test_timeline_cursors(self):
+        u0, u1, u2, u3 = self.users
+        u0.follow(u1)
+        u0.follow(u2)
+        # pairs of posts with the same timestamp, and ids on both sides of 9 and 10, which redis puts in the
+        # wrong order when the scores are the same
+        now = datetime.now(timezone.utc)
+        db.session.add_all([Post(body=f'post {i}', author=self.users[1 + i % 2],
+                                 timestamp=now + timedelta(seconds=10 + i // 2)) for i in range(6, 14)])
+        db.session.commit()
+        query = u0.following_posts()
+        keys = (Post.timestamp, Post.id)
+
+        def walk(get_page):
+            pages = [get_page(None, 'next')]
+            while pages[-1].has_next:
+                pages.append(get_page(pages[-1].next_cursor, 'next'))
+            back = [get_page(pages[-1].prev_cursor, 'prev')]
+            while back[-1].has_prev:
+                back.append(get_page(back[-1].prev_cursor, 'prev'))
+            return [[post.id for post in page] for page in pages], [[post.id for post in page] for page in back]
+
+        expected = walk(lambda cursor, _: keyset_paginate(query, keys, cursor, per_page=3))
+        self.assertEqual(len(expected[0]), 5)
+        self.assertEqual(walk(lambda cursor, _: timeline.home_cursor_page(u0, cursor, 3)), expected)
+        self.assertIsInstance(timeline.home_cursor_page(u0, None, 3), KeysetPage)
+        # the cursors are the same as the SQL ones, so a capped timeline carries on in SQL where it ends
+        self.app.redis.delete('timeline:1')
+        self.app.config['TIMELINE_LENGTH'] = 5
+        self.assertEqual(walk(lambda cursor, _: timeline.home_cursor_page(u0, cursor, 3)), expected)
+        self.assertEqual(timeline.home_cursor_page(u0, 'not a cursor', 3).items,
+                         timeline.home_cursor_page(u0, None, 3).items)
+
+    def test_search_cache(self):
+        from app import search
+        backend = self.app.search_backend
+        with mock.patch.object(backend, 'query', wraps=backend.query) as query:
+            first = search.query_index('post', 'Post  0', 1, 10)
+            self.assertEqual(search.query_index('post', 'post 0', 1, 10), first)
+            self.assertEqual(query.call_count, 1)
+            # a write moves the index on to a new generation, and the cached result is not used any more
+            post = Post(body='post 0 again', author=self.users[0])
+            db.session.add(post)
+            db.session.commit()
+            search.add_to_index('post', post)
+            self.assertEqual(search.query_index('post', 'post 0', 1, 10)[1], first[1] + 1)
+            self.assertEqual(query.call_count, 2)
+
+    def test_search_cache_single_flight(self):
+        from app import search
+        started, finish = Event(), Event()
+
+        def slow():
+            started.set()
+            finish.wait(5)
+            return 'from the first caller'
+
+        def first_caller():
+            with self.app.app_context():
+                search.cached('post', 'dog', slow)
+
+        thread = Thread(target=first_caller)
+        thread.start()
+        started.wait(5)
+        # the second caller waits for the one holding the lock instead of asking the backend too
+        Timer(0.1, finish.set).start()
+        self.assertEqual(search.cached('post', 'dog', mock.Mock(side_effect=AssertionError)), 'from the first caller')
+        thread.join()
+
+        # a failed search lets go of the lock, so the next caller doesn't wait for it
+        with self.assertRaises(ValueError):
+            search.cached('post', 'cat', mock.Mock(side_effect=ValueError))
+        start = time.monotonic()
+        self.assertEqual(search.cached('post', 'cat', lambda: 'cat'), 'cat')
+        self.assertLess(time.monotonic() - start, 1)
+        # and its own error is the one raised, even when redis fails too
+        with mock.patch.object(self.app.redis, 'delete', side_effect=redis.exceptions.ConnectionError()):
+            with self.assertRaises(ValueError):
+                search.cached('post', 'cow', mock.Mock(side_effect=ValueError))
+
+    def test_search_point_in_time(self):
+        from elasticsearch import NotFoundError
+        from app import search
+        es = mock.Mock()
+        es.open_point_in_time.return_value = {'id': 'pit'}
+        ids = [5, 4, 3, 2, 1]
+
+        def es_search(query, size, pit=None, sort=None, search_after=None, from_=0, index=None):
+            if pit is None:
+                hits = [{'_id': str(id), '_source': {'body': f'cat {id}'}} for id in ids[:size]]
+                return {'hits': {'hits': hits, 'total': {'value': len(ids)}}}
+            order = list(enumerate(ids))
+            if sort[0]['_score'] == 'asc':
+                order.reverse()
+            if search_after is not None:
+                from_ = [position for position, _ in order].index(search_after[1]) + 1
+            hits = [{'_id': str(id), '_source': {'body': f'cat {id}'}, 'sort': [1.0, position]}
+                    for position, id in order[from_:from_ + size]]
+            return {'hits': {'hits': hits, 'total': {'value': len(ids)}}}
+
+        es.search.side_effect = es_search
+        self.app.search_backend = search.ElasticsearchBackend(es)
+
+        # the first page opens no point in time, so there is none in the cache either
+        first = search.search_page('post', 'cat', None, 2)
+        self.assertEqual([id for id, _ in first.items], [5, 4])
+        self.assertEqual(search.search_page('post', 'cat', None, 2).next_cursor, first.next_cursor)
+        es.open_point_in_time.assert_not_called()
+        self.assertFalse([key for key in self.app.redis.keys() if b'pit' in self.app.redis.get(key)])
+
+        page = search.search_page('post', 'cat', first.next_cursor, 2)
+        self.assertEqual([id for id, _ in page.items], [3, 2])
+        self.assertEqual(es.open_point_in_time.call_count, 1)
+        last = search.search_page('post', 'cat', page.next_cursor, 2)
+        self.assertEqual([id for id, _ in last.items], [1])
+        # the last page closes it, and going back from there starts over by position
+        es.close_point_in_time.assert_called_once_with(id='pit')
+        page = search.search_page('post', 'cat', last.prev_cursor, 2)
+        self.assertEqual([id for id, _ in page.items], [3, 2])
+        self.assertEqual(search.search_page('post', 'cat', page.prev_cursor, 2).items, first.items)
+
+        # an expired point in time carries on where it was
+        def expired(**kwargs):
+            if kwargs.get('search_after'):
+                raise NotFoundError('gone', mock.Mock(), None)
+            return es_search(**kwargs)
+
+        es.search.side_effect = expired
+        page = search.search_page('post', 'cat', page.next_cursor, 2)
+        self.assertEqual([id for id, _ in page.items], [1])
+        self.assertEqual(es.close_point_in_time.call_count, 2)
+
+        # and a new search lets go of the point in time of the one before
+        search.close_cursor(search.search_page('post', 'cat', first.next_cursor, 2).next_cursor)
+        self.assertEqual(es.close_point_in_time.call_count, 3)
+
+    def test_rebuild_replays_changes(self):
+        from elasticsearch.helpers import BulkIndexError
+        from app.search import ElasticsearchBackend, make_document
+        es = mock.Mock()
+        es.options.return_value = es
+        es.indices.get_alias.return_value = {'post-old': {}}
+        backend = ElasticsearchBackend(es)
+        sent = []
+
+        def bulk(client, actions, **kwargs):
+            actions = list(actions)
+            sent.extend(actions)
+            return len(actions), []
+
+        posts = db.session.scalars(sa.select(Post).order_by(Post.id)).all()
+
+        def stream(index, target, first_id, last_id, chunk_size):
+            # the rows are streamed, and then the language detection job and a delete get to them. Both go
+            # to the old index through the alias
+            posts[0].language = 'es'
+            db.session.delete(posts[1])
+            db.session.commit()
+            backend.bulk('post', {posts[0].id: make_document(posts[0])}, [posts[1].id])
+            return last_id - first_id + 1
+
+        def before_swap(**kwargs):
+            # and another one after the first catch up
+            posts[2].language = 'fr'
+            db.session.commit()
+            backend.bulk('post', {posts[2].id: make_document(posts[2])}, [])
+
+        es.indices.put_settings.side_effect = before_swap
+        with mock.patch('app.search.helpers.bulk', bulk), mock.patch('app.search.index_id_range', stream):
+            target = backend.rebuild('post', 1, 100, None)
+        into_target = {(action['_id'], action['_op_type'], action.get('_source', {}).get('language'))
+                       for action in sent if action['_index'] == target}
+        self.assertEqual(into_target, {(posts[0].id, 'index', 'es'), (posts[1].id, 'delete', None)})
+        # the last one is sent again after the swap, when the alias is the new index
+        to_alias = [(action['_id'], action['_source']['language']) for action in sent
+                    if action['_index'] == 'post' and action['_op_type'] == 'index']
+        self.assertEqual(to_alias[-2:], [(posts[2].id, 'fr'), (posts[2].id, 'fr')])
+        es.indices.update_aliases.assert_called_once()
+        self.assertEqual(self.app.redis.keys('search-rebuild:*'), [])
+
+        # a rebuild that fails part way deletes the index it was building and leaves the alias alone
+        es.reset_mock()
+        failed = mock.patch('app.search.index_id_range', side_effect=BulkIndexError('1 document(s) failed', []))
+        with mock.patch('app.search.helpers.bulk', bulk), failed, self.assertRaises(BulkIndexError):
+            backend.rebuild('post', 1, 100, None)
+        target = es.indices.create.call_args.kwargs['index']
+        es.indices.delete.assert_called_once_with(index=target)
+        es.indices.update_aliases.assert_not_called()
+        self.assertEqual(self.app.redis.keys('search-rebuild:*'), [])
+
+    def test_task_queues(self):
+        u = self.users[0]
+        self.assertEqual(queues.queue_for('app.tasks.fan_out_post').name, 'microblog-high')
+        self.assertEqual(queues.queue_for('app.tasks.export_posts').name, 'microblog-low')
+        self.assertEqual(queues.queue_for('app.tasks.not_routed').name, 'microblog-default')
+
+        task = u.launch_task('export_posts', 'Exporting posts...')
+        self.assertEqual(self.app.task_queues['low'].job_ids, [task.id])
+        # a double click gets nothing, and nothing more is queued
+        self.assertIsNone(u.launch_task('export_posts', 'Exporting posts...'))
+        self.assertEqual(self.app.task_queues['low'].count, 1)
+        stats = queues.stats()
+        self.assertEqual((stats['low']['queued'], stats['high']['queued']), (1, 0))
+        self.assertGreaterEqual(stats['low']['oldest_wait'], 0)
+
+        # only the job holding the lock can release it
+        queues.unlock_task(u.id, 'export_posts', 'some other job')
+        self.assertIsNone(u.launch_task('export_posts', 'Exporting posts...'))
+        queues.unlock_task(u.id, 'export_posts', task.id)
+        self.assertIsNotNone(u.launch_task('export_posts', 'Exporting posts...'))
+
+        # a lock is not left behind when the job never made it onto the queue
+        with mock.patch('app.queues.enqueue', side_effect=redis.exceptions.ConnectionError()):
+            with self.assertRaises(redis.exceptions.ConnectionError):
+                self.users[1].launch_task('export_posts', 'Exporting posts...')
+        self.assertIsNotNone(self.users[1].launch_task('export_posts', 'Exporting posts...'))
+
+    def test_shared_health_checks(self):
+        import requests
+        self.app.config['MS_TRANSLATOR_KEY'] = 'key'
+        # the monitor of another process
+        other = health.HealthMonitor(self.app)
+        translator = mock.Mock(side_effect=requests.ConnectionError('down'))
+        with mock.patch.dict(health.CHECKS, translator=(translator, (requests.RequestException,), CircuitOpen)):
+            self.app.health.run_checks()
+            other.run_checks()
+        # one check between them, and both know the translator is down
+        translator.assert_called_once()
+        self.assertEqual(other.report()['checks']['translator']['status'], 'down')
+        self.assertEqual(other.breakers['translator'].state, 'open')
+        # redis is checked by each of them
+        self.assertEqual(other.report()['checks']['redis']['status'], 'up')
+
+    def test_schedule_once(self):
+        queue = self.app.task_queues['low']
+        first = queues.schedule_once('export:scheduled', 60, 'app.tasks.export_posts', 1)
+        # a job is waiting already
+        self.assertIsNone(queues.schedule_once('export:scheduled', 60, 'app.tasks.export_posts', 1))
+        self.assertEqual(queue.job_ids, [first.id])
+        # and once it has started, new work needs a job of its own
+        queues.clear_scheduled('export:scheduled')
+        second = queues.schedule_once('export:scheduled', 60, 'app.tasks.export_posts', 1)
+        self.assertEqual(queue.job_ids, [first.id, second.id])
+        self.assertLessEqual(self.app.redis.ttl('export:scheduled'), 60)
+
+        # a job that could not be enqueued leaves no flag behind
+        queues.clear_scheduled('export:scheduled')
+        with mock.patch('app.queues.enqueue', side_effect=redis.exceptions.ConnectionError()):
+            with self.assertRaises(redis.exceptions.ConnectionError):
+                queues.schedule_once('export:scheduled', 60, 'app.tasks.export_posts', 1)
+        self.assertFalse(self.app.redis.exists('export:scheduled'))
+
+    def test_queue_stats_redis_down(self):
+        self.users[0].set_password('cat')
+        db.session.commit()
+        client = self.app.test_client()
+        token = client.post('/api/tokens', auth=('user0', 'cat')).get_json()['token']
+        self.app.redis = redis.Redis(port=free_port(), socket_connect_timeout=1)
+        queues.init_app(self.app)
+        response = client.get('/api/stats/queues', headers={'Authorization': f'Bearer {token}'})
+        self.assertEqual(response.status_code, 503)
+
+
+class TranslatorStub(BaseHTTPRequestHandler):
+    # answers like the translator does, with the text in upper case, and remembers what it was asked.
+    # Set status to something else to make it fail
+    requests = []
+    status = 200
+
+    def do_GET(self):
+        # the list of languages the health check asks for
+        self.send_response(TranslatorStub.status)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'{}')
+
+    def do_POST(self):
+        texts = [item['text'] for item in json.loads(self.rfile.read(int(self.headers['Content-Length'])))]
+        TranslatorStub.requests.append(texts)
+        if TranslatorStub.status != 200:
+            self.send_response(TranslatorStub.status)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = json.dumps([{'translations': [{'text': text.upper()}]} for text in texts]).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TranslateCase(AppCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), TranslatorStub)
+        Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+
+    def setUp(self):
+        TranslatorStub.requests = []
+        TranslatorStub.status = 200
+        super().setUp()
+        self.app.config['MS_TRANSLATOR_KEY'] = 'key'
+        self.app.config['MS_TRANSLATOR_URL'] = f'http://127.0.0.1:{self.server.server_address[1]}'
+        self.app.config['WTF_CSRF_ENABLED'] = False
+
+    def test_cached_translations(self):
+        self.assertEqual(translate('hola', 'es', 'en'), 'HOLA')
+        self.assertEqual(translate('hola', 'es', 'en'), 'HOLA')
+        self.assertEqual(translate('hola', 'es', 'zh'), 'HOLA')
+        # only the first two needed the translator, the same text to another language is a new translation
+        self.assertEqual(TranslatorStub.requests, [['hola'], ['hola']])
+
+        # the missing ones go in one request, and duplicates only once
+        self.assertEqual(translate_many(['hola', 'adios', 'gato', 'adios'], 'es', 'en'),
+                         ['HOLA', 'ADIOS', 'GATO', 'ADIOS'])
+        self.assertEqual(TranslatorStub.requests[2:], [['adios', 'gato']])
+
+    def test_translate_batch(self):
+        u = User(username='susan', email='susan@example.com')
+        u.set_password('cat')
+        db.session.add(u)
+        db.session.commit()
+        client = self.app.test_client()
+        client.post('/auth/login', data={'username': 'susan', 'password': 'cat'})
+        response = client.post('/translate_batch', json={'dest_language': 'en', 'items': [
+            {'text': 'hola', 'source_language': 'es'},
+            {'text': 'ni hao', 'source_language': 'zh'},
+            {'text': 'gato', 'source_language': 'es'},
+        ]})
+        self.assertEqual(response.get_json(), {'texts': ['HOLA', 'NI HAO', 'GATO']})
+        # one request per source language
+        self.assertEqual(sorted(TranslatorStub.requests), [['hola', 'gato'], ['ni hao']])
+
+    def test_translator_breaker(self):
+        TranslatorStub.status = 503
+        failed = 'Error: the translation service failed.'
+        for word in ['uno', 'dos', 'tres', 'cuatro']:
+            self.assertEqual(translate(word, 'es', 'en'), failed)
+        # the breaker opened after three failures, and the fourth never reached the translator
+        self.assertEqual(TranslatorStub.requests, [['uno'], ['dos'], ['tres']])
+        self.assertFalse(self.app.health.is_up('translator'))
+
+        # a passing health check closes it again
+        TranslatorStub.status = 200
+        self.assertEqual(self.app.health.check_all()['translator'], True)
+        self.assertEqual(translate('cuatro', 'es', 'en'), 'CUATRO')
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class MailSink:
+    # an aiosmtpd handler that keeps what it is sent
+    def __init__(self):
+        self.connections = 0
+        self.messages = []
+
+    async def handle_EHLO(self, server, session, envelope, hostname, responses):
+        self.connections += 1
+        session.host_name = hostname
+        return responses
+
+    async def handle_RCPT(self, server, session, envelope, address, rcpt_options):
+        if address.startswith('nobody@'):
+            return '550 no such user'
+        envelope.rcpt_tos.append(address)
+        return '250 OK'
+
+    async def handle_DATA(self, server, session, envelope):
+        self.messages.append(email.message_from_bytes(envelope.content))
+        return '250 OK'
+
+
+class MailCase(AppCase):
+    def setUp(self):
+        self.sink = MailSink()
+        # the controller checks it is up by connecting to its port, so it can't be given port 0
+        port = free_port()
+        self.smtp = Controller(self.sink, hostname='127.0.0.1', port=port)
+        self.smtp.start()
+
+        class MailConfig(TestConfig):
+            MAIL_SERVER = '127.0.0.1'
+            MAIL_PORT = port
+            HEALTH_CHECK_SMTP = True
+            MAIL_SUPPRESS_SEND = False
+
+        self.config = MailConfig
+        super().setUp()
+
+    def tearDown(self):
+        super().tearDown()
+        self.smtp.stop()
+
+    def test_deliver_batch(self):
+        messages = [outbox._to_dict(self.message(f'user{i}@example.com')) for i in range(5)]
+        messages[2] = outbox._to_dict(self.message('nobody@example.com'))
+        messages[3]['attachments'] = [['posts.ndjson.gz', 'application/gzip',
+                                       base64.b64encode(b'\x1f\x8b data').decode('ascii')]]
+        # the refused one is dropped, not kept for another try
+        self.assertEqual(outbox.deliver(messages), [])
+        self.assertEqual(self.sink.connections, 1)
+        self.assertEqual([m['To'] for m in self.sink.messages],
+                         ['user0@example.com', 'user1@example.com', 'user3@example.com', 'user4@example.com'])
+        attachment = [part for part in self.sink.messages[2].walk() if part.get_filename()][0]
+        self.assertEqual(attachment.get_payload(decode=True), b'\x1f\x8b data')
+
+    def test_deliver_without_server(self):
+        self.app.extensions['mail'].port = free_port()
+        messages = [outbox._to_dict(self.message('user@example.com'))]
+        self.assertEqual(outbox.deliver(messages), messages)
+
+    def test_smtp_health(self):
+        self.assertEqual(self.app.health.check_all()['smtp'], True)
+        self.assertEqual(self.app.health.report()['checks']['smtp']['status'], 'up')
+
+        self.app.config['MAIL_PORT'] = self.app.extensions['mail'].port = free_port()
+        self.assertEqual(self.app.health.check_all()['smtp'], False)
+        self.assertEqual(self.app.health.report()['checks']['smtp']['breaker'], 'open')
+        # with the breaker open, nothing even tries to connect
+        messages = [outbox._to_dict(self.message('user@example.com'))]
+        with mock.patch('smtplib.SMTP') as smtp:
+            self.assertEqual(outbox.deliver(messages), messages)
+        smtp.assert_not_called()
+
+    def message(self, recipient):
+        msg = flask_mail.Message('hello', sender='no-reply@example.com', recipients=[recipient])
+        msg.body = 'hi'
+        msg.html = '<p>hi</p>'
+        return msg
+
 
 if __name__ == '__main__':
     unittest.main(verbosity=2)
\ No newline at end of file
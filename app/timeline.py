@@ -0,0 +1,266 @@
+from datetime import datetime, timezone
+from flask import current_app
+from app import db, queues
+from app.models import Post, followers
+from app.pagination import InvalidCursor, KeysetPage, decode_cursor, encode_cursor, keyset_paginate
+import sqlalchemy as sa
+import redis
+
+# home timelines are redis sorted sets of post ids by timestamp, the +inf sentinel marks an empty one as warm
+SENTINEL = '0'
+
+# Only touch a timeline that already exists. Adding to a cold key would create a partial timeline
+# that looks warm, so those users just get a full rebuild the next time they load the home page.
+# Pushing to a timeline counts as touching it, like reading it does, so it lives on for another TTL.
+PUSH_IF_WARM = """
+if redis.call('exists', KEYS[1]) == 1 then
+    for i = 3, #ARGV, 2 do
+        redis.call('zadd', KEYS[1], ARGV[i], ARGV[i + 1])
+    end
+    redis.call('zremrangebyrank', KEYS[1], 0, -(tonumber(ARGV[1]) + 2))
+    redis.call('expire', KEYS[1], ARGV[2])
+end
+"""
+
+# One page of a timeline for (timestamp, id) cursors, the same ones keyset_paginate hands out for the SQL
+# query, so either can carry on from the other. Redis orders posts with the same score by their ids as
+# strings, not as numbers, so this returns every post with the score of the cursor and every post with the
+# score of the last one in the window, and the caller sorts them out. The oldest post comes back too, to
+# know where a capped timeline stops. Returns nil for a cold timeline.
+# ARGV: the cursor's score ('' for the first page), 'next' or 'prev', how many, the TTL
+PAGE_AFTER = """
+if redis.call('exists', KEYS[1]) == 0 then
+    return false
+end
+redis.call('expire', KEYS[1], ARGV[4])
+local bound = ARGV[1]
+local ties = {}
+if bound ~= '' then
+    ties = redis.call('zrangebyscore', KEYS[1], bound, bound, 'withscores')
+end
+local window
+if ARGV[2] == 'next' then
+    local top = '(+inf'
+    if bound ~= '' then
+        top = '(' .. bound
+    end
+    window = redis.call('zrevrangebyscore', KEYS[1], top, '-inf', 'withscores', 'limit', 0, tonumber(ARGV[3]))
+else
+    window = redis.call('zrangebyscore', KEYS[1], '(' .. bound, '(+inf', 'withscores', 'limit', 0, tonumber(ARGV[3]))
+end
+local last = {}
+if #window > 0 then
+    last = redis.call('zrangebyscore', KEYS[1], window[#window], window[#window], 'withscores')
+end
+return {redis.call('zcard', KEYS[1]), redis.call('zrange', KEYS[1], 0, 0, 'withscores'), ties, window, last}
+"""
+
+
+def _key(user_id):
+    return f'timeline:{user_id}'
+
+
+def _score(timestamp):
+    # sqlite hands back naive datetimes, but everything we store is in UTC
+    return timestamp.replace(tzinfo=timezone.utc).timestamp()
+
+
+def _from_score(score):
+    return datetime.fromtimestamp(score, timezone.utc).replace(tzinfo=None)
+
+
+def _push(client, user_id, posts):
+    args = [current_app.config['TIMELINE_LENGTH'], current_app.config['TIMELINE_TTL']]
+    for post_id, timestamp in posts:
+        args.extend([_score(timestamp), post_id])
+    current_app.redis.register_script(PUSH_IF_WARM)(keys=[_key(user_id)], args=args, client=client)
+
+
+def rebuild(user):
+    """Load the newest TIMELINE_LENGTH posts for a user from SQL and store them in redis."""
+    query = sa.select(Post.id, Post.timestamp).where(sa.or_(
+        Post.user_id == user.id,
+        Post.user_id.in_(sa.select(followers.c.followed_id).where(followers.c.follower_id == user.id))
+    )).order_by(Post.timestamp.desc()).limit(current_app.config['TIMELINE_LENGTH'])
+    rows = db.session.execute(query).all()
+    mapping = {SENTINEL: float('inf')}
+    for post_id, timestamp in rows:
+        mapping[post_id] = _score(timestamp)
+    pipe = current_app.redis.pipeline()
+    pipe.delete(_key(user.id))
+    pipe.zadd(_key(user.id), mapping)
+    pipe.expire(_key(user.id), current_app.config['TIMELINE_TTL'])
+    pipe.execute()
+    return [post_id for post_id, _ in rows]
+
+
+def clear(batch_size=1000):
+    """Throw away every cached timeline, they are rebuilt from SQL as they are read. Returns how many."""
+    cleared = 0
+    keys = []
+    for key in current_app.redis.scan_iter(match=_key('*'), count=batch_size):
+        keys.append(key)
+        if len(keys) >= batch_size:
+            cleared += current_app.redis.unlink(*keys)
+            keys = []
+    if keys:
+        cleared += current_app.redis.unlink(*keys)
+    return cleared
+
+
+def push_post(post):
+    """Put a freshly committed post on its author's timeline and fan it out to followers in the background."""
+    try:
+        _push(None, post.user_id, [(post.id, post.timestamp)])
+        queues.enqueue('app.tasks.fan_out_post', post.id)
+    except redis.exceptions.RedisError:
+        current_app.logger.warning('Could not push post %s to the timeline cache', post.id)
+
+
+def fan_out(post, batch_size=1000):
+    """Add a post to the timeline of every follower of its author. Runs inside an RQ job."""
+    query = sa.select(followers.c.follower_id).where(followers.c.followed_id == post.user_id)
+    pipe = current_app.redis.pipeline(transaction=False)
+    for follower_id in db.session.scalars(query.execution_options(yield_per=batch_size)):
+        _push(pipe, follower_id, [(post.id, post.timestamp)])
+        if len(pipe) >= batch_size:
+            pipe.execute()
+    pipe.execute()
+
+
+def backfill(user, followed):
+    """Merge the recent posts of a newly followed user into the follower's timeline."""
+    query = sa.select(Post.id, Post.timestamp).where(Post.user_id == followed.id).order_by(
+        Post.timestamp.desc()).limit(current_app.config['TIMELINE_LENGTH'])
+    try:
+        _push(None, user.id, db.session.execute(query).all())
+    except redis.exceptions.RedisError:
+        current_app.logger.warning('Could not backfill the timeline cache of user %s', user.id)
+
+
+def prune(user, unfollowed):
+    """Drop the posts of an unfollowed user from the follower's timeline."""
+    key = _key(user.id)
+    try:
+        size = current_app.redis.zcard(key)
+        if size <= 1:
+            # cold, or nothing in it but the sentinel, so there is nothing to drop
+            return
+        if size - 1 >= current_app.config['TIMELINE_LENGTH']:
+            # the timeline was capped, so removing posts would leave holes that we can't refill
+            # from what is cached. Throw it away and let the next read rebuild it.
+            current_app.redis.delete(key)
+            return
+        oldest = current_app.redis.zrange(key, 0, 0, withscores=True)[0][1]
+        query = sa.select(Post.id).where(Post.user_id == unfollowed.id, Post.timestamp >= _from_score(oldest))
+        ids = db.session.scalars(query).all()
+        if ids:
+            current_app.redis.zrem(key, *ids)
+    except redis.exceptions.RedisError:
+        current_app.logger.warning('Could not prune the timeline cache of user %s', user.id)
+
+
+class TimelinePage:
+    # quacks like the flask_sqlalchemy Pagination object, which is all the templates and views use
+    def __init__(self, items, page, has_next):
+        self.items = items
+        self.page = page
+        self.has_next = has_next
+        self.has_prev = page > 1
+        self.next_num = page + 1 if has_next else None
+        self.prev_num = page - 1 if self.has_prev else None
+
+    def __iter__(self):
+        return iter(self.items)
+
+
+def _read(user, start, count):
+    key = _key(user.id)
+    pipe = current_app.redis.pipeline()
+    pipe.zcard(key)
+    # +1 skips the sentinel, which always sits at the top
+    pipe.zrevrange(key, start + 1, start + count)
+    # reading a timeline keeps it, only ones nobody looks at expire
+    pipe.expire(key, current_app.config['TIMELINE_TTL'])
+    size, ids, _ = pipe.execute()
+    if size == 0:
+        ids = rebuild(user)
+        return len(ids), ids[start:start + count]
+    return size - 1, [int(post_id) for post_id in ids]
+
+
+def home_page(user, page, per_page):
+    """Return one page of the user's home timeline, reading post ids from redis when possible."""
+    start = (page - 1) * per_page
+    try:
+        # ask for one extra id to know if there is a next page without counting anything
+        size, ids = _read(user, start, per_page + 1)
+    except redis.exceptions.RedisError:
+        size, ids = None, None
+    if size is None or (size >= current_app.config['TIMELINE_LENGTH'] and start + per_page >= size):
+        # redis is unavailable, or the page goes past the end of a capped timeline
+        return db.paginate(user.following_posts(), page=page, per_page=per_page, error_out=False)
+    page_ids = ids[:per_page]
+    posts = {post.id: post for post in db.session.scalars(sa.select(Post).where(Post.id.in_(page_ids)))}
+    return TimelinePage([posts[post_id] for post_id in page_ids if post_id in posts], page,
+                        has_next=len(ids) > per_page)
+
+
+def _cursor_page(user, values, direction, per_page):
+    script = current_app.redis.register_script(PAGE_AFTER)
+    args = [repr(_score(values[0])) if values else '', direction, per_page + 1, current_app.config['TIMELINE_TTL']]
+    result = script(keys=[_key(user.id)], args=args)
+    if result is None:
+        rebuild(user)
+        result = script(keys=[_key(user.id)], args=args)
+    size, oldest, *groups = result
+    # the posts with the oldest score in a capped timeline may only be partly there, so nothing from that
+    # score down can be answered from redis
+    floor = float(oldest[1]) if size - 1 >= current_app.config['TIMELINE_LENGTH'] else None
+    found = set()
+    for group in groups:
+        for member, score in zip(group[::2], group[1::2]):
+            if member != SENTINEL.encode() and (floor is None or float(score) > floor):
+                found.add((float(score), int(member)))
+    if values:
+        after = (_score(values[0]), values[1])
+        if floor is not None and direction == 'prev' and after[0] <= floor:
+            return None
+        found = {key for key in found if (key < after if direction == 'next' else key > after)}
+    ids = [post_id for _, post_id in sorted(found, reverse=direction == 'next')[:per_page + 1]]
+    if floor is not None and direction == 'next' and len(ids) <= per_page:
+        # the page goes past the end of the capped timeline
+        return None
+    return ids
+
+
+def home_cursor_page(user, cursor, per_page):
+    """Return one page of the user's home timeline for a (timestamp, id) cursor, like keyset_paginate."""
+    try:
+        values, direction = decode_cursor(cursor) if cursor else (None, 'next')
+        if values is not None and not (len(values) == 2 and isinstance(values[0], datetime)
+                                       and isinstance(values[1], int)):
+            raise InvalidCursor(cursor)
+    except InvalidCursor:
+        cursor, values, direction = None, None, 'next'
+    try:
+        ids = _cursor_page(user, values, direction, per_page)
+    except redis.exceptions.RedisError:
+        ids = None
+    if ids is None:
+        # redis is unavailable, or the page is further back than a capped timeline goes
+        return keyset_paginate(user.following_posts(), (Post.timestamp, Post.id), cursor, per_page)
+    more = len(ids) > per_page
+    page_ids = ids[:per_page]
+    posts = {post.id: post for post in db.session.scalars(sa.select(Post).where(Post.id.in_(page_ids)))}
+    items = [posts[post_id] for post_id in page_ids if post_id in posts]
+    if direction == 'prev':
+        items.reverse()
+        has_next, has_prev = cursor is not None, more
+    else:
+        has_next, has_prev = more, cursor is not None
+    return KeysetPage(
+        items,
+        encode_cursor([items[-1].timestamp, items[-1].id], 'next') if has_next and items else None,
+        encode_cursor([items[0].timestamp, items[0].id], 'prev') if has_prev and items else None,
+    )
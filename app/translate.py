@@ -1,19 +1,95 @@
 from flask_babel import _
 from flask import current_app
+from hashlib import sha1
+from requests.adapters import HTTPAdapter
+from app.health import CircuitOpen
 import requests, uuid, json
+import redis
+
+# Translations are cached in two places: a small in-process LRU cache that is checked first (see
+# app/cache.py), and redis, which is shared by all the processes and keeps them much longer. Only when
+# neither has it do we ask the translator, and then for all the missing texts in one request.
+
+# the translator takes up to 1000 texts per request, we stay well under that
+BATCH_SIZE = 100
+
+_session = None
+
+
+def _get_session():
+    # one session per process, so connections to the translator are kept alive and reused
+    global _session
+    if _session is None:
+        _session = requests.Session()
+        _session.mount('https://', HTTPAdapter(pool_maxsize=16))
+        _session.mount('http://', HTTPAdapter(pool_maxsize=16))
+    return _session
+
+
+def _cache_key(text, source_language, dest_language):
+    digest = sha1(text.encode('utf-8')).hexdigest()
+    return f'translation:{source_language}:{dest_language}:{digest}'
+
 
 def translate(text, source_language, dest_language):
+    return translate_many([text], source_language, dest_language)[0]
+
+
+def translate_many(texts, source_language, dest_language):
+    """Translate a list of texts from one language to another. Returns the translations in the same order.
 
+    If the translator fails, the texts it was asked for get an error message instead.
+    """
     if 'MS_TRANSLATOR_KEY' not in current_app.config or not current_app.config['MS_TRANSLATOR_KEY']:
-        return _('Error: the translation service is not configured.')
+        return [_('Error: the translation service is not configured.')] * len(texts)
+
+    keys = [_cache_key(text, source_language, dest_language) for text in texts]
+    results = {}
+    for key in keys:
+        cached = current_app.translation_cache.get(key)
+        if cached is not None:
+            results[key] = cached
+    missing = [key for key in dict.fromkeys(keys) if key not in results]
+    if missing:
+        try:
+            for key, cached in zip(missing, current_app.redis.mget(missing)):
+                if cached is not None:
+                    results[key] = cached.decode('utf-8')
+                    current_app.translation_cache.set(key, results[key])
+        except redis.exceptions.RedisError:
+            pass
+
+    # the same text can be in the list more than once, it only needs translating once
+    todo = {key: text for key, text in zip(keys, texts) if key not in results}
+    todo = list(todo.items())
+    for i in range(0, len(todo), BATCH_SIZE):
+        batch = todo[i:i + BATCH_SIZE]
+        translations = _call_translator([text for key, text in batch], source_language, dest_language)
+        if translations is None:
+            for key, _text in batch:
+                results[key] = _('Error: the translation service failed.')
+            continue
+        for (key, _text), translation in zip(batch, translations):
+            results[key] = translation
+            current_app.translation_cache.set(key, translation)
+        try:
+            pipe = current_app.redis.pipeline()
+            for (key, _text), translation in zip(batch, translations):
+                pipe.set(key, translation, ex=current_app.config['TRANSLATION_CACHE_TTL'])
+            pipe.execute()
+        except redis.exceptions.RedisError:
+            pass
+    return [results[key] for key in keys]
+
 
+def _call_translator(texts, source_language, dest_language):
     # Add your key and endpoint
     key = current_app.config['MS_TRANSLATOR_KEY']
-    endpoint = "https://api.cognitive.microsofttranslator.com"
+    endpoint = current_app.config['MS_TRANSLATOR_URL']
 
     # location, also known as region.
     # required if you're using a multi-service or regional (not global) resource. It can be found in the Azure portal on the Keys and Endpoint page.
-    location = "westus2"
+    location = current_app.config['MS_TRANSLATOR_REGION']
 
     path = '/translate'
     constructed_url = endpoint + path
@@ -32,16 +108,25 @@ def translate(text, source_language, dest_language):
         'X-ClientTraceId': str(uuid.uuid4())
     }
 
-    # You can pass more than one object in body.
-    body = [{
-        'text': text
-    }]
+    # one object per text, the translations come back in the same order
+    body = [{'text': text} for text in texts]
 
-    request = requests.post(constructed_url, params=params, headers=headers, json=body)
+    try:
+        # fails straight away while the translator is known to be down, see app/health.py
+        with current_app.health.breakers['translator']:
+            request = _get_session().post(constructed_url, params=params, headers=headers, json=body,
+                                          timeout=current_app.config['MS_TRANSLATOR_TIMEOUT'])
+            if request.status_code >= 500:
+                raise requests.HTTPError(f'the translator answered {request.status_code}', response=request)
+    except CircuitOpen:
+        return None
+    except requests.RequestException:
+        current_app.logger.warning('Could not reach the translation service', exc_info=True)
+        return None
 
     if request.status_code != 200:
-        return _('Error: the translation service failed.')
+        return None
 
     response = request.json()
-    # return the actual translation as a string
-    return response[0]['translations'][0]['text']
\ No newline at end of file
+    # the actual translations as strings
+    return [item['translations'][0]['text'] for item in response]
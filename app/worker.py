@@ -0,0 +1,127 @@
+import importlib
+import os
+import signal
+import time
+import traceback
+import rq
+import sqlalchemy as sa
+from app import cache, db, language
+
+# RQ's own worker forks a fresh process for every job, and each one used to import app.tasks, which
+# built a whole new app, connected to everything and loaded the langdetect profiles before it could start
+# on the job. `flask worker` builds the app once, does all of that warming up in a parent process, and then
+# forks long-lived workers from it that run job after job in the same process, keeping their database and
+# redis connection pools. Each job gets an app context of its own, and the session is removed when it ends.
+# --fork still gives every job a process of its own, forked from an already warm worker.
+
+
+class AppContextMixin:
+    """Runs every job inside an app context. Without an app, it makes one, for `rq worker -w`."""
+
+    def __init__(self, *args, app=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        if app is None:
+            from app import create_app
+            app = create_app()
+            warm_up(app)
+        self.app = app
+
+    def perform_job(self, job, queue):
+        with self.app.app_context():
+            return super().perform_job(job, queue)
+
+
+class AppWorker(AppContextMixin, rq.SimpleWorker):
+    """Runs every job in the worker's own process."""
+    pass
+
+
+class ForkingAppWorker(AppContextMixin, rq.Worker):
+    """Forks a work horse for every job, from a worker that has already done the warming up."""
+
+    def main_work_horse(self, job, queue):
+        # the work horse must not share the worker's database connections
+        _dispose_engines(self.app)
+        super().main_work_horse(job, queue)
+
+
+def warm_up(app):
+    """Do everything the first job would otherwise pay for, before any workers are forked."""
+    with app.app_context():
+        # the tasks module imports the models and everything they use
+        importlib.import_module('app.tasks')
+        sa.orm.configure_mappers()
+        for name in app.jinja_env.list_templates():
+            app.jinja_env.get_template(name)
+        language.load_profiles()
+
+
+def run(app, workers, fork=False, burst=False, with_scheduler=False):
+    """Fork a worker process for each (name, queue names) in workers and keep them running.
+
+    Workers that exit are started again, unless burst is set, in which case this returns once they have
+    all emptied their queues. SIGTERM or SIGINT asks every worker to finish its job and stop.
+    """
+    warm_up(app)
+    children = {}
+
+    def start(index):
+        name, queue_names = workers[index]
+        pid = os.fork()
+        if pid:
+            children[pid] = index
+            return
+        code = 0
+        try:
+            # a Ctrl+C reaches only the parent, which passes it on once. RQ takes a second signal
+            # as an order to kill the job it is running
+            os.setpgrp()
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            _dispose_engines(app)
+            cache.start_listener(app)
+            worker_class = ForkingAppWorker if fork else AppWorker
+            worker = worker_class([app.task_queues[queue] for queue in queue_names], name=name,
+                                  connection=app.redis, app=app)
+            # one scheduler is plenty, the others would only wait for its lock
+            worker.work(burst=burst, with_scheduler=with_scheduler and index == 0)
+        except BaseException:
+            traceback.print_exc()
+            code = 1
+        finally:
+            os._exit(code)
+
+    for index in range(len(workers)):
+        start(index)
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        if not stopping:
+            stopping = True
+            for pid in children:
+                os.kill(pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        index = children.pop(pid, None)
+        if index is None or stopping or burst:
+            continue
+        app.logger.warning('Worker %s exited with %s, starting it again', workers[index][0],
+                           os.waitstatus_to_exitcode(status))
+        # don't spin if it dies straight away, redis being down say
+        time.sleep(1)
+        if not stopping:
+            start(index)
+
+
+def _dispose_engines(app):
+    # the pools were copied from the parent, so drop them without closing the parent's connections
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=False)
@@ -0,0 +1,85 @@
+"""Time the explore page with the rendered post cache off and on.
+
+    python benchmarks/explore.py [--per-page 50] [--requests 200]
+
+The page is fetched with Flask's test client by a logged in user, so the time is the whole request: the
+query, the rendering and everything else. "on" is with every post already in the process's cache. If
+redis is up (REDIS_URL) there is also "redis", where the process's cache is emptied before each request
+and the posts come from redis.
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sqlalchemy as sa
+from app import create_app, db
+from app.models import User, Post
+from config import Config
+
+
+def measure(client, requests, before=None):
+    times = []
+    for _ in range(requests):
+        if before:
+            before()
+        start = time.perf_counter()
+        response = client.get('/explore')
+        times.append(time.perf_counter() - start)
+        assert response.status_code == 200
+    return statistics.median(times) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--per-page', type=int, default=50)
+    parser.add_argument('--requests', type=int, default=200)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        class BenchConfig(Config):
+            TESTING = True
+            WTF_CSRF_ENABLED = False
+            SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(tmp, 'bench.db')
+            SEARCH_BACKEND = 'none'
+            POSTS_PER_PAGE = args.per_page
+
+        app = create_app(BenchConfig)
+        with app.app_context():
+            db.create_all()
+            users = [User(username=f'user{i}', email=f'user{i}@example.com') for i in range(20)]
+            users[0].set_password('bench')
+            db.session.add_all(users)
+            db.session.commit()
+            db.session.execute(sa.insert(Post), [
+                {'body': f'post number {i}, about as long as a post usually is', 'user_id': users[i % 20].id,
+                 'language': 'en'} for i in range(args.per_page * 2)])
+            db.session.commit()
+            redis_up = app.health.check('redis')
+
+        client = app.test_client()
+        client.post('/auth/login', data={'username': 'user0', 'password': 'bench'})
+        print(f'explore page with {args.per_page} posts, median of {args.requests} requests')
+
+        app.config['POST_HTML_CACHE_TTL'] = 0
+        off = measure(client, args.requests)
+        print(f'off:   {off:7.2f} ms')
+
+        app.config['POST_HTML_CACHE_TTL'] = 300
+        client.get('/explore')
+        on = measure(client, args.requests)
+        print(f'on:    {on:7.2f} ms   {off / on:.1f}x faster')
+
+        if redis_up:
+            from_redis = measure(client, args.requests, app.post_html_cache.clear)
+            print(f'redis: {from_redis:7.2f} ms   {off / from_redis:.1f}x faster')
+        else:
+            print('redis is not running, so only the cache in the process was measured')
+
+
+if __name__ == '__main__':
+    main()
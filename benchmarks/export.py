@@ -0,0 +1,99 @@
+"""Export a user with a lot of posts, and check that the streaming exporter stays under a memory ceiling.
+
+    python benchmarks/export.py [--posts 1000000] [--ceiling 32] [--compare]
+
+Memory is the peak of Python allocations during the export, measured with tracemalloc. --compare also
+runs the old exporter, which built a list of every post and json.dumps()ed it, on the same posts. Expect
+that one to need gigabytes at a million posts.
+"""
+import argparse
+import gzip
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sqlalchemy as sa
+from app import create_app, db, export
+from app.models import User, Post
+from config import Config
+
+
+def measure(fn):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = fn()
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak / 2 ** 20
+
+
+def old_export(user):
+    # what app/tasks.py did before, without the sleep
+    data = []
+    for post in db.session.scalars(user.posts.select().order_by(Post.timestamp.asc())):
+        data.append({'body': post.body, 'timestamp': post.timestamp.isoformat() + 'Z'})
+    return len(json.dumps({'posts': data}, indent=4))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--posts', type=int, default=1000000)
+    parser.add_argument('--chunk-size', type=int, default=1000)
+    parser.add_argument('--ceiling', type=float, default=32, help='most MB the streaming export may use')
+    parser.add_argument('--compare', action='store_true')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        class BenchConfig(Config):
+            TESTING = True
+            SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(tmp, 'bench.db')
+            SEARCH_BACKEND = 'none'
+
+        app = create_app(BenchConfig)
+        with app.app_context():
+            db.create_all()
+            user = User(username='bench', email='bench@example.com')
+            db.session.add(user)
+            db.session.commit()
+            start = datetime(2020, 1, 1)
+            for i in range(0, args.posts, 100000):
+                db.session.execute(sa.insert(Post), [
+                    {'body': f'post number {j} with a few more words in it, like a real one would',
+                     'user_id': user.id, 'timestamp': start + timedelta(seconds=j)}
+                    for j in range(i, min(i + 100000, args.posts))
+                ])
+            db.session.commit()
+
+            path = os.path.join(tmp, 'posts.ndjson.gz')
+
+            def stream():
+                with open(path, 'wb') as f:
+                    return export.write_posts(user.id, f, args.chunk_size)
+
+            count, elapsed, peak = measure(stream)
+            size = os.path.getsize(path) / 2 ** 20
+            print(f'{count} posts')
+            print(f'streaming: {elapsed:6.2f}s  {count / elapsed:8.0f} posts/s  peak {peak:8.1f} MB  '
+                  f'file {size:.1f} MB')
+            with gzip.open(path, 'rt', encoding='utf-8') as f:
+                assert sum(1 for _ in f) == args.posts
+
+            if args.compare:
+                db.session.expunge_all()
+                _, elapsed, peak_old = measure(lambda: old_export(user))
+                print(f'old:       {elapsed:6.2f}s  {count / elapsed:8.0f} posts/s  peak {peak_old:8.1f} MB')
+            db.session.remove()
+
+    if peak > args.ceiling:
+        sys.exit(f'the streaming export used {peak:.1f} MB, over the {args.ceiling} MB ceiling')
+
+
+if __name__ == '__main__':
+    main()
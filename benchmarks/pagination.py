@@ -0,0 +1,82 @@
+"""Compare OFFSET pagination with keyset pagination on the explore query.
+
+    python benchmarks/pagination.py [--posts 100010] [--per-page 10]
+
+Page 1 and page 10,000 should take about the same time with cursors, while the OFFSET
+version gets slower the deeper it goes (and pays for a COUNT(*) on every page).
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sqlalchemy as sa
+from app import create_app, db
+from app.models import User, Post
+from app.pagination import keyset_paginate, encode_cursor
+from config import Config
+
+
+def best_of(fn, repeat=5):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return min(timings) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--posts', type=int, default=100010)
+    parser.add_argument('--per-page', type=int, default=10)
+    args = parser.parse_args()
+    deep_page = (args.posts - 1) // args.per_page
+
+    with tempfile.TemporaryDirectory() as tmp:
+        class BenchConfig(Config):
+            TESTING = True
+            SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(tmp, 'bench.db')
+
+        app = create_app(BenchConfig)
+        with app.app_context():
+            db.create_all()
+            user = User(username='bench', email='bench@example.com')
+            db.session.add(user)
+            db.session.commit()
+            start = datetime(2020, 1, 1)
+            db.session.execute(sa.insert(Post), [
+                {'body': f'post {i}', 'user_id': user.id, 'timestamp': start + timedelta(seconds=i)}
+                for i in range(args.posts)
+            ])
+            db.session.commit()
+
+            query = sa.select(Post).order_by(Post.timestamp.desc())
+            keys = (Post.timestamp, Post.id)
+            # the cursor a client would be holding after walking to the deep page one page at a time
+            last = db.session.execute(sa.select(Post.timestamp, Post.id).order_by(
+                Post.timestamp.desc(), Post.id.desc()).offset((deep_page - 1) * args.per_page - 1).limit(1)).one()
+            deep_cursor = encode_cursor(list(last), 'next')
+            assert keyset_paginate(query, keys, deep_cursor, args.per_page).items == \
+                db.paginate(query, page=deep_page, per_page=args.per_page).items
+
+            def offset(page):
+                db.paginate(query, page=page, per_page=args.per_page, error_out=False).items
+
+            def keyset(cursor):
+                keyset_paginate(query, keys, cursor, args.per_page).items
+
+            print(f'{args.posts} posts, {args.per_page} per page')
+            print(f'offset  page 1:      {best_of(lambda: offset(1)):8.2f} ms')
+            print(f'offset  page {deep_page}: {best_of(lambda: offset(deep_page)):8.2f} ms')
+            print(f'keyset  page 1:      {best_of(lambda: keyset(None)):8.2f} ms')
+            print(f'keyset  page {deep_page}: {best_of(lambda: keyset(deep_cursor)):8.2f} ms')
+            db.session.remove()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+"""Compare the SQLite FTS5 search backend with elasticsearch.
+
+    python benchmarks/search.py [--posts 50000] [--batch 500]
+
+Loads the same generated posts into each backend with bulk(), then times single updates and a few
+queries. Elasticsearch is only measured when ELASTICSEARCH_URL is set, into a throwaway index that is
+deleted afterwards.
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import create_app
+from app.fts import FTSBackend
+from app.search import ElasticsearchBackend
+from config import Config
+
+# a very common word, two common ones, and two rare ones
+QUERIES = ['w0', 'w10 w20', 'w3000 w4000']
+
+
+def best_of(fn, repeat=5):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return min(timings) * 1000
+
+
+def make_posts(count):
+    # word frequencies roughly follow Zipf's law, like real text, so common and rare words both exist
+    rng = random.Random(42)
+    words = [f'w{i}' for i in range(5000)]
+    weights = [1 / (rank + 1) for rank in range(len(words))]
+    return {i: {'body': ' '.join(rng.choices(words, weights, k=rng.randint(5, 40)))}
+            for i in range(1, count + 1)}
+
+
+def run(name, backend, index, posts, batch, refresh=None):
+    ids = list(posts)
+    start = time.perf_counter()
+    for i in range(0, len(ids), batch):
+        backend.bulk(index, {id: posts[id] for id in ids[i:i + batch]}, [])
+    if refresh:
+        refresh()
+    load = time.perf_counter() - start
+    print(f'{name}: loaded {len(ids)} posts in {load:.2f}s ({len(ids) / load:.0f} posts/s)')
+    print(f'  update one post:          {best_of(lambda: backend.bulk(index, {1: posts[1]}, [])):8.2f} ms')
+    for query in QUERIES:
+        _, total = backend.query(index, query, 1, 10)
+        print(f'  {query!r:16} page 1:     {best_of(lambda: backend.query(index, query, 1, 10)):8.2f} ms '
+              f'({total} matches)')
+        print(f'  {query!r:16} page 100:   {best_of(lambda: backend.query(index, query, 100, 10)):8.2f} ms')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--posts', type=int, default=50000)
+    parser.add_argument('--batch', type=int, default=500)
+    args = parser.parse_args()
+    posts = make_posts(args.posts)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        class BenchConfig(Config):
+            TESTING = True
+            SQLALCHEMY_DATABASE_URI = 'sqlite://'
+            SEARCH_BACKEND = 'none'
+
+        app = create_app(BenchConfig)
+        with app.app_context():
+            run('sqlite fts5', FTSBackend(os.path.join(tmp, 'search.db')), 'post', posts, args.batch)
+
+            if app.elasticsearch:
+                index = f'bench-post-{int(time.time())}'
+                app.elasticsearch.indices.create(index=index)
+                try:
+                    run('elasticsearch', ElasticsearchBackend(app.elasticsearch), index, posts, args.batch,
+                        refresh=lambda: app.elasticsearch.indices.refresh(index=index))
+                finally:
+                    app.elasticsearch.indices.delete(index=index)
+            else:
+                print('ELASTICSEARCH_URL is not set, skipping elasticsearch')
+
+
+if __name__ == '__main__':
+    main()
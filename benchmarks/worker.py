@@ -0,0 +1,124 @@
+"""How long a task worker takes to start on a job, cold and warm.
+
+    python benchmarks/worker.py [--jobs 50]
+
+Each job looks up a user and renders an email template, about the least a real task does. Three ways of
+running it are timed, from the moment the job is handed over until it is done:
+
+cold      what `rq worker` did with the old app/tasks.py. Every job is forked from a process that has
+          not imported the app, so it imports it, builds an app and loads the langdetect profiles first
+fork      `flask worker --fork`, every job forked from a worker that did all of that once
+in place  `flask worker`, every job run by the same long-lived process
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+from multiprocessing import Pipe
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def job(user_id):
+    from flask import render_template
+    from app import db
+    from app.models import User
+    user = db.session.get(User, user_id)
+    return render_template('email/export_posts.txt', user=user)
+
+
+def cold_job(user_id):
+    # everything the old app/tasks.py did when it was imported, and then the job
+    from app import create_app, language
+    app = create_app()
+    app.app_context().push()
+    language.load_profiles()
+    job(user_id)
+
+
+def bare_parent(conn, user_id):
+    # started before the app was imported, like the rq worker that used to fork the work horses
+    while conn.recv():
+        start = time.perf_counter()
+        pid = os.fork()
+        if pid == 0:
+            cold_job(user_id)
+            os._exit(0)
+        os.waitpid(pid, 0)
+        conn.send(time.perf_counter() - start)
+
+
+def forked(app, user_id):
+    from app.worker import _dispose_engines
+    start = time.perf_counter()
+    pid = os.fork()
+    if pid == 0:
+        _dispose_engines(app)
+        with app.app_context():
+            job(user_id)
+        os._exit(0)
+    os.waitpid(pid, 0)
+    return time.perf_counter() - start
+
+
+def in_place(app, user_id):
+    start = time.perf_counter()
+    with app.app_context():
+        job(user_id)
+    return time.perf_counter() - start
+
+
+def report(name, times):
+    times = sorted(times)
+    print(f'{name:9} median {statistics.median(times) * 1000:8.1f} ms   '
+          f'p95 {times[int(len(times) * 0.95) - 1] * 1000:8.1f} ms')
+    return statistics.median(times)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--jobs', type=int, default=50)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tmp, 'bench.db')
+        os.environ['SEARCH_BACKEND'] = 'none'
+        # the user is made further down, and is the first one
+        user_id = 1
+        parent, child = Pipe()
+        pid = os.fork()
+        if pid == 0:
+            parent.close()
+            bare_parent(child, user_id)
+            os._exit(0)
+        child.close()
+
+        from app import create_app, db
+        from app.models import User
+        from app.worker import warm_up
+        app = create_app()
+        with app.app_context():
+            db.create_all()
+            db.session.add(User(username='bench', email='bench@example.com'))
+            db.session.commit()
+
+        cold = []
+        for _ in range(args.jobs):
+            parent.send(True)
+            cold.append(parent.recv())
+        parent.send(False)
+        os.waitpid(pid, 0)
+
+        start = time.perf_counter()
+        warm_up(app)
+        print(f'warming up once: {(time.perf_counter() - start) * 1000:.1f} ms')
+        cold = report('cold', cold)
+        fork = report('fork', [forked(app, user_id) for _ in range(args.jobs)])
+        warm = report('in place', [in_place(app, user_id) for _ in range(args.jobs)])
+        print(f'fork is {cold / fork:.0f}x and in place {cold / warm:.0f}x faster to start than cold')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,15 @@
 #!/bin/bash
-while truel do
+while true; do
 	flask db upgrade
 	if [[ "$?" == "0" ]]; then
 		break
 	fi
 	echo Upgrade command failed, retrying in 5 secs....
 done
-exec gunicorn -b :5000 --access-logfile - --error-logfile - microblog:app
+if [[ "$1" == "worker" ]]; then
+	# the task workers, see `flask queues pool`
+	exec flask queues pool
+fi
+# threads, so a page holding a notification stream open (NOTIFICATION_STREAM) doesn't hold up the worker
+exec gunicorn -b :5000 --worker-class gthread --threads ${GUNICORN_THREADS:-16} \
+	--access-logfile - --error-logfile - microblog:app
@@ -13,10 +13,84 @@ class Config:
     MAIL_USE_TLS = os.environ.get('MAIL_USE_TLS') is not None
     MAIL_USERNAME = os.environ.get('MAIL_USERNAME')
     MAIL_PASSWORD = os.environ.get('MAIL_PASSWORD')
+    # seconds to wait for the mail server, to connect and then to answer each command
+    MAIL_TIMEOUT = float(os.environ.get('MAIL_TIMEOUT') or 10)
+    # outgoing mail is queued in redis and sent in batches, one SMTP connection per batch
+    MAIL_BATCH_SIZE = int(os.environ.get('MAIL_BATCH_SIZE') or 50)
+    # the most jobs sending mail at the same time
+    MAIL_CONCURRENCY = int(os.environ.get('MAIL_CONCURRENCY') or 2)
+    # a message is given up on after this many failed tries
+    MAIL_MAX_ATTEMPTS = int(os.environ.get('MAIL_MAX_ATTEMPTS') or 5)
     ADMINS = ['example@test.com']
     FUNNY = os.environ.get('FUNNY')
     POSTS_PER_PAGE = 10
+    # use opaque (timestamp, id) cursors instead of ?page=N everywhere. Any view also accepts ?cursor= on its own.
+    # The home page pages the cached timeline by the same cursors, see app/timeline.py
+    CURSOR_PAGINATION = os.environ.get('CURSOR_PAGINATION') is not None
     LANGUAGES = ['en', 'zh', 'es']
     MS_TRANSLATOR_KEY = os.environ.get('MS_TRANSLATOR_KEY')
+    MS_TRANSLATOR_URL = os.environ.get('MS_TRANSLATOR_URL') or 'https://api.cognitive.microsofttranslator.com'
+    MS_TRANSLATOR_REGION = os.environ.get('MS_TRANSLATOR_REGION') or 'westus2'
+    # seconds to wait for the translator, to connect and then to answer
+    MS_TRANSLATOR_TIMEOUT = float(os.environ.get('MS_TRANSLATOR_TIMEOUT') or 5)
+    # translations are kept in each process and in redis, and a text only has to be translated once
+    TRANSLATION_CACHE_SIZE = int(os.environ.get('TRANSLATION_CACHE_SIZE') or 10000)
+    TRANSLATION_CACHE_TTL = int(os.environ.get('TRANSLATION_CACHE_TTL') or 7 * 24 * 3600)
+    # rendered post HTML is kept in each process for POST_HTML_CACHE_TTL seconds, 0 turns the cache off,
+    # and in redis for POST_HTML_TTL
+    POST_HTML_CACHE_SIZE = int(os.environ.get('POST_HTML_CACHE_SIZE') or 5000)
+    POST_HTML_CACHE_TTL = int(os.environ.get('POST_HTML_CACHE_TTL', 300))
+    POST_HTML_TTL = int(os.environ.get('POST_HTML_TTL') or 24 * 3600)
     ELASTICSEARCH_URL = os.environ.get('ELASTICSEARCH_URL')
-    REDIS_URL = os.environ.get('REDIS_URL') or 'redis://'
\ No newline at end of file
+    # searches give up after this many seconds, bulk indexing in the background gets longer
+    ELASTICSEARCH_TIMEOUT = float(os.environ.get('ELASTICSEARCH_TIMEOUT') or 5)
+    ELASTICSEARCH_BULK_TIMEOUT = float(os.environ.get('ELASTICSEARCH_BULK_TIMEOUT') or 60)
+    # 'elasticsearch', 'sqlite' (SQLite FTS5 in a local file, no server needed) or 'none'. Without
+    # ELASTICSEARCH_URL this is now sqlite, where search used to be off, set it to 'none' to keep it off
+    SEARCH_BACKEND = os.environ.get('SEARCH_BACKEND') or ('elasticsearch' if ELASTICSEARCH_URL else 'sqlite')
+    SEARCH_DATABASE = os.environ.get('SEARCH_DATABASE') or os.path.join(basedir, 'search.db')
+    # seconds search results are cached in redis, 0 turns the cache off
+    SEARCH_CACHE_TTL = int(os.environ.get('SEARCH_CACHE_TTL', 300))
+    REDIS_URL = os.environ.get('REDIS_URL') or 'redis://'
+    # seconds a redis command or connection may take before it counts as failed
+    REDIS_TIMEOUT = float(os.environ.get('REDIS_TIMEOUT') or 2)
+    # the task queues from the most urgent down, with how many workers `flask queues pool` runs for each
+    TASK_QUEUES = os.environ.get('TASK_QUEUES') or 'high:2,default:2,low:1'
+    # seconds before a user's lock on a running task expires, in case its job never finishes
+    TASK_LOCK_TIMEOUT = int(os.environ.get('TASK_LOCK_TIMEOUT') or 3600)
+    # how many processes `flask worker` forks when it isn't told
+    WORKER_PROCESSES = int(os.environ.get('WORKER_PROCESSES') or 2)
+    # search indexing happens in an RQ job with the bulk API, retrying failed items with backoff
+    SEARCH_BULK_RETRIES = int(os.environ.get('SEARCH_BULK_RETRIES') or 3)
+    SEARCH_RETRY_DELAY = float(os.environ.get('SEARCH_RETRY_DELAY') or 1)
+    SEARCH_QUEUE_TIMEOUT = 300
+    # read the follower/following/post counts from the counter columns on User instead of running COUNT(*)
+    USER_COUNTERS = os.environ.get('USER_COUNTERS_DISABLED') is None
+    # seconds between the bulk writes of buffered User.last_seen updates
+    LAST_SEEN_INTERVAL = int(os.environ.get('LAST_SEEN_INTERVAL') or 60)
+    # how many user rows each process keeps for the login loader, and for how many seconds
+    USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE') or 10000)
+    USER_CACHE_TTL = int(os.environ.get('USER_CACHE_TTL') or 30)
+    # same for API tokens. Revoked tokens are evicted right away, the ttl only matters if redis is down
+    TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE') or 10000)
+    TOKEN_CACHE_TTL = int(os.environ.get('TOKEN_CACHE_TTL') or 300)
+    # how many post ids are cached per home timeline, and how long an untouched timeline lives in redis
+    TIMELINE_LENGTH = int(os.environ.get('TIMELINE_LENGTH') or 800)
+    TIMELINE_TTL = int(os.environ.get('TIMELINE_TTL') or 24 * 3600)
+    # how long an unread message counter is kept in redis before it is counted again
+    UNREAD_COUNT_TTL = int(os.environ.get('UNREAD_COUNT_TTL') or 24 * 3600)
+    # push notifications to open pages over Server-Sent Events instead of having them poll. Every open page
+    # holds a server thread for as long as its stream is open, so only turn this on with enough threaded
+    # or async workers to go round (boot.sh runs gunicorn with GUNICORN_THREADS threads per worker)
+    NOTIFICATION_STREAM = os.environ.get('NOTIFICATION_STREAM') is not None
+    # seconds a notification stream stays open before the browser is made to reconnect
+    NOTIFICATION_STREAM_TIMEOUT = int(os.environ.get('NOTIFICATION_STREAM_TIMEOUT') or 300)
+    # seconds between the background checks of redis, elasticsearch, the mail server and the translator,
+    # and how long each check may take
+    HEALTH_CHECK_INTERVAL = int(os.environ.get('HEALTH_CHECK_INTERVAL') or 15)
+    HEALTH_CHECK_TIMEOUT = float(os.environ.get('HEALTH_CHECK_TIMEOUT') or 2)
+    # the mail server is only checked when one was given, not for the localhost default
+    HEALTH_CHECK_SMTP = os.environ.get('MAIL_SERVER') is not None
+    # failures in a row before calls to a backend fail straight away, and seconds before one is tried again
+    CIRCUIT_BREAKER_THRESHOLD = int(os.environ.get('CIRCUIT_BREAKER_THRESHOLD') or 3)
+    CIRCUIT_BREAKER_RESET = int(os.environ.get('CIRCUIT_BREAKER_RESET') or 30)